@@ -1,6 +1,11 @@
 import numpy as n
 cimport numpy as n
 cimport cython
+from libc.string cimport memmove, memset
+cdef extern from "math.h" nogil:
+    float cosf(float)
+    float sinf(float)
+import os, pickle, socket
 #import logging
 #logger = logging.getLogger(__name__)
 #logger.setLevel(logging.INFO)
@@ -71,124 +76,456 @@ cpdef beamonefullxy(n.ndarray[n.float32_t, ndim=2, mode='c'] u, n.ndarray[n.floa
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-cpdef imgonefullxy(n.ndarray[n.float32_t, ndim=2, mode='c'] u, n.ndarray[n.float32_t, ndim=2, mode='c'] v, n.ndarray[DTYPE_t, ndim=3, mode='c'] data, unsigned int npixx, unsigned int npixy, unsigned int uvres, verbose=1):
+cpdef imgonefullxy(n.ndarray[n.float32_t, ndim=2, mode='c'] u, n.ndarray[n.float32_t, ndim=2, mode='c'] v, n.ndarray[DTYPE_t, ndim=3, mode='c'] data, unsigned int npixx, unsigned int npixy, unsigned int uvres, verbose=1, c2r=False):
     # Same as imgallfullxy, but one flux scaled image
     # Defines uvgrid filter before loop
     # flips xy gridding!
+    # c2r images with complex-to-real fft of hermitian half grid
 
     # initial definitions
     shape = n.shape(data)
-    cdef unsigned int len0 = shape[0]
-    cdef unsigned int len1 = shape[1]
-    cdef unsigned int len2 = shape[2]
-    cdef unsigned int i
-    cdef unsigned int j
-    cdef unsigned int p
-    cdef unsigned int cellu
-    cdef unsigned int cellv
     cdef unsigned int nonzeros = 0
-    cdef n.ndarray[DTYPE_t, ndim=2] grid = n.zeros((npixx,npixy), dtype='complex64')
-    cdef arr = pyfftw.n_byte_align_empty((npixx,npixy), 16, dtype='complex64')
+    cdef float norm = npixx*npixy
+    cdef n.ndarray[DTYPE_t, ndim=4, mode='c'] data4 = data[None]
 
     # put uv data on grid
-    cdef n.ndarray[CTYPE_t, ndim=2] uu = n.round(u/uvres).astype(n.int)
-    cdef n.ndarray[CTYPE_t, ndim=2] vv = n.round(v/uvres).astype(n.int)
+    gridop = calc_gridop(u, v, npixx, npixy, uvres, c2r)
+    cdef float gridded = float((gridop[3] < 2).sum())/(shape[0]*shape[1])
+    if c2r:
+        norm = norm/2.
 
-    ifft = pyfftw.builders.ifft2(arr, overwrite_input=True, auto_align_input=True, auto_contiguous=True)
-    
-    ok = n.logical_and(n.abs(uu) < npixx/2, n.abs(vv) < npixy/2)
-    uu = n.mod(uu, npixx)
-    vv = n.mod(vv, npixy)
-
-    # add uv data to grid
-    # or use np.add.at(x, i, y)?
-    for i in xrange(len0):
-        for j in xrange(len1):
-            if ok[i,j]:
-                cellu = uu[i,j]
-                cellv = vv[i,j]
-                for p in xrange(len2):
-                    grid[cellu, cellv] = data[i,j,p] + grid[cellu, cellv]
-                    if data[i,j,p] != 0j:
-                        nonzeros = nonzeros + 1
+    fftplan = get_fftplan(npixx, npixy, 1, 1, c2r)
+    grid_batch(fftplan.input_array, data4, gridop, n.zeros(1, dtype=n.int32))
+    nonzeros = count_nonzero(data4, gridop, 0)
 
     # make images and filter based on threshold
-    arr[:] = grid[:]
-    im = ifft(arr).real*int(npixx*npixy)
+    im = fftplan()[0].real*norm
     im = recenter(im, (npixx/2,npixy/2))
     
     if nonzeros > 0:
         im = im/float(nonzeros)
         if verbose:
-            print 'Gridded %.3f of data. Scaling fft by = %.1f' % (float(ok.sum())/ok.size, int(npixx*npixy)/float(nonzeros))
+            print 'Gridded %.3f of data. Scaling fft by = %.1f' % (gridded, int(npixx*npixy)/float(nonzeros))
     else:
         if verbose:
-            print 'Gridded %.3f of data. All zeros.' % (float(ok.sum())/ok.size)
+            print 'Gridded %.3f of data. All zeros.' % (gridded)
     if verbose:
         print 'Pixel sizes (%.1f\", %.1f\"), Field size %.1f\"' % (3600*n.degrees(2./(npixx*uvres)), 3600*n.degrees(2./(npixy*uvres)), 3600*n.degrees(1./uvres))
     return im
 
+_fftplans = {}   # ifft2 and irfft2 plans made by this process, keyed by (npixx, npixy, batch, threads, c2r)
+
+cpdef get_fftplan(unsigned int npixx, unsigned int npixy, unsigned int batch=1, unsigned int threads=1, c2r=False):
+    """ Returns pyfftw plan for inverse 2d fft of a batch of grids with shape (batch, npixx, npixy).
+    If c2r, plan is complex-to-real fft of hermitian half grids with shape (batch, npixx, npixy/2+1) (see calc_gridop).
+    Plan is made once per process and reused. Grids are put in plan.input_array and plan() returns images in plan.output_array.
+    Both are overwritten by next use of plan.
+    """
+
+    key = (npixx, npixy, batch, threads, bool(c2r))
+    if not _fftplans.has_key(key):
+        if c2r:
+            arr = pyfftw.n_byte_align_empty((batch, npixx, npixy/2+1), 16, dtype='complex64')
+            _fftplans[key] = pyfftw.builders.irfft2(arr, s=(npixx, npixy), axes=(-2,-1), planner_effort='FFTW_MEASURE', threads=threads)
+        else:
+            arr = pyfftw.n_byte_align_empty((batch, npixx, npixy), 16, dtype='complex64')
+            _fftplans[key] = pyfftw.builders.ifft2(arr, axes=(-2,-1), overwrite_input=True, planner_effort='FFTW_MEASURE', threads=threads)
+    return _fftplans[key]
+
+_wisdom = pyfftw.export_wisdom() if ffttype == 'pyfftw' else ()   # FFTW wisdom last imported from or saved to wisdom file by this process
+
+def load_wisdom(wisdomfile):
+    """ Imports FFTW wisdom from pickle file, if it exists. Returns True if wisdom was imported.
+    """
+
+    global _wisdom
+    if os.path.exists(wisdomfile):
+        with open(wisdomfile, 'rb') as pkl:
+            pyfftw.import_wisdom(pickle.load(pkl))
+        _wisdom = pyfftw.export_wisdom()
+        return True
+    else:
+        return False
+
+def save_wisdom(wisdomfile):
+    """ Saves FFTW wisdom accumulated by this process to pickle file, if plans were made since it was loaded or saved.
+    Wisdom saved by other processes is merged first. File is written to a temporary name and renamed, so readers never see a partial file.
+    Returns True if file was written.
+    """
+
+    global _wisdom
+    wisdom = pyfftw.export_wisdom()
+    if wisdom == _wisdom:
+        return False
+
+    if os.path.exists(wisdomfile):
+        with open(wisdomfile, 'rb') as pkl:
+            pyfftw.import_wisdom(pickle.load(pkl))
+        wisdom = pyfftw.export_wisdom()
+
+    tmpfile = '%s.%s.%d' % (wisdomfile, socket.gethostname(), os.getpid())
+    with open(tmpfile, 'wb') as pkl:
+        pickle.dump(wisdom, pkl)
+    os.rename(tmpfile, wisdomfile)
+    _wisdom = wisdom
+    return True
+
+cpdef calc_gridop(n.ndarray[n.float32_t, ndim=2] u, n.ndarray[n.float32_t, ndim=2] v, unsigned int npixx, unsigned int npixy, unsigned int res, c2r=False, float uvmax=0):
+    """ Calculates gridding operator for uv coords with shape (nbl, nchan) as table of (bl, chan) pairs sorted by uv cell.
+    Returns tuple (cells, cellptr, blchan, conj). cells are flat grid indices that have data.
+    blchan[cellptr[c]:cellptr[c+1]] are flat indices (bl*nchan + chan) gridded to cells[c], in same order as looping over bl then chan.
+    If c2r, grid is hermitian half plane (npixx, npixy/2+1) of c2r fft. Each vis goes to its cell and its conjugate to the mirrored cell,
+    keeping those in half plane. conj is 0 for vis, 1 for conjugate of vis not in half plane, and 2 for conjugate of vis also in half plane.
+    If uvmax > 0, only grids vis with uv distance less than uvmax.
+    Only depends on u, v, and grid definition, so it can be made once per segment and shared by all imaging calls.
+    """
+
+    cdef n.ndarray[CTYPE_t, ndim=2] uu = n.round(u/res).astype(n.int)
+    cdef n.ndarray[CTYPE_t, ndim=2] vv = n.round(v/res).astype(n.int)
+
+    ok = n.logical_and(n.abs(uu) < npixx/2, n.abs(vv) < npixy/2)
+    if uvmax > 0:
+        ok = n.logical_and(ok, u**2 + v**2 < uvmax**2)
+    blchan = n.where(ok.flatten())[0]
+    cu = n.mod(uu, npixx).flatten()[blchan]
+    cv = n.mod(vv, npixy).flatten()[blchan]
+    if c2r:
+        mu = n.mod(-uu, npixx).flatten()[blchan]
+        mv = n.mod(-vv, npixy).flatten()[blchan]
+        inhalf = cv <= npixy/2
+        mirror = mv <= npixy/2
+        cell = n.concatenate( (cu[inhalf]*(npixy/2+1) + cv[inhalf], mu[mirror]*(npixy/2+1) + mv[mirror]) )
+        conj = n.concatenate( (n.zeros(inhalf.sum(), dtype=n.uint8), n.where(inhalf[mirror], 2, 1).astype(n.uint8)) )
+        blchan = n.concatenate( (blchan[inhalf], blchan[mirror]) )
+    else:
+        cell = cu*npixy + cv
+        conj = n.zeros(len(blchan), dtype=n.uint8)
+    order = n.argsort(cell, kind='mergesort')    # stable, so order within cell is unchanged
+    blchan = blchan[order]
+    conj = conj[order]
+    cells, cellptr = n.unique(cell[order], return_index=True)
+
+    return (cells.astype(n.int32), n.append(cellptr, len(blchan)).astype(n.int32), blchan.astype(n.int32), conj)
+
+cpdef calc_beamgridop(gridop, float dl, float dm, n.ndarray[n.float32_t, ndim=1] u, n.ndarray[n.float32_t, ndim=1] v, n.ndarray[n.float32_t, ndim=1] freq):
+    """ Returns gridding operator that images beam with phase center shifted by (dl, dm), as from phaseshift.
+    Appends fringe rotation of each (bl, chan) in gridop, conjugated for conjugate vis, so grid_batch rotates vis as it grids them.
+    Cells are shared with gridop, so each beam only adds a complex table the size of blchan.
+    """
+
+    blchan = gridop[2]
+    conj = gridop[3]
+    frot = fringe_rotation(dl, dm, u, v, freq).astype(n.complex64).flatten()[blchan]
+    return gridop[:4] + (n.where(conj > 0, frot.conjugate(), frot),)
+
+cpdef calc_subbandgridop(gridop, unsigned int nchan, unsigned int chan0, unsigned int chan1):
+    """ Returns gridding operator that only grids channels chan0 to chan1-1 of gridop (e.g., from calc_gridop or calc_beamgridop) for data with nchan channels.
+    Cells and order of vis are those of gridop, so grids of all subbands sum to grid of gridop.
+    """
+
+    cells, cellptr, blchan, conj = gridop[:4]
+    chan = blchan % nchan
+    keep = (chan >= chan0) & (chan < chan1)
+    cellind = n.repeat(n.arange(len(cells)), n.diff(cellptr))[keep]
+    cellkeep, ptr = n.unique(cellind, return_index=True)
+    return (cells[cellkeep], n.append(ptr, keep.sum()).astype(n.int32), blchan[keep], conj[keep]) + tuple([g[keep] for g in gridop[4:]])
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef grid_batch(n.ndarray[DTYPE_t, ndim=3, mode='c'] grid, n.ndarray[DTYPE_t, ndim=4, mode='c'] data, gridop, n.ndarray[int, ndim=1] ints):
+    """ Grids ints of data into first len(ints) grids with gridding operator from calc_gridop.
+    This is a sparse product of the (cell, bl*chan*pol) operator with the batch of ints. All grids are zeroed first.
+    Hermitian half grids for c2r fft are twice the full grid's hermitian part.
+    Operator from calc_beamgridop also multiplies each vis by its fringe rotation.
+    """
+
+    cdef n.ndarray[int, ndim=1] cells = gridop[0]
+    cdef n.ndarray[int, ndim=1] cellptr = gridop[1]
+    cdef n.ndarray[int, ndim=1] blchan = gridop[2]
+    cdef n.ndarray[n.uint8_t, ndim=1] conj = gridop[3]
+    cdef n.ndarray[DTYPE_t, ndim=1] frot
+    cdef bint rotate = len(gridop) > 4
+    cdef unsigned int ncell = len(cells)
+    cdef unsigned int k, c, m, p
+    cdef unsigned int nints = len(ints)
+    cdef size_t bc
+    cdef DTYPE_t acc, vis
+    cdef DTYPE_t *datat
+    cdef DTYPE_t *gridt
+    shape = n.shape(data)
+    cdef unsigned int len3 = shape[3]
+    cdef size_t intsize = shape[1]*shape[2]*shape[3]
+    cdef size_t gridsize = grid.shape[1]*grid.shape[2]
+    cdef DTYPE_t *datap = <DTYPE_t*> data.data
+    cdef DTYPE_t *gridp = <DTYPE_t*> grid.data
+
+    grid[:] = 0j
+    if rotate:
+        frot = gridop[4]
+    else:
+        frot = n.zeros(0, dtype=n.complex64)
+
+    with nogil:
+        for k in xrange(nints):
+            datat = datap + ints[k]*intsize
+            gridt = gridp + k*gridsize
+            for c in xrange(ncell):
+                acc = 0
+                for m in xrange(cellptr[c], cellptr[c+1]):
+                    bc = blchan[m]*len3
+                    vis = 0
+                    if conj[m]:
+                        for p in xrange(len3):
+                            vis = vis + datat[bc + p].conjugate()
+                    else:
+                        for p in xrange(len3):
+                            vis = vis + datat[bc + p]
+                    if rotate:
+                        vis = vis*frot[m]
+                    acc = acc + vis
+                gridt[cells[c]] = acc
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef unsigned int count_nonzero(n.ndarray[DTYPE_t, ndim=4, mode='c'] data, gridop, unsigned int t):
+    """ Counts nonzero visibilities of int t that are gridded by gridding operator from calc_gridop.
+    Conjugates of vis also in hermitian half grid are not counted twice.
+    """
+
+    cdef n.ndarray[int, ndim=1] blchan = gridop[2]
+    cdef n.ndarray[n.uint8_t, ndim=1] conj = gridop[3]
+    cdef unsigned int m, p
+    cdef unsigned int nonzeros = 0
+    cdef unsigned int len3 = data.shape[3]
+    cdef DTYPE_t *datat = <DTYPE_t*> data.data + t*data.shape[1]*data.shape[2]*len3
+
+    for m in xrange(len(blchan)):
+        if conj[m] == 2:
+            continue
+        for p in xrange(len3):
+            if datat[blchan[m]*len3 + p] != 0j:
+                nonzeros = nonzeros + 1
+    return nonzeros
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef calc_validfrac(n.ndarray[DTYPE_t, ndim=4, mode='c'] data):
+    """ Returns fraction of nonzero visibilities in each int of data in one pass.
+    Used to skip imaging of ints that are flagged or zeroed at dedispersion edges.
+    """
+
+    cdef unsigned int len0 = data.shape[0]
+    cdef size_t intsize = data.shape[1]*data.shape[2]*data.shape[3]
+    cdef unsigned int t
+    cdef size_t i, nonzeros
+    cdef DTYPE_t *datat
+    cdef DTYPE_t *datap = <DTYPE_t*> data.data
+    cdef n.ndarray[n.float32_t, ndim=1] validfrac = n.zeros(len0, dtype='float32')
+
+    with nogil:
+        for t in xrange(len0):
+            datat = datap + t*intsize
+            nonzeros = 0
+            for i in xrange(intsize):
+                nonzeros = nonzeros + ((datat[i].real != 0) | (datat[i].imag != 0))    # branch free, so loop vectorizes
+            validfrac[t] = <float> nonzeros/intsize
+    return validfrac
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
-cpdef imgallfullfilterxy(n.ndarray[n.float32_t, ndim=2, mode='c'] u, n.ndarray[n.float32_t, ndim=2, mode='c'] v, n.ndarray[DTYPE_t, ndim=4, mode='c'] data, unsigned int npixx, unsigned int npixy, unsigned int res, float thresh):
+@cython.cdivision(True)
+cpdef calc_blpower(n.ndarray[DTYPE_t, ndim=4, mode='c'] data):
+    """ Returns incoherent power of each int of data in one pass.
+    Power is mean over baselines and pols of |sum of vis over channels|**2/(number of nonzero channels), so noise has same mean for any flagging.
+    Transient anywhere in field that is not smeared over band raises power by |amplitude|**2 times mean number of channels.
+    Much cheaper than imaging, so it can be used to rank ints before imaging.
+    """
+
+    cdef unsigned int len0 = data.shape[0]
+    cdef unsigned int len1 = data.shape[1]
+    cdef unsigned int len2 = data.shape[2]
+    cdef unsigned int len3 = data.shape[3]
+    cdef unsigned int t, i, j, k, nchan, nsum
+    cdef float sumre, sumim, power
+    cdef DTYPE_t vis
+    cdef DTYPE_t *datap = <DTYPE_t*> data.data
+    cdef DTYPE_t *datab
+    cdef n.ndarray[n.float32_t, ndim=1] blpower = n.zeros(len0, dtype='float32')
+
+    with nogil:
+        for t in xrange(len0):
+            power = 0
+            nsum = 0
+            for i in xrange(len1):
+                datab = datap + (t*len1 + i)*len2*len3
+                for k in xrange(len3):
+                    sumre = 0; sumim = 0; nchan = 0
+                    for j in xrange(len2):
+                        vis = datab[j*len3 + k]
+                        sumre = sumre + vis.real
+                        sumim = sumim + vis.imag
+                        nchan = nchan + ((vis.real != 0) | (vis.imag != 0))
+                    if nchan:
+                        power = power + (sumre*sumre + sumim*sumim)/nchan
+                        nsum = nsum + 1
+            if nsum:
+                blpower[t] = power/nsum
+    return blpower
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef grid_std(n.ndarray[DTYPE_t, ndim=3, mode='c'] grid, gridop, unsigned int npixx, unsigned int npixy, unsigned int nb, c2r):
+    """ Returns std of images made by fft plan from first nb grids, calculated from grids with Parseval's theorem.
+    Sum of squares of image is from hermitian part of full grid or from half grid weighted by number of its mirrored cells.
+    Only visits cells in gridop, so it is much cheaper than std of image. Must be called before fft, which overwrites grids.
+    """
+
+    cdef n.ndarray[int, ndim=1] cells = gridop[0]
+    cdef unsigned int ncell = len(cells)
+    cdef unsigned int nv = grid.shape[2]
+    cdef size_t gridsize = grid.shape[1]*nv
+    cdef unsigned int b, c, cu, cv
+    cdef double sumsq, mean
+    cdef double npix = npixx*npixy
+    cdef bint half = c2r
+    cdef DTYPE_t g, gm
+    cdef DTYPE_t *gridb
+    cdef DTYPE_t *gridp = <DTYPE_t*> grid.data
+    cdef n.ndarray[n.float64_t, ndim=1] std = n.zeros(nb)
+
+    with nogil:
+        for b in xrange(nb):
+            gridb = gridp + b*gridsize
+            sumsq = 0
+            for c in xrange(ncell):
+                g = gridb[cells[c]]
+                cu = cells[c]/nv
+                cv = cells[c]%nv
+                if half:
+                    # columns that are not their own mirror stand for two cells of full grid
+                    if (cv == 0) or (2*cv == npixy):
+                        sumsq = sumsq + g.real*g.real + g.imag*g.imag
+                    else:
+                        sumsq = sumsq + 2*(g.real*g.real + g.imag*g.imag)
+                else:
+                    # image is real part, so use sum of |(g + conj(g_mirror))/2|**2
+                    gm = gridb[((npixx-cu)%npixx)*nv + (npixy-cv)%npixy]
+                    sumsq = sumsq + (g.real*g.real + g.imag*g.imag + g.real*gm.real - g.imag*gm.imag)/2
+            mean = gridb[0].real/npix
+            std[b] = sumsq/(npix*npix) - mean*mean
+    return n.sqrt(n.clip(std, 0, None))
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void peak_minmax(float *im, size_t npix, size_t stride, float *immax, float *immin) nogil:
+    """ Finds max and min of image with npix pixels separated by stride floats in one pass.
+    """
+
+    cdef size_t i
+    cdef float x
+    immax[0] = im[0]
+    immin[0] = im[0]
+    for i in xrange(1, npix):
+        x = im[i*stride]
+        if x > immax[0]:
+            immax[0] = x
+        elif x < immin[0]:
+            immin[0] = x
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void peak_argminmax(float *im, size_t npix, size_t stride, float *immax, float *immin, size_t *pixmax, size_t *pixmin) nogil:
+    """ Finds max and min of image as peak_minmax and index of first pixel with each in the same pass.
+    """
+
+    cdef size_t i
+    cdef float x
+    immax[0] = im[0]
+    immin[0] = im[0]
+    pixmax[0] = 0
+    pixmin[0] = 0
+    for i in xrange(1, npix):
+        x = im[i*stride]
+        if x > immax[0]:
+            immax[0] = x
+            pixmax[0] = i
+        elif x < immin[0]:
+            immin[0] = x
+            pixmin[0] = i
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef imgallfullfilterxy(n.ndarray[n.float32_t, ndim=2, mode='c'] u, n.ndarray[n.float32_t, ndim=2, mode='c'] v, n.ndarray[DTYPE_t, ndim=4, mode='c'] data, unsigned int npixx, unsigned int npixy, unsigned int res, float thresh, unsigned int fftthreads=1, unsigned int batch=1, gridop=None, c2r=False, ints=None):
     # Same as imgallfull, but returns both pos and neg candidates
     # Defines uvgrid filter before loop
     # flips xy gridding!
+    # images batch ints at a time with cached fft plan (see get_fftplan) using fftthreads threads
+    # gridop from calc_gridop can be given to avoid recalculating it from u, v
+    # c2r images with complex-to-real fft of hermitian half grid. gridop must be made with same c2r.
+    # ints is array of ints to image (e.g., from calc_validfrac). Default is all.
 
     # initial definitions
     shape = n.shape(data)
     cdef unsigned int len0 = shape[0]
-    cdef unsigned int len1 = shape[1]
     cdef unsigned int len2 = shape[2]
-    cdef unsigned int len3 = shape[3]
     cdef unsigned int t
-    cdef unsigned int i
-    cdef unsigned int j
-    cdef unsigned int p
-    cdef unsigned int cellu
-    cdef unsigned int cellv
-    cdef n.ndarray[DTYPE_t, ndim=3] grid = n.zeros((len0,npixx,npixy), dtype='complex64')
-    cdef arr = pyfftw.n_byte_align_empty((npixx,npixy), 32, dtype='complex64')
+    cdef unsigned int b
+    cdef unsigned int k
+    cdef n.ndarray[int, ndim=1] tb
     cdef float snr
+    cdef float immax, immin
+    cdef double std
+    cdef size_t stride = 1 if c2r else 2
+    cdef size_t imsize = npixx*npixy*stride
+    cdef n.ndarray[n.float64_t, ndim=1] stds
+    cdef n.ndarray[n.float32_t, ndim=3, mode='c'] imraw
 
     # put uv data on grid
-    cdef n.ndarray[CTYPE_t, ndim=2] uu = n.round(u/res).astype(n.int)
-    cdef n.ndarray[CTYPE_t, ndim=2] vv = n.round(v/res).astype(n.int)
+    if gridop is None:
+        gridop = calc_gridop(u, v, npixx, npixy, res, c2r)
 
-    ifft = pyfftw.builders.ifft2(arr, overwrite_input=True, auto_align_input=True, auto_contiguous=True)
-    
-    ok = n.logical_and(n.abs(uu) < npixx/2, n.abs(vv) < npixy/2)
-    uu = n.mod(uu, npixx)
-    vv = n.mod(vv, npixy)
+    if ints is None:
+        ints = n.arange(len0, dtype=n.int32)
+    else:
+        ints = n.asarray(ints, dtype=n.int32)
 
-    # add uv data to grid
-    # or use np.add.at(x, i, y)?
-    for i in xrange(len1):
-        for j in xrange(len2):
-            if ok[i,j]:
-                cellu = uu[i,j]
-                cellv = vv[i,j]
-                for t in xrange(len0):
-                    for p in xrange(len3):
-                        grid[t, cellu, cellv] = data[t,i,j,p] + grid[t, cellu, cellv]
+    batch = max(1, min(batch, len0))
+    fftplan = get_fftplan(npixx, npixy, batch, fftthreads, c2r)
 
     # make images and filter based on threshold
     candints = []; candims = []; candsnrs = []
-    for t in xrange(len0):
-        arr[:] = grid[t]
-        im = ifft(arr).real
-
-        # find most extreme pixel
-        snrmax = im.max()/im.std()
-        snrmin = im.min()/im.std()
-        if snrmax >= abs(snrmin):
-            snr = snrmax
-        else:
-            snr = snrmin
-        if ( (abs(snr) > thresh) & n.any(data[t,:,len2/3:,:])):
-            candints.append(t)
-            candsnrs.append(snr)
-            candims.append(recenter(im, (npixx/2,npixy/2)))
+    for b in xrange((len(ints)+batch-1)/batch):
+        tb = ints[b*batch:(b+1)*batch]
+        grid_batch(fftplan.input_array, data, gridop, tb)
+        stds = grid_std(fftplan.input_array, gridop, npixx, npixy, len(tb), c2r)
+        ims = fftplan()
+        imraw = ims.view(n.float32)    # real parts are every stride floats
+
+        for k in xrange(len(tb)):
+            t = tb[k]
+
+            # find most extreme pixel in one pass and skip ints below threshold, which are most of them
+            std = stds[k]
+            if std == 0:
+                continue
+            peak_minmax(<float*> imraw.data + k*imsize, npixx*npixy, stride, &immax, &immin)
+            if max(immax, -immin) <= thresh*std:
+                continue
+
+            snrmax = immax/std
+            snrmin = immin/std
+            if snrmax >= abs(snrmin):
+                snr = snrmax
+            else:
+                snr = snrmin
+            if ( (abs(snr) > thresh) & n.any(data[t,:,len2/3:,:])):
+                im = ims[k].real
+                if c2r:
+                    im = im/2
+                candints.append(t)
+                candsnrs.append(snr)
+                candims.append(recenter(im, (npixx/2,npixy/2)))
 
 #    print 'Detected %d candidates with at least third the band.' % len(candints)
 #    print 'Pixel sizes (%.1f\", %.1f\"), Field size %.1f\"' % (3600*n.degrees(2./(npixx*res)), 3600*n.degrees(2./(npixy*res)), 3600*n.degrees(1./res))
@@ -196,79 +533,416 @@ cpdef imgallfullfilterxy(n.ndarray[n.float32_t, ndim=2, mode='c'] u, n.ndarray[n
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-cpdef imgallfullfilterxyflux(n.ndarray[n.float32_t, ndim=2, mode='c'] u, n.ndarray[n.float32_t, ndim=2, mode='c'] v, n.ndarray[DTYPE_t, ndim=4, mode='c'] data, unsigned int npixx, unsigned int npixy, unsigned int res, float thresh):
+cpdef imgallfullfilterxyflux(n.ndarray[n.float32_t, ndim=2, mode='c'] u, n.ndarray[n.float32_t, ndim=2, mode='c'] v, n.ndarray[DTYPE_t, ndim=4, mode='c'] data, unsigned int npixx, unsigned int npixy, unsigned int res, float thresh, unsigned int fftthreads=1, unsigned int batch=1, gridop=None, c2r=False, ints=None):
     # Same as imgallfull, but returns only candidates and rolls images
     # Defines uvgrid filter before loop
     # flips xy gridding!
     # counts nonzero data and properly normalizes fft to be on flux scale
+    # images batch ints at a time with cached fft plan (see get_fftplan) using fftthreads threads
+    # gridop from calc_gridop can be given to avoid recalculating it from u, v
+    # c2r images with complex-to-real fft of hermitian half grid. gridop must be made with same c2r.
+    # ints is array of ints to image (e.g., from calc_validfrac). Default is all.
+    # keeps full image of each candidate. imgallfullfilterxypeak returns compact records instead.
+
+    recs, candims = imgallfullfilterxypeak(u, v, data, npixx, npixy, res, thresh, fftthreads, batch, gridop, c2r, ints, keepims=True)
+    return candims, [float(snr) for snr in recs['snr']], [int(t) for t in recs['int']]
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void image_moments(float *im, size_t npix, size_t stride, float *skew, float *kurtosis) nogil:
+    """ Calculates skew and kurtosis of image with npix pixels separated by stride floats, as from scipy.stats with bias and fisher kurtosis.
+    """
+
+    cdef size_t i
+    cdef double x, x2
+    cdef double mean = 0, m2 = 0, m3 = 0, m4 = 0
+    for i in xrange(npix):
+        mean = mean + im[i*stride]
+    mean = mean/npix
+    for i in xrange(npix):
+        x = im[i*stride] - mean
+        x2 = x*x
+        m2 = m2 + x2
+        m3 = m3 + x2*x
+        m4 = m4 + x2*x2
+    m2 = m2/npix; m3 = m3/npix; m4 = m4/npix
+    if m2 > 0:
+        skew[0] = m3/(m2*m2**0.5)
+        kurtosis[0] = m4/(m2*m2) - 3
+    else:
+        skew[0] = 0
+        kurtosis[0] = -3
+
+cdef list peak_fields(unsigned int cutout, moments):
+    """ Returns fields of candidate records made by peak_record.
+    """
+
+    fields = [('int', n.int32), ('snr', n.float32), ('immax', n.float32), ('peakx', n.int32), ('peaky', n.int32)]
+    if moments:
+        fields += [('skew', n.float32), ('kurtosis', n.float32)]
+    if cutout:
+        fields += [('cutout', n.float32, (cutout, cutout))]
+    return fields
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef size_t peak_pixel(float *im, size_t npix, size_t stride, float peak) nogil:
+    """ Returns index of first pixel of image with value peak (e.g., from peak_minmax).
+    """
+
+    cdef size_t p
+    for p in xrange(npix):
+        if im[p*stride] == peak:
+            return p
+    return 0
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef tuple peak_record(float *im, size_t stride, unsigned int npixx, unsigned int npixy, size_t peakpix, unsigned int t, float snr, float peak, float scale, unsigned int cutout, moments):
+    """ Returns candidate record with fields from peak_fields for unrolled image with pixels separated by stride floats and extreme pixel peakpix.
+    Pixel is given as in image rolled to put phase center at (npixx/2, npixy/2). scale converts image to flux.
+    """
+
+    cdef unsigned int i, j
+    cdef size_t p
+    cdef float skew = 0, kurtosis = 0
+    cdef n.ndarray[n.float32_t, ndim=2, mode='c'] cut
+
+    rec = [t, snr, peak*scale, (peakpix/npixy + npixx - npixx/2) % npixx, (peakpix%npixy + npixy - npixy/2) % npixy]
+    if moments:
+        image_moments(im, npixx*npixy, stride, &skew, &kurtosis)
+        rec += [skew, kurtosis]
+    if cutout:
+        cut = n.zeros((cutout, cutout), dtype=n.float32)
+        for i in xrange(cutout):
+            for j in xrange(cutout):
+                p = ((peakpix/npixy + npixx + i - cutout/2) % npixx)*npixy + (peakpix%npixy + npixy + j - cutout/2) % npixy
+                cut[i, j] = im[p*stride]*scale
+        rec += [cut]
+    return tuple(rec)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef imgallfullfilterxypeak(n.ndarray[n.float32_t, ndim=2, mode='c'] u, n.ndarray[n.float32_t, ndim=2, mode='c'] v, n.ndarray[DTYPE_t, ndim=4, mode='c'] data, unsigned int npixx, unsigned int npixy, unsigned int res, float thresh, unsigned int fftthreads=1, unsigned int batch=1, gridop=None, c2r=False, ints=None, unsigned int cutout=0, moments=False, keepims=False, peaks=None):
+    """ Images ints of data as in imgallfullfilterxyflux, but returns (recs, ims) with one fixed-size record per candidate.
+    recs is record array with fields int, snr, immax (flux of most extreme pixel) and peakx, peaky (its pixel in image rolled to put phase center at (npixx/2, npixy/2), as for calc_lm).
+    If moments, records have skew and kurtosis of image (as from scipy.stats). If cutout > 0, records have cutout (cutout, cutout) flux image centered on extreme pixel, wrapped at edges.
+    ims has full rolled flux images only if keepims, so memory per candidate does not depend on image size.
+    peaks is optional record array with fields snr, peakx, peaky and length of data. snr and pixel of most extreme pixel of every imaged int are written to it, whatever the threshold.
+    """
 
     # initial definitions
     shape = n.shape(data)
     cdef unsigned int len0 = shape[0]
-    cdef unsigned int len1 = shape[1]
     cdef unsigned int len2 = shape[2]
-    cdef unsigned int len3 = shape[3]
     cdef unsigned int t
-    cdef unsigned int i
-    cdef unsigned int j
-    cdef unsigned int p
-    cdef unsigned int cellu
-    cdef unsigned int cellv
+    cdef unsigned int b
+    cdef unsigned int k
+    cdef n.ndarray[int, ndim=1] tb
     cdef unsigned int nonzeros = 0
-    cdef n.ndarray[DTYPE_t, ndim=3] grid = n.zeros((len0,npixx,npixy), dtype='complex64')
-    cdef arr = pyfftw.n_byte_align_empty((npixx,npixy), 16, dtype='complex64')
     cdef float snr
+    cdef float norm = npixx*npixy
+    cdef float immax, immin, peak
+    cdef double std
+    cdef size_t peakpix, pixmax = 0, pixmin = 0
+    cdef size_t stride = 1 if c2r else 2
+    cdef size_t imsize = npixx*npixy*stride
+    cdef float *imk
+    cdef n.ndarray[n.float64_t, ndim=1] stds
+    cdef n.ndarray[n.float32_t, ndim=3, mode='c'] imraw
+
+    assert cutout <= min(npixx, npixy), 'cutout must be smaller than image'
 
     # put uv data on grid
-    cdef n.ndarray[CTYPE_t, ndim=2] uu = n.round(u/res).astype(n.int)
-    cdef n.ndarray[CTYPE_t, ndim=2] vv = n.round(v/res).astype(n.int)
+    if gridop is None:
+        gridop = calc_gridop(u, v, npixx, npixy, res, c2r)
+    if c2r:
+        norm = norm/2.
 
-    ifft = pyfftw.builders.ifft2(arr, overwrite_input=True, auto_align_input=True, auto_contiguous=True)
-    
-    ok = n.logical_and(n.abs(uu) < npixx/2, n.abs(vv) < npixy/2)
-    uu = n.mod(uu, npixx)
-    vv = n.mod(vv, npixy)
+    if ints is None:
+        ints = n.arange(len0, dtype=n.int32)
+    else:
+        ints = n.asarray(ints, dtype=n.int32)
 
-    # add uv data to grid
-    # or use np.add.at(x, i, y)?
-    for i in xrange(len1):
-        for j in xrange(len2):
-            if ok[i,j]:
-                cellu = uu[i,j]
-                cellv = vv[i,j]
-                for t in xrange(len0):
-                    for p in xrange(len3):
-                        grid[t, cellu, cellv] = data[t,i,j,p] + grid[t, cellu, cellv]
+    batch = max(1, min(batch, len0))
+    fftplan = get_fftplan(npixx, npixy, batch, fftthreads, c2r)
 
     # make images and filter based on threshold
-    candints = []; candims = []; candsnrs = []
-    for t in xrange(len0):
-        arr[:] = grid[t]
-        im = ifft(arr).real*int(npixx*npixy)
-
-        # find most extreme pixel
-        snrmax = im.max()/im.std()
-        snrmin = im.min()/im.std()
-        if snrmax >= abs(snrmin):
-            snr = snrmax
+    recs = []; candims = []
+    for b in xrange((len(ints)+batch-1)/batch):
+        tb = ints[b*batch:(b+1)*batch]
+        grid_batch(fftplan.input_array, data, gridop, tb)
+        stds = grid_std(fftplan.input_array, gridop, npixx, npixy, len(tb), c2r)
+        ims = fftplan()
+        imraw = ims.view(n.float32)    # real parts are every stride floats
+
+        for k in xrange(len(tb)):
+            t = tb[k]
+
+            # find most extreme pixel in one pass and skip ints below threshold, which are most of them
+            std = stds[k]
+            if std == 0:
+                continue
+            imk = <float*> imraw.data + k*imsize
+            if peaks is None:
+                peak_minmax(imk, npixx*npixy, stride, &immax, &immin)
+                if max(immax, -immin) <= thresh*std:
+                    continue
+            else:
+                # same pass finds pixels of extremes, so peak of every int is saved without a second pass over image
+                peak_argminmax(imk, npixx*npixy, stride, &immax, &immin, &pixmax, &pixmin)
+
+            snrmax = immax/std
+            snrmin = immin/std
+            if snrmax >= abs(snrmin):
+                snr = snrmax
+                peak = immax
+                peakpix = pixmax
+            else:
+                snr = snrmin
+                peak = immin
+                peakpix = pixmin
+
+            if peaks is None:
+                peakpix = peak_pixel(imk, npixx*npixy, stride, peak)
+            else:
+                peaks[t] = (snr, (peakpix/npixy + npixx - npixx/2) % npixx, (peakpix%npixy + npixy - npixy/2) % npixy)
+                if max(immax, -immin) <= thresh*std:
+                    continue
+
+            if ( (abs(snr) > thresh) & n.any(data[t,:,len2/3:,:])):
+                # calculate number of nonzero vis to normalize fft
+                nonzeros = count_nonzero(data, gridop, t)
+                recs.append(peak_record(imk, stride, npixx, npixy, peakpix, t, snr, peak, norm/nonzeros, cutout, moments))
+
+                if keepims:
+                    candims.append(recenter(ims[k].real*norm/float(nonzeros), (npixx/2,npixy/2)))
+
+    return n.array(recs, dtype=peak_fields(cutout, moments)), candims
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void add_image(float *dst, float *src, size_t npix, size_t stride) nogil:
+    """ Adds image with npix pixels separated by stride floats to contiguous image dst.
+    """
+
+    cdef size_t i
+    for i in xrange(npix):
+        dst[i] = dst[i] + src[i*stride]
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef double image_std(float *im, size_t npix) nogil:
+    """ Returns std of contiguous image with npix pixels.
+    """
+
+    cdef size_t i
+    cdef double x, sum = 0, sumsq = 0
+    for i in xrange(npix):
+        x = im[i]
+        sum = sum + x
+        sumsq = sumsq + x*x
+    x = sumsq/npix - (sum/npix)*(sum/npix)
+    return x**0.5 if x > 0 else 0
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef imgallfullfilterxydt(n.ndarray[n.float32_t, ndim=2, mode='c'] u, n.ndarray[n.float32_t, ndim=2, mode='c'] v, n.ndarray[DTYPE_t, ndim=4, mode='c'] data, unsigned int npixx, unsigned int npixy, unsigned int res, float thresh, dtarr, unsigned int fftthreads=1, unsigned int batch=1, gridop=None, c2r=False, ints=None, unsigned int cutout=0, moments=False):
+    """ Images ints of data (dedispersed, but not resampled) once and makes images of each dt in dtarr by summing images, since imaging is linear.
+    dtarr must start with 1 and each dt must be a multiple of the last. Image of each dt is summed from images of previous dt as they are made, so only one image per dt is kept.
+    Image of int i at dt is mean of images of ints i*dt to (i+1)*dt-1, as for dedisperse_resample. Ints not in ints (e.g., from calc_validfrac) are taken to be zero.
+    Noise of summed images is their std. Flux scale uses most nonzero vis of any summed int.
+    Returns list with recs for each dt, as from imgallfullfilterxypeak with int in units of dt.
+    """
+
+    # initial definitions
+    shape = n.shape(data)
+    cdef unsigned int len0 = shape[0]
+    cdef unsigned int len2 = shape[2]
+    cdef unsigned int ndt = len(dtarr)
+    cdef unsigned int t, tnext, b, k, l
+    cdef n.ndarray[int, ndim=1] tb
+    cdef float snr, scale
+    cdef float norm = npixx*npixy
+    cdef float immax, immin, peak
+    cdef double std
+    cdef size_t npix = npixx*npixy
+    cdef size_t stride = 1 if c2r else 2
+    cdef size_t imsize = npix*stride
+    cdef float *imk
+    cdef float *accl
+    cdef n.ndarray[n.float64_t, ndim=1] stds
+    cdef n.ndarray[n.float32_t, ndim=3, mode='c'] imraw
+    cdef n.ndarray[n.float32_t, ndim=2, mode='c'] accs = n.zeros((ndt, npix), dtype=n.float32)   # running sum for each dt > 1
+    cdef n.ndarray[int, ndim=1] factor = n.ones(ndt, dtype=n.int32)
+    cdef n.ndarray[int, ndim=1] count = n.zeros(ndt, dtype=n.int32)
+    cdef n.ndarray[int, ndim=1] nonzeros = n.zeros(ndt, dtype=n.int32)
+    cdef n.ndarray[n.uint8_t, ndim=1] upper = n.zeros(ndt, dtype=n.uint8)
+
+    assert dtarr[0] == 1, 'dtarr must start with 1'
+    for l in xrange(1, ndt):
+        assert dtarr[l] % dtarr[l-1] == 0, 'each dt must be a multiple of the last'
+        factor[l] = dtarr[l]/dtarr[l-1]
+
+    if gridop is None:
+        gridop = calc_gridop(u, v, npixx, npixy, res, c2r)
+    if c2r:
+        norm = norm/2.
+
+    if ints is None:
+        ints = n.arange(len0, dtype=n.int32)
+    else:
+        ints = n.unique(n.asarray(ints, dtype=n.int32))    # sums need ints in order
+
+    batch = max(1, min(batch, len0))
+    fftplan = get_fftplan(npixx, npixy, batch, fftthreads, c2r)
+
+    recs = [[] for l in xrange(ndt)]
+    tnext = 0
+    for b in xrange((len(ints)+batch-1)/batch + 1):
+        # last pass has no images and only completes sums to end of data
+        if b*batch < len(ints):
+            tb = ints[b*batch:(b+1)*batch]
+            grid_batch(fftplan.input_array, data, gridop, tb)
+            stds = grid_std(fftplan.input_array, gridop, npixx, npixy, len(tb), c2r)
+            ims = fftplan()
+            imraw = ims.view(n.float32)
         else:
-            snr = snrmin
-        if ( (abs(snr) > thresh) & n.any(data[t,:,len2/3:,:])):
+            tb = n.zeros(0, dtype=n.int32)
+
+        for k in xrange(max(len(tb), 1)):
+            # ints up to next image (or end) are zero, and image k is int t
+            t = tb[k] if len(tb) else len0
+            while tnext <= t and tnext < len0:
+                nonzeros[0] = 0; upper[0] = 0
+                if (tnext == t) and (stds[k] > 0):
+                    imk = <float*> imraw.data + k*imsize
+                    std = stds[k]
+                    nonzeros[0] = count_nonzero(data, gridop, t)
+                    upper[0] = n.any(data[t,:,len2/3:,:])
+                    peak_minmax(imk, npix, stride, &immax, &immin)
+                    if (max(immax, -immin) > thresh*std) and upper[0]:
+                        snr, peak = (immax/std, immax) if immax >= -immin else (immin/std, immin)
+                        recs[0].append(peak_record(imk, stride, npixx, npixy, peak_pixel(imk, npix, stride, peak), t, snr, peak, norm/nonzeros[0], cutout, moments))
+
+                # add int to running sum of next dt. completed sums are thresholded and added to sum of next dt.
+                for l in xrange(1, ndt):
+                    accl = <float*> accs.data + l*npix
+                    if (l == 1) and nonzeros[0]:
+                        add_image(accl, imk, npix, stride)
+                        nonzeros[1] = max(nonzeros[1], nonzeros[0])
+                        upper[1] = upper[1] | upper[0]
+                    count[l] += 1
+                    if count[l] < factor[l]:
+                        break
+
+                    if nonzeros[l]:
+                        std = image_std(accl, npix)
+                        peak_minmax(accl, npix, 1, &immax, &immin)
+                        if (std > 0) and (max(immax, -immin) > thresh*std) and upper[l]:
+                            snr, peak = (immax/std, immax) if immax >= -immin else (immin/std, immin)
+                            recs[l].append(peak_record(accl, 1, npixx, npixy, peak_pixel(accl, npix, 1, peak), tnext/dtarr[l], snr, peak, norm/(nonzeros[l]*dtarr[l]), cutout, moments))
+                        if l+1 < ndt:
+                            add_image(accl + npix, accl, npix, 1)
+                            nonzeros[l+1] = max(nonzeros[l+1], nonzeros[l])
+                            upper[l+1] = upper[l+1] | upper[l]
+                    memset(accl, 0, npix*sizeof(float))
+                    count[l] = 0; nonzeros[l] = 0; upper[l] = 0
+                tnext += 1
+
+    return [n.array(recs[l], dtype=peak_fields(cutout, moments)) for l in xrange(ndt)]
 
-            # calculate number of nonzero vis to normalize fft
-            nonzeros = 0
-            for i in xrange(len1):
-                for j in xrange(len2):
-                    if ok[i,j]:
-                        for p in xrange(len3):
-                            if data[t,i,j,p] != 0j:
-                                nonzeros = nonzeros + 1
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef imgallraw(n.ndarray[DTYPE_t, ndim=4, mode='c'] data, unsigned int npixx, unsigned int npixy, gridop, c2r, n.ndarray[n.float32_t, ndim=2, mode='c'] ims, unsigned int fftthreads=1, unsigned int batch=1):
+    """ Images every int of data with gridding operator from calc_gridop (or calc_subbandgridop) into ims with shape (len(data), npixx*npixy).
+    Images are unnormalized and not rolled, so images of parts of data (e.g., subbands) can be summed. Ints with no gridded vis are zero.
+    Returns number of nonzero gridded vis of each int, as used to normalize fft.
+    """
 
-            candints.append(t)
-            candsnrs.append(snr)
-            candims.append(recenter(im/float(nonzeros), (npixx/2,npixy/2)))
+    cdef unsigned int len0 = data.shape[0]
+    cdef unsigned int b, k, t
+    cdef size_t npix = npixx*npixy
+    cdef size_t stride = 1 if c2r else 2
+    cdef n.ndarray[int, ndim=1] tb
+    cdef n.ndarray[int, ndim=1] nonzeros = n.zeros(len0, dtype=n.int32)
+    cdef n.ndarray[n.float32_t, ndim=3, mode='c'] imraw
+    cdef float *imk
+    cdef float *dst
 
-    return candims,candsnrs,candints
+    assert ims.shape[0] == len0 and ims.shape[1] == npix, 'ims must have shape (len(data), npixx*npixy)'
+
+    for t in xrange(len0):
+        nonzeros[t] = count_nonzero(data, gridop, t)
+    ints = n.where(nonzeros > 0)[0].astype(n.int32)
+    ims[nonzeros == 0] = 0
+
+    batch = max(1, min(batch, len0))
+    fftplan = get_fftplan(npixx, npixy, batch, fftthreads, c2r)
+    for b in xrange((len(ints)+batch-1)/batch):
+        tb = ints[b*batch:(b+1)*batch]
+        grid_batch(fftplan.input_array, data, gridop, tb)
+        imraw = fftplan().view(n.float32)
+        for k in xrange(len(tb)):
+            imk = <float*> imraw.data + k*npix*stride
+            dst = <float*> ims.data + tb[k]*npix
+            memset(dst, 0, npix*sizeof(float))
+            add_image(dst, imk, npix, stride)
+    return nonzeros
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef imgsubbandsum(n.ndarray[n.float32_t, ndim=3, mode='c'] cube, n.ndarray[int, ndim=2, mode='c'] nonzeros, n.ndarray[n.uint8_t, ndim=2, mode='c'] upper, n.ndarray[short, ndim=1] subdelay, unsigned int resample, int offset, unsigned int i0, unsigned int i1, float thresh, unsigned int npixx, unsigned int npixy, c2r=False, unsigned int cutout=0, moments=False):
+    """ Dedisperses and resamples in image plane by shifting and summing images of subbands in cube.
+    cube has shape (nsubband, nints, npixx*npixy) with unrolled images of each int from imgallraw. nonzeros and upper have shape (nsubband, nints) with nonzero vis and whether subband has data in upper third of band.
+    Image of resampled int i is sum over subbands s and r < resample of cube[s, i*resample + r + subdelay[s] - offset], where offset is int of cube[:,0]. Ints beyond cube are zero.
+    Images ints i0 to i1-1 and returns recs as from imgallfullfilterxypeak. Noise is std of summed image. Flux scale uses most nonzero vis of any summed int.
+    """
+
+    cdef unsigned int nsub = cube.shape[0]
+    cdef int ncube = cube.shape[1]
+    cdef size_t npix = npixx*npixy
+    cdef unsigned int i, r, s
+    cdef int j
+    cdef int nz, nzmax
+    cdef bint up
+    cdef float snr, peak, immax, immin
+    cdef float norm = npixx*npixy
+    cdef double std
+    cdef n.ndarray[n.float32_t, ndim=1, mode='c'] acc = n.zeros(npix, dtype=n.float32)
+    cdef float *accp = <float*> acc.data
+
+    if c2r:
+        norm = norm/2.
+
+    recs = []
+    for i in xrange(i0, i1):
+        memset(accp, 0, npix*sizeof(float))
+        nzmax = 0; up = 0
+        for r in xrange(resample):
+            nz = 0
+            for s in xrange(nsub):
+                j = i*resample + r + subdelay[s] - offset
+                if (j >= 0) and (j < ncube) and nonzeros[s, j]:
+                    add_image(accp, <float*> cube.data + (s*ncube + j)*npix, npix, 1)
+                    nz = nz + nonzeros[s, j]
+                    up = up | upper[s, j]
+            nzmax = max(nzmax, nz)
+        if not (nzmax and up):
+            continue
+
+        std = image_std(accp, npix)
+        if std == 0:
+            continue
+        peak_minmax(accp, npix, 1, &immax, &immin)
+        if max(immax, -immin) > thresh*std:
+            snr, peak = (immax/std, immax) if immax >= -immin else (immin/std, immin)
+            recs.append(peak_record(accp, 1, npixx, npixy, peak_pixel(accp, npix, 1, peak), i, snr, peak, norm/(nzmax*resample), cutout, moments))
+
+    return n.array(recs, dtype=peak_fields(cutout, moments))
 
 cpdef imgonefullw(n.ndarray[n.float32_t, ndim=2] u, n.ndarray[n.float32_t, ndim=2] v, n.ndarray[DTYPE_t, ndim=3] data, unsigned int npix, unsigned int uvres, blsets, kers, verbose=1):
     # Same as imgallfullxy, but includes w term
@@ -461,46 +1135,94 @@ def sigma_clip(n.ndarray[n.float32_t, ndim=1] arr, float sigma=3):
 
 cpdef make_triples(d):
     """ Calculates and returns data indexes (i,j,k) for all closed triples.
+    Triple of ants (a1, a2, a3) has baselines (a1,a2), (a2,a3), and (a1,a3), so bispectrum is v_i * v_j * conj(v_k).
+    Only triples with all three baselines in data are returned.
     """
 
-    ants = d['ants']
-    nants = d['nants']
+    ants = list(d['ants'])
     blarr = calc_blarr(d)
+    blind = dict([((blarr[i,0], blarr[i,1]), i) for i in xrange(len(blarr))])
+
+    # make triples indexes in antenna numbering, then look up data indexes
+    triples = []
+    for i in xrange(len(ants)):
+        for j in xrange(i+1, len(ants)):
+            if not blind.has_key((ants[i], ants[j])):
+                continue
+            for k in xrange(j+1, len(ants)):
+                if blind.has_key((ants[j], ants[k])) and blind.has_key((ants[i], ants[k])):
+                    triples.append( (blind[(ants[i], ants[j])], blind[(ants[j], ants[k])], blind[(ants[i], ants[k])]) )
+
+    return n.array(triples, dtype='int').reshape(len(triples), 3)
+
+cpdef calc_bispectra(n.ndarray[DTYPE_t, ndim=2] datamean, n.ndarray[n.int_t, ndim=2] triples):
+    """ Returns mean real part of bispectrum and number of triples with data for each int.
+    datamean has shape (nints, nbl), usually averaged over channels and pols. Triples from make_triples index the baselines for all ints at once.
+    """
 
-    cdef int t
-    cdef int ant1
-    cdef int ant2
-    cdef int ant3
-    cdef n.ndarray[n.int_t, ndim=2] triples = n.zeros((nants*(nants-1)*(nants-2)/6, 3), dtype='int')
-
-    # first make triples indexes in antenna numbering
-    anttrips = []
-    for i in ants:
-        for j in ants[list(ants).index(i)+1:]:
-            for k in ants[list(ants).index(j)+1:]:
-                anttrips.append([i,j,k])
-                
-    # next return data indexes for triples
-    for t in xrange(len(anttrips)):
-        ant1 = anttrips[t][0]
-        ant2 = anttrips[t][1]
-        ant3 = anttrips[t][2]
-        try:
-            bl1 = n.where( (blarr[:,0] == ant1) & (blarr[:,1] == ant2) )[0][0]
-            bl2 = n.where( (blarr[:,0] == ant2) & (blarr[:,1] == ant3) )[0][0]
-            bl3 = n.where( (blarr[:,0] == ant1) & (blarr[:,1] == ant3) )[0][0]
-            triples[t,0] = bl1
-            triples[t,1] = bl2
-            triples[t,2] = bl3
-        except IndexError:
-            continue
-
-    return triples
+    ba = datamean[:, triples[:,0]] * datamean[:, triples[:,1]] * n.conj(datamean[:, triples[:,2]])
+    ntr = (ba != 0j).sum(axis=1)
+    bamean = ba.real.sum(axis=1)/n.maximum(ntr, 1)
+    return bamean, ntr
 
 @cython.profile(False)
 cdef n.ndarray[DTYPE_t, ndim=2] fringe_rotation(float dl, float dm, n.ndarray[n.float32_t, ndim=1] u, n.ndarray[n.float32_t, ndim=1] v, n.ndarray[n.float32_t, ndim=1] freq): 
     return n.exp(-2j*3.1415*(dl*n.outer(u,freq) + dm*n.outer(v,freq)))
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef calc_spectra(n.ndarray[DTYPE_t, ndim=4, mode='c'] data, n.ndarray[int, ndim=2] windows, n.ndarray[n.float32_t, ndim=2] dlm, n.ndarray[n.float32_t, ndim=1] u, n.ndarray[n.float32_t, ndim=1] v, n.ndarray[n.float32_t, ndim=1] freq):
+    """ Returns spectra of data phased to many locations, as direct dft of each channel, without changing data.
+    windows has (first int, last int + 1) of data for each location and dlm has its (dl, dm) from phase center, as in phaseshift.
+    Returns (spec, nvalid) with shape (len(windows), longest window, nchan, npol).
+    spec is sum over baselines of phased vis and nvalid is number of nonzero vis in sum, so mean over baselines with or without flagged data can be made.
+    Fringe rotation of each (bl, chan) is made once per location and used for all ints and pols of its window.
+    """
+
+    cdef unsigned int nloc = len(windows)
+    cdef unsigned int len1 = data.shape[1]
+    cdef unsigned int len2 = data.shape[2]
+    cdef unsigned int len3 = data.shape[3]
+    cdef unsigned int nwin = max([0] + [w1 - w0 for (w0, w1) in windows])
+    cdef unsigned int k, t, i, j, p
+    cdef size_t ind, specind, m
+    cdef float phase, blphase
+    cdef float rotre, rotim, visre, visim
+    cdef float *datap = <float*> data.data    # complex as (re, im) pairs, so products need no complex arithmetic
+    cdef n.ndarray[DTYPE_t, ndim=4, mode='c'] spec = n.zeros((nloc, nwin, len2, len3), dtype=n.complex64)
+    cdef n.ndarray[n.int32_t, ndim=4, mode='c'] nvalid = n.zeros((nloc, nwin, len2, len3), dtype=n.int32)
+    cdef float *specp = <float*> spec.data
+    cdef n.int32_t *nvalidp = <n.int32_t*> nvalid.data
+    cdef n.ndarray[n.float32_t, ndim=1, mode='c'] frot = n.zeros(2*len1*len2, dtype=n.float32)
+
+    assert (windows[:,0] >= 0).all() and (windows[:,1] <= data.shape[0]).all(), 'windows must be within data'
+
+    with nogil:
+        for k in xrange(nloc):
+            for i in xrange(len1):
+                blphase = -2*3.1415*(dlm[k,0]*u[i] + dlm[k,1]*v[i])
+                for j in xrange(len2):
+                    phase = blphase*freq[j]
+                    frot[2*(i*len2 + j)] = cosf(phase)
+                    frot[2*(i*len2 + j) + 1] = sinf(phase)
+
+            # sweep window in memory order
+            for t in xrange(windows[k,0], windows[k,1]):
+                specind = (k*nwin + t - windows[k,0])*len2*len3
+                for i in xrange(len1):
+                    ind = (t*len1 + i)*len2*len3
+                    for j in xrange(len2):
+                        rotre = frot[2*(i*len2 + j)]
+                        rotim = frot[2*(i*len2 + j) + 1]
+                        for p in xrange(len3):
+                            m = j*len3 + p
+                            visre = datap[2*(ind + m)]
+                            visim = datap[2*(ind + m) + 1]
+                            specp[2*(specind + m)] += visre*rotre - visim*rotim
+                            specp[2*(specind + m) + 1] += visre*rotim + visim*rotre
+                            nvalidp[specind + m] += (visre != 0) | (visim != 0)
+    return spec, nvalid
+
 @cython.wraparound(False)
 @cython.boundscheck(False)
 cpdef phaseshift(n.ndarray[DTYPE_t, ndim=4, mode='c'] data, d, float l1, float m1, n.ndarray[n.float32_t, ndim=2] u, n.ndarray[n.float32_t, ndim=2] v, verbose=0):
@@ -572,6 +1294,42 @@ cpdef phaseshift_threaded(n.ndarray[DTYPE_t, ndim=4, mode='c'] data, d, float l1
         if verbose:
             print 'No phase rotation needed'
 
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cpdef phaseshift_t(n.ndarray[DTYPE_t, ndim=4, mode='c'] datat, d, float l1, float m1, n.ndarray[n.float32_t, ndim=1, mode='c'] u, n.ndarray[n.float32_t, ndim=1, mode='c'] v, verbose=0):
+    """ Shift phase center to (l1, m1) for time-contiguous data with shape (nbl, npol, nchan, nints).
+    Same as phaseshift_threaded, but rotation is constant along contiguous time axis.
+    """
+
+    cdef n.ndarray[DTYPE_t, ndim=2] frot
+    cdef n.ndarray[float, ndim=1] freq = d['freq_orig'][d['chans']]
+    cdef n.ndarray[float, ndim=1] freq_orig = d['freq_orig']
+    cdef float dl = l1 - d['l0']
+    cdef float dm = m1 - d['m0']
+    cdef unsigned int i
+    cdef unsigned int j
+    cdef unsigned int k
+    cdef unsigned int l
+    cdef DTYPE_t rot
+
+    shape = n.shape(datat)
+    cdef unsigned int len0 = shape[0]
+    cdef unsigned int len1 = shape[1]
+    cdef unsigned int len2 = shape[2]
+    cdef unsigned int len3 = shape[3]
+
+    if (dl != 0.) or (dm != 0.):
+        frot = fringe_rotation(dl, dm, u, v, freq/freq_orig[0])
+        for j in xrange(len0):
+            for l in xrange(len1):
+                for k in xrange(len2):
+                    rot = frot[j,k]
+                    for i in xrange(len3):
+                        datat[j,l,k,i] = datat[j,l,k,i] * rot
+    else:
+        if verbose:
+            print 'No phase rotation needed'
+
 def calc_blarr(d):
     """ Helper function to make blarr a function instead of big list in d.
     ms and sdm format data have different bl orders.
@@ -755,6 +1513,509 @@ cpdef dedisperse_resample2(n.ndarray[DTYPE_t, ndim=4, mode='c'] data, n.ndarray[
     if verbose != 0:
         print 'Dedispersed for DM=%d' % dm
 
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cpdef dedisperse_resample_blocks(n.ndarray[DTYPE_t, ndim=4, mode='c'] data, n.ndarray[DTYPE_t, ndim=4, mode='c'] data_resamp, n.ndarray[float, ndim=1] freq, float inttime, float dm, unsigned int resample, blr):
+    """ dedisperse and resample data into data_resamp (can be same array as data).
+    adjacent channels with same delay are moved together as one contiguous block per int and baseline.
+    GIL is released, so baseline ranges (blr) can be run in parallel with threads.
+    same result as dedisperse_resample for first len(data)/resample ints (or len(data_resamp), if smaller).
+    """
+
+    cdef unsigned int i, j, g, r, m
+    cdef unsigned int iprime
+    cdef int shift
+    shape = n.shape(data)
+    cdef unsigned int len0 = shape[0]
+    cdef unsigned int len1 = shape[1]
+    cdef unsigned int len2 = shape[2]
+    cdef unsigned int len3 = shape[3]
+    cdef unsigned int bl0 = blr[0]
+    cdef unsigned int bl1 = blr[1]
+    cdef unsigned int newlen0 = min(len0/resample, data_resamp.shape[0])
+    cdef n.ndarray[short, ndim=1] relativedelay = calc_delay(freq, inttime, dm)
+
+    # groups of adjacent channels with same delay. blocks given in floats.
+    edges = n.concatenate( ([0], n.where(n.diff(relativedelay))[0]+1, [len2]) )
+    cdef unsigned int ngroup = len(edges)-1
+    cdef n.ndarray[int, ndim=1] groupoffset = (2*len3*edges[:ngroup]).astype(n.int32)
+    cdef n.ndarray[int, ndim=1] groupsize = (2*len3*n.diff(edges)).astype(n.int32)
+    cdef n.ndarray[int, ndim=1] groupshift = relativedelay[edges[:ngroup]].astype(n.int32)
+    cdef n.ndarray[int, ndim=1] nvalid = n.zeros(ngroup, dtype=n.int32)
+    for g in xrange(ngroup):    # ints with full resample window in data
+        shift = groupshift[g]
+        if <int> len0 >= shift + <int> resample:
+            nvalid[g] = min(<int> newlen0, (<int> len0 - shift - <int> resample)/<int> resample + 1)
+
+    cdef size_t intsize = 2*len1*len2*len3
+    cdef size_t blsize = 2*len2*len3
+    cdef float *src
+    cdef float *dst
+    cdef float *datap = <float*> data.data
+    cdef float *resampp = <float*> data_resamp.data
+
+    with nogil:
+        for i in xrange(newlen0):
+            for j in xrange(bl0, bl1):
+                for g in xrange(ngroup):
+                    dst = resampp + i*intsize + j*blsize + groupoffset[g]
+                    if <int> i < nvalid[g]:
+                        iprime = i*resample + groupshift[g]
+                        src = datap + iprime*intsize + j*blsize + groupoffset[g]
+                        memmove(dst, src, groupsize[g]*sizeof(float))
+                        if resample > 1:
+                            for r in xrange(1, resample):
+                                for m in xrange(groupsize[g]):
+                                    dst[m] = dst[m] + src[r*intsize + m]
+                            for m in xrange(groupsize[g]):
+                                dst[m] = dst[m]/resample
+                    else:    # set nonsense shifted data to zero
+                        memset(dst, 0, groupsize[g]*sizeof(float))
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cpdef dedisperse_resample_chanavg(n.ndarray[DTYPE_t, ndim=4, mode='c'] data, n.ndarray[DTYPE_t, ndim=4, mode='c'] data_resamp, n.ndarray[float, ndim=1] freq, float inttime, float dm, unsigned int resample, unsigned int chanavg, blr):
+    """ dedisperse and resample data as dedisperse_resample_blocks and average groups of chanavg adjacent channels into data_resamp.
+    data_resamp has nchan/chanavg channels. Each channel is mean of nonzero dedispersed and resampled channels of its group, so flagged channels do not bias fluxes.
+    GIL is released, so baseline ranges (blr) can be run in parallel with threads.
+    Same result as dedisperse_resample_blocks for chanavg=1.
+    """
+
+    cdef unsigned int i, j, c, k, l, r
+    cdef unsigned int iprime
+    shape = n.shape(data)
+    cdef unsigned int len0 = shape[0]
+    cdef unsigned int len1 = shape[1]
+    cdef unsigned int len2 = shape[2]
+    cdef unsigned int len3 = shape[3]
+    cdef unsigned int bl0 = blr[0]
+    cdef unsigned int bl1 = blr[1]
+    cdef unsigned int navg = len2/chanavg
+    cdef unsigned int newlen0 = min(len0/resample, data_resamp.shape[0])
+    cdef n.ndarray[short, ndim=1] delay = calc_delay(freq, inttime, dm)
+    cdef unsigned int nvalid
+    cdef float accre, accim, chanre, chanim
+
+    assert (len2 % chanavg == 0) and (data_resamp.shape[2] == navg), 'chanavg must divide nchan and data_resamp must have nchan/chanavg channels'
+
+    cdef size_t intsize = 2*len1*len2*len3
+    cdef size_t blsize = 2*len2*len3
+    cdef size_t avgintsize = 2*len1*navg*len3
+    cdef size_t avgblsize = 2*navg*len3
+    cdef float *src
+    cdef float *dst
+    cdef float *datap = <float*> data.data
+    cdef float *resampp = <float*> data_resamp.data
+    cdef short *delayp = <short*> delay.data
+
+    with nogil:
+        for i in xrange(newlen0):
+            for j in xrange(bl0, bl1):
+                for c in xrange(navg):
+                    dst = resampp + i*avgintsize + j*avgblsize + 2*c*len3
+                    for l in xrange(len3):
+                        chanre = 0.
+                        chanim = 0.
+                        nvalid = 0
+                        for k in xrange(c*chanavg, (c+1)*chanavg):
+                            iprime = i*resample + delayp[k]
+                            if iprime + resample <= len0:    # full resample window in data
+                                src = datap + iprime*intsize + j*blsize + 2*(k*len3 + l)
+                                accre = src[0]
+                                accim = src[1]
+                                for r in xrange(1, resample):
+                                    accre = accre + src[r*intsize]
+                                    accim = accim + src[r*intsize+1]
+                                if (accre != 0.) or (accim != 0.):
+                                    chanre = chanre + accre/resample
+                                    chanim = chanim + accim/resample
+                                    nvalid = nvalid + 1
+                        if nvalid > 1:
+                            chanre = chanre/nvalid
+                            chanim = chanim/nvalid
+                        dst[2*l] = chanre
+                        dst[2*l+1] = chanim
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cpdef dedisperse_resample_t(n.ndarray[DTYPE_t, ndim=4, mode='c'] datat, n.ndarray[DTYPE_t, ndim=4, mode='c'] data_resamp, n.ndarray[float, ndim=1] freq, float inttime, float dm, unsigned int resample, blr):
+    """ dedisperse and resample time-contiguous data with shape (nbl, npol, nchan, nints) into data_resamp.
+    data_resamp has usual shape (nints, nbl, nchan, npol), so transpose for imaging is done on output.
+    each baseline is read as contiguous block of channel time series, each starting at its delay, and written one int at a time.
+    GIL is released, so baseline ranges (blr) can be run in parallel with threads.
+    same result as dedisperse_resample for first len(data)/resample ints (or len(data_resamp), if smaller).
+    """
+
+    cdef unsigned int i, ib, i0, i1
+    cdef unsigned int iprime
+    cdef unsigned int j
+    cdef unsigned int k
+    cdef unsigned int l
+    cdef unsigned int r
+    cdef unsigned int iblock = 32
+    cdef int shift
+    cdef DTYPE_t acc
+    shape = n.shape(datat)
+    cdef unsigned int len1 = shape[1]
+    cdef unsigned int len2 = shape[2]
+    cdef unsigned int len3 = shape[3]
+    cdef n.ndarray[short, ndim=1] relativedelay = calc_delay(freq, inttime, dm)
+    cdef unsigned int bl0 = blr[0]
+    cdef unsigned int bl1 = blr[1]
+    cdef unsigned int newlen0 = min(len3/resample, data_resamp.shape[0])
+    cdef n.ndarray[int, ndim=1] nvalid = n.zeros(len2, dtype=n.int32)
+
+    # ints per channel with full resample window in data
+    for k in xrange(len2):
+        shift = relativedelay[k]
+        if <int> len3 >= shift + <int> resample:
+            nvalid[k] = min(<int> newlen0, (<int> len3 - shift - <int> resample)/<int> resample + 1)
+
+    # transpose in blocks of ints, so reads and writes both stay in cache
+    with nogil:
+        for j in xrange(bl0, bl1):     # parallelized over blrange
+            for ib in xrange((newlen0+iblock-1)/iblock):
+                i0 = ib*iblock
+                i1 = min(i0+iblock, newlen0)
+                for k in xrange(len2):
+                    shift = relativedelay[k]
+                    for l in xrange(len1):
+                        for i in xrange(i0, i1):
+                            if <int> i < nvalid[k]:
+                                iprime = i*resample + shift
+                                acc = datat[j,l,k,iprime]
+                                for r in xrange(1,resample):
+                                    acc = acc + datat[j,l,k,iprime+r]
+                                if resample > 1:
+                                    acc = acc/resample
+                                data_resamp[i,j,k,l] = acc
+                            else:    # set nonsense shifted data to zero
+                                data_resamp[i,j,k,l] = 0j
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cpdef dedisperse_fold(n.ndarray[DTYPE_t, ndim=4, mode='c'] data, n.ndarray[DTYPE_t, ndim=4, mode='c'] data_fold, n.ndarray[float, ndim=1] freq, float inttime, float dm, n.ndarray[int, ndim=1] bins, blr):
+    """ Dedisperses data and folds it into data_fold, with one int per phase bin.
+    bins has phase bin of each dedispersed int of data, or -1 to skip it. Only the first max(bins)+1 ints of data_fold are written.
+    Each vis of data_fold is mean of nonzero vis folded into it, so flagged data does not bias fluxes.
+    GIL is released, so baseline ranges (blr) can be run in parallel with threads.
+    """
+
+    cdef unsigned int i, j, k, l
+    cdef int b
+    cdef unsigned int iprime
+    shape = n.shape(data)
+    cdef unsigned int len0 = shape[0]
+    cdef unsigned int len1 = shape[1]
+    cdef unsigned int len2 = shape[2]
+    cdef unsigned int len3 = shape[3]
+    cdef unsigned int bl0 = blr[0]
+    cdef unsigned int bl1 = blr[1]
+    cdef unsigned int nbins = bins.max()+1
+    cdef n.ndarray[short, ndim=1] delay = calc_delay(freq, inttime, dm)
+    cdef n.ndarray[int, ndim=2, mode='c'] count = n.zeros((nbins, len3), dtype=n.int32)
+
+    assert len(bins) == len0, 'bins must have phase bin of each int of data'
+    assert nbins <= data_fold.shape[0], 'data_fold has too few ints for phase bins'
+
+    # data_fold has same nbl, nchan and npol as data
+    cdef size_t intsize = 2*len1*len2*len3
+    cdef size_t chansize = 2*len3
+    cdef float *src
+    cdef float *dst
+    cdef float *datap = <float*> data.data
+    cdef float *foldp = <float*> data_fold.data
+
+    with nogil:
+        for j in xrange(bl0, bl1):
+            for k in xrange(len2):
+                for b in xrange(nbins):
+                    memset(foldp + b*intsize + (j*len2 + k)*chansize, 0, chansize*sizeof(float))
+                    for l in xrange(len3):
+                        count[b,l] = 0
+                for i in xrange(len0):
+                    b = bins[i]
+                    iprime = i+delay[k]
+                    if (b >= 0) and (iprime < len0):
+                        src = datap + iprime*intsize + (j*len2 + k)*chansize
+                        dst = foldp + b*intsize + (j*len2 + k)*chansize
+                        for l in xrange(len3):
+                            if (src[2*l] != 0.) or (src[2*l+1] != 0.):
+                                dst[2*l] = dst[2*l] + src[2*l]
+                                dst[2*l+1] = dst[2*l+1] + src[2*l+1]
+                                count[b,l] = count[b,l] + 1
+                for b in xrange(nbins):
+                    dst = foldp + b*intsize + (j*len2 + k)*chansize
+                    for l in xrange(len3):
+                        if count[b,l] > 1:
+                            dst[2*l] = dst[2*l]/count[b,l]
+                            dst[2*l+1] = dst[2*l+1]/count[b,l]
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cpdef resample_pyramid(n.ndarray[DTYPE_t, ndim=4, mode='c'] data, n.ndarray[DTYPE_t, ndim=4, mode='c'] data_out, unsigned int resample, blr):
+    """ Resamples data in time by averaging groups of resample ints into data_out.
+    Used to build next level of dt pyramid from dedispersed data of previous level.
+    Ints of data_out beyond len(data)/resample are set to zero.
+    Each baseline of an int is one contiguous block, so it is copied and summed as a block. GIL is released, so baseline ranges (blr) can be run in parallel with threads.
+    """
+
+    cdef unsigned int i, j, r, m
+    cdef unsigned int iprime
+    shape = n.shape(data)
+    cdef unsigned int len0 = shape[0]
+    cdef unsigned int len1 = shape[1]
+    cdef unsigned int len2 = shape[2]
+    cdef unsigned int len3 = shape[3]
+    cdef unsigned int bl0 = blr[0]
+    cdef unsigned int bl1 = blr[1]
+    cdef unsigned int newlen0 = data_out.shape[0]
+
+    cdef size_t intsize = 2*len1*len2*len3
+    cdef size_t blsize = 2*len2*len3
+    cdef float *src
+    cdef float *dst
+    cdef float *datap = <float*> data.data
+    cdef float *outp = <float*> data_out.data
+
+    with nogil:
+        for i in xrange(newlen0):
+            iprime = i*resample
+            for j in xrange(bl0, bl1):
+                dst = outp + i*intsize + j*blsize
+                if iprime + resample <= len0:
+                    src = datap + iprime*intsize + j*blsize
+                    memmove(dst, src, blsize*sizeof(float))
+                    for r in xrange(1, resample):
+                        for m in xrange(blsize):
+                            dst[m] = dst[m] + src[r*intsize + m]
+                    for m in xrange(blsize):
+                        dst[m] = dst[m]/resample
+                else:
+                    memset(dst, 0, blsize*sizeof(float))
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cpdef dedisperse_subband1(n.ndarray[DTYPE_t, ndim=4, mode='c'] data, n.ndarray[DTYPE_t, ndim=4, mode='c'] data_sub, n.ndarray[short, ndim=1] intradelay, blr):
+    """ First stage of subband dedispersion. Shifts each channel by its delay within its subband.
+    Reads data and writes data_sub, which can be shared by all dm trials with same intradelay.
+    """
+
+    cdef unsigned int i
+    cdef unsigned int iprime
+    cdef unsigned int j
+    cdef unsigned int k
+    cdef unsigned int l
+    shape = n.shape(data)
+    cdef unsigned int len0 = shape[0]
+    cdef unsigned int len2 = shape[2]
+    cdef unsigned int len3 = shape[3]
+
+    for j in xrange(*blr):     # parallelized over blrange
+        for i in xrange(len0):
+            for k in xrange(len2):
+                iprime = i+intradelay[k]
+                if iprime < len0:
+                    for l in xrange(len3):
+                        data_sub[i,j,k,l] = data[iprime,j,k,l]
+                else:
+                    for l in xrange(len3):
+                        data_sub[i,j,k,l] = 0j
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cpdef dedisperse_subband2(n.ndarray[DTYPE_t, ndim=4, mode='c'] data_sub, n.ndarray[DTYPE_t, ndim=4, mode='c'] data_resamp, n.ndarray[n.int_t, ndim=1] subbands, n.ndarray[short, ndim=1] subdelay, n.ndarray[short, ndim=1] intradelay, unsigned int resample, blr):
+    """ Second stage of subband dedispersion. Shifts each subband of data_sub as a block and resamples into data_resamp.
+    Result is identical to dedisperse_resample over the first len0/resample ints, if calc_subdelay error is 0.
+    """
+
+    cdef unsigned int i
+    cdef unsigned int iprime
+    cdef unsigned int j
+    cdef unsigned int k
+    cdef unsigned int l
+    cdef unsigned int r
+    cdef unsigned int s
+    cdef unsigned int k0
+    cdef unsigned int k1
+    cdef unsigned int intramin
+    cdef unsigned int intramax
+    cdef DTYPE_t acc
+    shape = n.shape(data_sub)
+    cdef unsigned int len0 = shape[0]
+    cdef unsigned int len3 = shape[3]
+    cdef unsigned int newlen0 = len0/resample
+    cdef unsigned int nsub = len(subbands)-1
+
+    for s in xrange(nsub):
+        k0 = subbands[s]
+        k1 = subbands[s+1]
+        intramin = intradelay[k0:k1].min()
+        intramax = intradelay[k0:k1].max()
+        for j in xrange(*blr):     # parallelized over blrange
+            for i in xrange(newlen0):
+                iprime = i*resample+subdelay[s]
+                if iprime + intramax < len0-(resample-1):    # whole subband in bounds. block copy.
+                    for k in xrange(k0, k1):
+                        for l in xrange(len3):
+                            acc = data_sub[iprime,j,k,l]
+                            if resample > 1:
+                                for r in xrange(1,resample):
+                                    acc = acc + data_sub[iprime+r,j,k,l]
+                                acc = acc/resample
+                            data_resamp[i,j,k,l] = acc
+                elif iprime + intramin >= len0-(resample-1):    # whole subband out of bounds
+                    for k in xrange(k0, k1):
+                        for l in xrange(len3):
+                            data_resamp[i,j,k,l] = 0j
+                else:    # subband straddles edge, so check each channel
+                    for k in xrange(k0, k1):
+                        for l in xrange(len3):
+                            if iprime + intradelay[k] < len0-(resample-1):
+                                acc = data_sub[iprime,j,k,l]
+                                if resample > 1:
+                                    for r in xrange(1,resample):
+                                        acc = acc + data_sub[iprime+r,j,k,l]
+                                    acc = acc/resample
+                                data_resamp[i,j,k,l] = acc
+                            else:
+                                data_resamp[i,j,k,l] = 0j
+
+cpdef calc_fdmtbands(unsigned int nchan, unsigned int nsubband):
+    """ Function to define merging of channels for fdmt.
+    Starts with single channels and merges neighboring pairs until the next merge would leave fewer than nsubband.
+    Returns list of levels, each a list of (first chan, last chan + 1) per band. Last level defines output subbands.
+    """
+
+    bands = [(k, k+1) for k in xrange(nchan)]
+    levels = [bands]
+    while (len(bands) > 1) and ((len(bands)+1)/2 >= max(1, nsubband)):
+        bands = [(bands[b][0], bands[min(b+1, len(bands)-1)][1]) for b in xrange(0, len(bands), 2)]
+        levels.append(bands)
+    return levels
+
+cpdef calc_fdmtndelay(n.ndarray[float, ndim=1] freq, float inttime, float maxdm, band):
+    """ Function to calculate number of delay trials needed by fdmt for a band (first chan, last chan + 1) up to maxdm.
+    """
+
+    cdef double lofreq = freq[band[0]]
+    cdef double hifreq = freq[band[1]-1]
+    return int(n.ceil(4.2e-3 * maxdm * (1/(lofreq*lofreq) - 1/(hifreq*hifreq))/inttime)) + 1
+
+def fdmt_mergeindex(n.ndarray[n.float64_t, ndim=1] kk, lo, hi, unsigned int delay, unsigned int nlo, unsigned int nhi):
+    """ Returns tuple (delayhi, shift, delaylo) that fdmt combines for delay of band merged from bands lo and hi (first chan, last chan + 1).
+    kk is freq**-2 of channels. nlo and nhi are number of delays of lo and hi.
+    hi is taken at delayhi and lo is shifted by delay of its highest channel. lo keeps residual of merged delay, so highest and lowest channels are exact.
+    """
+
+    scale = delay/(kk[lo[0]] - kk[hi[1]-1])    # ints per unit of freq**-2
+    delayhi = min(int(round(scale*(kk[hi[0]] - kk[hi[1]-1]))), nhi-1)
+    shift = int(round(scale*(kk[lo[1]-1] - kk[hi[1]-1])))
+    delaylo = min(max(0, <int> delay - shift), nlo-1)
+    return delayhi, shift, delaylo
+
+def fdmt_transform(states, n.ndarray[float, ndim=1] freq, float inttime, float maxdm, unsigned int nsubband):
+    """ Merges states of single channels (each with shape (1, nints, ...)) up to output subbands of fdmt. Works for any dtype.
+    Returns list of states, one per output subband, each with shape (ndelay, nints, ...).
+    """
+
+    levels = calc_fdmtbands(len(freq), nsubband)
+    kk = 1/freq.astype(n.float64)**2
+    len0 = states[0].shape[1]
+
+    for lev in xrange(1, len(levels)):
+        prev = levels[lev-1]
+        newstates = []
+        for b in xrange(0, len(prev), 2):
+            if b+1 == len(prev):     # odd band passes through to next level
+                newstates.append(states[b])
+                continue
+
+            lo = prev[b]; hi = prev[b+1]
+            state = n.zeros( (calc_fdmtndelay(freq, inttime, maxdm, (lo[0], hi[1])),) + states[b].shape[1:], dtype=states[b].dtype)
+            for delay in xrange(len(state)):
+                delayhi, shift, delaylo = fdmt_mergeindex(kk, lo, hi, delay, len(states[b]), len(states[b+1]))
+                state[delay] = states[b+1][delayhi]
+                if shift < len0:
+                    state[delay, :len0-shift] += states[b][delaylo, shift:]
+            newstates.append(state)
+        states = newstates
+    return states
+
+cpdef fdmt(data, data_fdmt, n.ndarray[float, ndim=1] freq, float inttime, float maxdm, unsigned int nsubband, blr, data_count=None):
+    """ Fast dispersion measure transform (Zackay & Ofek 2014) of visibilities for baselines in blr.
+    Sums channels into subbands along dispersion sweeps for every integer delay up to that of maxdm.
+    Each band is referenced to its highest channel and merged bands are combined with a single shift (see fdmt_mergeindex).
+    data_fdmt has shape (ndelay, nints, nbl, npol), where ndelay sums calc_fdmtndelay over output subbands.
+    If data_count (uint16 with shape of data_fdmt) is given, it gets number of nonzero visibilities in each sum, so flagged channels can be excluded from subband means.
+    """
+
+    bl0, bl1 = blr
+    outputs = [(data_fdmt, [data[:, bl0:bl1, k][None] for k in xrange(len(freq))])]
+    if data_count is not None:
+        outputs.append( (data_count, [(data[:, bl0:bl1, k] != 0).astype(n.uint16)[None] for k in xrange(len(freq))]) )
+
+    for (out, states) in outputs:
+        offset = 0
+        for state in fdmt_transform(states, freq, inttime, maxdm, nsubband):
+            out[offset:offset+len(state), :, bl0:bl1] = state
+            offset += len(state)
+
+cpdef fdmt_extract(data_fdmt, data_resamp, n.ndarray[float, ndim=1] freq, float inttime, float maxdm, float dm, unsigned int nsubband, blr, data_count=None):
+    """ Extracts visibilities for single dm from output of fdmt.
+    Writes mean visibility of each subband into data_resamp with shape (nints, nbl, nsubband, npol).
+    Mean is over nonzero visibilities counted in data_count by fdmt, if given. Otherwise, over all channels of subband.
+    Subbands are shifted by delay of their highest channel, as in dedisperse_resample.
+    """
+
+    bl0, bl1 = blr
+    len0 = data_resamp.shape[0]
+    bands = calc_fdmtbands(len(freq), nsubband)[-1]
+    cdef n.ndarray[short, ndim=1] delay = calc_delay(freq, inttime, dm)
+
+    offset = 0
+    for s in xrange(len(bands)):
+        k0, k1 = bands[s]
+        ndelay = calc_fdmtndelay(freq, inttime, maxdm, bands[s])
+        banddelay = min(delay[k0] - delay[k1-1], ndelay-1)
+        shift = min(delay[k1-1], len0)
+        if data_count is not None:
+            data_resamp[:len0-shift, bl0:bl1, s] = data_fdmt[offset+banddelay, shift:, bl0:bl1]/n.maximum(data_count[offset+banddelay, shift:, bl0:bl1], 1)
+        else:
+            data_resamp[:len0-shift, bl0:bl1, s] = data_fdmt[offset+banddelay, shift:, bl0:bl1]/(k1-k0)
+        data_resamp[len0-shift:, bl0:bl1, s] = 0j
+        offset += ndelay
+
+cpdef calc_fdmtoffsets(n.ndarray[float, ndim=1] freq, float inttime, float maxdm, unsigned int nsubband, float dm):
+    """ Returns delay in ints of each channel, relative to highest channel, along sweep that fdmt_extract takes for dm.
+    Same as calc_delay for exact dedispersion. Channels with other delays are lost for pulses of one int.
+    """
+
+    levels = calc_fdmtbands(len(freq), nsubband)
+    kk = 1/freq.astype(n.float64)**2
+    cdef n.ndarray[short, ndim=1] delay = calc_delay(freq, inttime, dm)
+    cdef n.ndarray[int, ndim=1] offsets = n.zeros(len(freq), dtype=n.int32)
+
+    # number of delays in state of each band, as made by fdmt_transform
+    nstates = [[1]*len(levels[0])]
+    for lev in xrange(1, len(levels)):
+        nstates.append([nstates[lev-1][2*b] if 2*b+1 == len(levels[lev-1]) else calc_fdmtndelay(freq, inttime, maxdm, levels[lev][b]) for b in xrange(len(levels[lev]))])
+
+    # walk down merges from each output subband with (level, band, delay, offset of highest channel)
+    top = len(levels)-1
+    stack = [(top, s, min(delay[levels[top][s][0]] - delay[levels[top][s][1]-1], nstates[top][s]-1), delay[levels[top][s][1]-1]) for s in xrange(len(levels[top]))]
+    while stack:
+        lev, b, dd, off = stack.pop()
+        if lev == 0:
+            offsets[levels[0][b][0]] = off
+        elif 2*b+1 == len(levels[lev-1]):   # passed through
+            stack.append( (lev-1, 2*b, dd, off) )
+        else:
+            delayhi, shift, delaylo = fdmt_mergeindex(kk, levels[lev-1][2*b], levels[lev-1][2*b+1], dd, nstates[lev-1][2*b], nstates[lev-1][2*b+1])
+            stack.append( (lev-1, 2*b+1, delayhi, off) )
+            stack.append( (lev-1, 2*b, delaylo, off + shift) )
+    return offsets
+
 cpdef meantsub(n.ndarray[DTYPE_t, ndim=4, mode='c'] datacal, blr):
     """ Subtract mean visibility, ignoring zeros
     """
@@ -782,8 +2043,79 @@ cpdef meantsub(n.ndarray[DTYPE_t, ndim=4, mode='c'] datacal, blr):
                         if datacal[i,j,k,l] != 0j:   # ignore zeros
                             datacal[i,j,k,l] = datacal[i,j,k,l] - sum/count
 
-cpdef dataflag(n.ndarray[DTYPE_t, ndim=4, mode='c'] datacal, n.ndarray[n.int_t, ndim=1] chans, unsigned int pol, d, sigma=4, mode='', convergence=0.2, tripfrac=0.4):
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cpdef meantsub_t(n.ndarray[DTYPE_t, ndim=4, mode='c'] datat, blr):
+    """ Subtract mean visibility, ignoring zeros, for time-contiguous data with shape (nbl, npol, nchan, nints).
+    """
+
+    cdef unsigned int i, j, k, l
+    sh = datat.shape
+    cdef unsigned int npol = sh[1]
+    cdef unsigned int nchan = sh[2]
+    cdef unsigned int iterint = sh[3]
+    cdef complex sum
+    cdef unsigned int count = 0
+
+    for j in xrange(*blr):
+        for l in xrange(npol):
+            for k in xrange(nchan):
+                sum = 0.
+                count = 0
+                for i in xrange(iterint):
+                    if datat[j,l,k,i] != 0j:   # ignore zeros
+                        sum += datat[j,l,k,i]
+                        count += 1
+                if count:
+                    for i in xrange(iterint):
+                        if datat[j,l,k,i] != 0j:   # ignore zeros
+                            datat[j,l,k,i] = datat[j,l,k,i] - sum/count
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cpdef stokesi(n.ndarray[DTYPE_t, ndim=4, mode='c'] data, n.ndarray[DTYPE_t, ndim=4, mode='c'] data_i, pols, blr):
+    """ Writes Stokes I of data with shape (nints, nbl, nchan, npol) into data_i with shape (nints, nbl, nchan, 1).
+    Stokes I is mean of pols (indices of parallel hands) that are not zero, so a pol flagged on its own does not bias it.
+    GIL is released, so baseline ranges (blr) can be run in parallel with threads.
+    """
+
+    cdef unsigned int i, j, k, l, count
+    shape = n.shape(data)
+    cdef unsigned int len0 = shape[0]
+    cdef unsigned int len1 = shape[1]
+    cdef unsigned int len2 = shape[2]
+    cdef unsigned int len3 = shape[3]
+    cdef unsigned int bl0 = blr[0]
+    cdef unsigned int bl1 = blr[1]
+    cdef n.ndarray[int, ndim=1] polarr = n.array(pols, dtype=n.int32)
+    cdef unsigned int npolsel = len(polarr)
+    cdef size_t src, dst
+    cdef float re, im, sumre, sumim
+    cdef float *datap = <float*> data.data
+    cdef float *outp = <float*> data_i.data
+
+    with nogil:
+        for i in xrange(len0):
+            for j in xrange(bl0, bl1):
+                for k in xrange(len2):
+                    dst = (<size_t> i*len1 + j)*len2 + k
+                    sumre = 0.; sumim = 0.
+                    count = 0
+                    for l in xrange(npolsel):
+                        src = 2*(dst*len3 + polarr[l])
+                        re = datap[src]; im = datap[src+1]
+                        if (re != 0.) or (im != 0.):   # ignore zeros
+                            sumre += re; sumim += im
+                            count += 1
+                    if count:
+                        outp[2*dst] = sumre/count; outp[2*dst+1] = sumim/count
+                    else:
+                        outp[2*dst] = 0.; outp[2*dst+1] = 0.
+
+cpdef dataflag(datacal, n.ndarray[n.int_t, ndim=1] chans, unsigned int pol, d, sigma=4, mode='', convergence=0.2, tripfrac=0.4):
     """ Flagging function that can operate on pol/chan selections independently
+    datacal has shape (nints, nbl, nchan, npol), but can be a transposed view of time-contiguous data (as with d['tlayout']).
+    flags are set with array slicing, so they are written to underlying data for either layout.
     """
 
     cdef unsigned int i, j, 
@@ -820,13 +2152,8 @@ cpdef dataflag(n.ndarray[DTYPE_t, ndim=4, mode='c'] datacal, n.ndarray[n.int_t,
             # flag blstd too high
             badint, badchan = n.where(blstd > blstdmednew + sigma*blstdstdnew)
             for badi in range(len(badint)):
-#            for i in xrange(iterint):
-#                for chan in xrange(len(chans)):
-#                    if blstd.data[i,chan] > blstdmednew + sigma*blstdstdnew:     # then measure points to flag based on a third std threshold
                 flagged += nbl
-                for j in xrange(nbl):
-                    datacal[badint[badi],j,chans[badchan[badi]],pol] = n.complex64(0j)
-#                logger.info('%d, %d, %d, %d' % (badi, badint[badi], badchan[badi], chans[badchan[badi]]))
+                datacal[badint[badi],:,chans[badchan[badi]],pol] = n.complex64(0j)
 
             summary='Blstd flagging for (chans %d-%d, pol %d), %.1f sigma: %3.2f %% of total flagged' % (chans[0], chans[-1], pol, sigma, 100.*flagged/datacal.size)
 
@@ -848,9 +2175,7 @@ cpdef dataflag(n.ndarray[DTYPE_t, ndim=4, mode='c'] datacal, n.ndarray[n.int_t,
             badch = n.where(specmed > sigma*specmed.std())[0]
             for chan in badch:
                 flagged += iterint*nbl
-                for i in xrange(iterint):
-                    for j in xrange(nbl):
-                        datacal[i,j,chan,pol] = n.complex64(0j)
+                datacal[:,:,chan,pol] = n.complex64(0j)
 
             # calc badt as deviation from median of window
             lcmed = []
@@ -863,9 +2188,7 @@ cpdef dataflag(n.ndarray[DTYPE_t, ndim=4, mode='c'] datacal, n.ndarray[n.int_t,
             badt = n.where(lcmed > sigma*lcmed.std())[0]
             for i in badt:
                 flagged += nchan*nbl
-                for chan in xrange(len(chans)):
-                    for j in xrange(nbl):
-                        datacal[i,j,chans[chan],pol] = n.complex64(0j)
+                datacal[i,:,chans,pol] = n.complex64(0j)
 
             summary='Bad chans/ints flagging for (chans %d-%d, pol %d), %1.f sigma: %d chans, %d ints, %3.2f %% of total flagged' % (chans[0], chans[-1], pol, sigma, len(badch), len(badt), 100.*flagged/datacal.size)
 
@@ -888,14 +2211,10 @@ cpdef dataflag(n.ndarray[DTYPE_t, ndim=4, mode='c'] datacal, n.ndarray[n.int_t,
 
             for chan in badch:
                 flagged += iterint*nbl
-                for i in xrange(iterint):
-                    for j in xrange(nbl):
-                        datacal[i,j,chan,pol] = n.complex64(0j)
+                datacal[:,:,chan,pol] = n.complex64(0j)
             for i in badt:
                 flagged += nchan*nbl
-                for chan in xrange(len(chans)):
-                    for j in xrange(nbl):
-                        datacal[i,j,chans[chan],pol] = n.complex64(0j)
+                datacal[i,:,chans,pol] = n.complex64(0j)
 
             summary='Bad chans/ints flagging for (chans %d-%d, pol %d), %1.f sigma: %d chans, %d ints, %3.2f %% of total flagged' % (chans[0], chans[-1], pol, sigma, len(badch), len(badt), 100.*flagged/datacal.size)
 
@@ -909,9 +2228,7 @@ cpdef dataflag(n.ndarray[DTYPE_t, ndim=4, mode='c'] datacal, n.ndarray[n.int_t,
 
             for badbl in badbls:
                flagged += iterint*len(chans)
-               for i in xrange(iterint):
-                   for chan in chans:
-                       datacal[i,badbl,chan,pol] = n.complex64(0j)
+               datacal[:,badbl,chans,pol] = n.complex64(0j)
 
             summary='Ringing flagging for (chans %d-%d, pol %d) at %.1f sigma: %d/%d bls, %3.2f %% of total flagged' % (chans[0], chans[-1], pol, sigma, len(badbls), nbl, 100.*flagged/datacal.size)
 
@@ -931,9 +2248,7 @@ cpdef dataflag(n.ndarray[DTYPE_t, ndim=4, mode='c'] datacal, n.ndarray[n.int_t,
                     badpols = n.concatenate( (badpols, [ww[1][i]]*len(newbadbls)) )
                 for j in xrange(len(badbls)):
                     flagged += iterint*len(chans)
-                    for i in xrange(iterint):
-                        for chan in chans:
-                            datacal[i,badbls[j],chan,badpols[j]] = n.complex64(0j)
+                    datacal[:,badbls[j],chans,badpols[j]] = n.complex64(0j)
 
             summary='Bad basepol flagging for chans %d-%d at %.1f sigma: ants/pols %s/%s, %3.2f %% of total flagged' % (chans[0], chans[-1], sigma, badants, ww[1], 100.*flagged/datacal.size)
 
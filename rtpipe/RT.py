@@ -1,9 +1,12 @@
 import rtpipe.parsems as pm
 import rtpipe.parsecal as pc
 import rtpipe.parsesdm as ps
+import rtpipe.dedispplan as dp
+import rtpipe.candcollect as cc
 import rtlib_cython as rtlib
 import multiprocessing as mp
 import multiprocessing.sharedctypes as mps
+from multiprocessing.pool import ThreadPool
 from contextlib import closing
 import numpy as n
 from scipy.special import erf
@@ -52,14 +55,14 @@ def pipeline(d, segments):
     random.seed()    
 
     # set up shared arrays to fill
-    data_read_mem = mps.Array(mps.ctypes.c_float, datasize(d)*2);  data_mem = mps.Array(mps.ctypes.c_float, datasize(d)*2)
+    data_read_mem = mps.Array(mps.ctypes.c_float, readsize(d)*2);  data_mem = mps.Array(mps.ctypes.c_float, datasize(d)*2)
     u_read_mem = mps.Array(mps.ctypes.c_float, d['nbl']);  u_mem = mps.Array(mps.ctypes.c_float, d['nbl'])
     v_read_mem = mps.Array(mps.ctypes.c_float, d['nbl']);  v_mem = mps.Array(mps.ctypes.c_float, d['nbl'])
     w_read_mem = mps.Array(mps.ctypes.c_float, d['nbl']);  w_mem = mps.Array(mps.ctypes.c_float, d['nbl'])
 
     # need these if debugging
-    data = numpyview(data_mem, 'complex64', datashape(d)) # optional
-    data_read = numpyview(data_read_mem, 'complex64', datashape(d)) # optional
+    data = dataview(d, data_mem) # optional
+    data_read = readview(d, data_read_mem) # optional
                 
     results = {}
     # only one needed for parallel read/process. more would overwrite memory space
@@ -93,7 +96,7 @@ def pipeline(d, segments):
 
                         if d['domock']:
                             nints = d['readints']
-                            rms = data[nints/2].real.std()
+                            rms = data[nints/2].real.std() \
                                   / n.sqrt(d['npol']*d['nbl']*d['nchan'])
                             DMmax = max(d['dmarr'])
                             logger.debug(' Adding mock transient ...')
@@ -126,7 +129,8 @@ def pipeline_dataprep(d, segment):
     d['segment'] = segment
 
     # set up numpy arrays, as expected by dataprep functions
-    data_read = numpyview(data_read_mem, 'complex64', datashape(d), raw=False); data = numpyview(data_mem, 'complex64', datashape(d), raw=False)
+    data_read = numpyview(data_read_mem, 'complex64', readshape(d), raw=False); data = dataview(d, data_mem)
+    tlayout = d.has_key('tlayout') and d['tlayout']
     u_read = numpyview(u_read_mem, 'float32', d['nbl'], raw=False); u = numpyview(u_mem, 'float32', d['nbl'], raw=False)
     v_read = numpyview(v_read_mem, 'float32', d['nbl'], raw=False); v = numpyview(v_mem, 'float32', d['nbl'], raw=False)
     w_read = numpyview(w_read_mem, 'float32', d['nbl'], raw=False); w = numpyview(w_mem, 'float32', d['nbl'], raw=False)
@@ -177,6 +181,12 @@ def pipeline_dataprep(d, segment):
         else:
             logger.info('Calibration file not found. Proceeding with no calibration applied.')
 
+        # rest of prep done on time-contiguous data, if requested. data_read keeps usual shape as a transposed view.
+        if tlayout:
+            data_readt = numpyview(data_read_mem, 'complex64', datashape_t(d), raw=False)
+            data_readt[:] = data_read.transpose(1,3,2,0).copy()
+            data_read = dataview(d, data_read_mem)
+
         # flag data
         if len(d['flaglist']):
             logger.info('Flagging with flaglist: %s' % d['flaglist'])
@@ -187,7 +197,10 @@ def pipeline_dataprep(d, segment):
         # mean t vis subtration
         if d['timesub'] == 'mean':
             logger.info('Subtracting mean visibility in time...')
-            rtlib.meantsub(data_read, [0, d['nbl']])
+            if tlayout:
+                rtlib.meantsub_t(data_readt, [0, d['nbl']])
+            else:
+                rtlib.meantsub(data_read, [0, d['nbl']])
         else:
             logger.info('No mean time subtraction.')
 
@@ -199,7 +212,10 @@ def pipeline_dataprep(d, segment):
         try:
             if any([d['l1'], d['m1']]):
                 logger.info('Rephasing data to (l, m)=(%.4f, %.4f).' % (d['l1'], d['m1']))
-                rtlib.phaseshift_threaded(data_read, d, d['l1'], d['m1'], u_read, v_read)
+                if tlayout:
+                    rtlib.phaseshift_t(data_readt, d, d['l1'], d['m1'], u_read, v_read)
+                else:
+                    rtlib.phaseshift_threaded(data_read, d, d['l1'], d['m1'], u_read, v_read)
                 d['l0'] = d['l1']
                 d['m0'] = d['m1']
             else:
@@ -210,7 +226,10 @@ def pipeline_dataprep(d, segment):
         logger.debug('prep finished data_read mods and waiting for data lock for segment %d. data_read = %s. data = %s' % (segment, str(data_read.mean()), str(data.mean())))
         with data_mem.get_lock():
             logger.debug('prep data_read unlocked for segment %d. data_read = %s. data = %s.' % (segment, str(data_read.mean()), str(data.mean())))
-            data[:] = data_read[:]
+            if d.has_key('stokesi') and d['stokesi']:
+                rtlib.stokesi(data_read, data, stokesipols(d), [0, d['nbl']])
+            else:
+                data[:] = data_read[:]
             u[:] = u_read[:]; v[:] = v_read[:]; w[:] = w_read[:]
             logger.debug('prep copied into data for segment %d. data_read = %s. data = %s.' % (segment, str(data_read.mean()), str(data.mean())))
     logger.info('All data unlocked for segment %d' % segment)
@@ -226,7 +245,7 @@ def pipeline_reproduce(d, segment, candloc = ()):
 
     # set up shared arrays to fill
     data_reproduce_mem = mps.Array(mps.ctypes.c_float, datasize(d)*2)
-    data_read_mem = mps.Array(mps.ctypes.c_float, datasize(d)*2)
+    data_read_mem = mps.Array(mps.ctypes.c_float, readsize(d)*2)
     data_mem = mps.Array(mps.ctypes.c_float, datasize(d)*2)
     u_read_mem = mps.Array(mps.ctypes.c_float, d['nbl'])
     u_mem = mps.Array(mps.ctypes.c_float, d['nbl'])
@@ -236,8 +255,8 @@ def pipeline_reproduce(d, segment, candloc = ()):
     w_mem = mps.Array(mps.ctypes.c_float, d['nbl'])
 
     # get numpy views of memory spaces
-    data = numpyview(data_mem, 'complex64', datashape(d)) # optional
-    data_read = numpyview(data_read_mem, 'complex64', datashape(d)) # optional
+    data = dataview(d, data_mem) # optional
+    data_read = readview(d, data_read_mem) # optional
     u = numpyview(u_mem, 'float32', d['nbl'], raw=False)
     v = numpyview(v_mem, 'float32', d['nbl'], raw=False)
     w = numpyview(w_mem, 'float32', d['nbl'], raw=False)
@@ -274,7 +293,7 @@ def meantsubpool(d, data_read):
     """
 
     logger.info('Subtracting mean visibility in time...')
-    data_read = numpyview(data_read_mem, 'complex64', datashape(d))
+    data_read = numpyview(data_read_mem, 'complex64', readshape(d))
     tsubpart = partial(rtlib.meantsub, data_read)
 
     blranges = [(d['nbl'] * t/d['nthread'], d['nbl']*(t+1)/d['nthread']) for t in range(d['nthread'])]
@@ -291,7 +310,7 @@ def dataflag(d, data_read):
 #        with closing(mp.Pool(4, initializer=initreadonly, initargs=(data_read_mem,))) as flagpool:
         for ss in d['spw']:
             chans = n.arange(d['spw_chanr_select'][ss][0], d['spw_chanr_select'][ss][1])
-            for pol in range(d['npol']):
+            for pol in range(len(d['pols'])):
                 status = rtlib.dataflag(data_read, chans, pol, d, sig, mode, conv)
                 logger.info(status)
 
@@ -300,7 +319,7 @@ def dataflagatom(chans, pol, d, sig, mode, conv):
     Assumes data_mem is global mps.Array
     """
 
-    data = numpyview(data_mem, 'complex64', datashape(d))
+    data = dataview(d, data_mem)
 #    data = n.ma.masked_array(data, data==0j)  # this causes massive overflagging on 14sep03 data
 
     return rtlib.dataflag(data, chans, pol, d, sig, mode, conv)
@@ -309,25 +328,128 @@ def search(d, data_mem, u_mem, v_mem, w_mem):
     """ Search function.
     Queues all trials with multiprocessing.
     Assumes shared memory system with single uvw grid for all images.
+    With prefilter or dm_refineloss, number of ints imaged and searched per (dmind, dtind) are saved in d['imagecounts'].
+    With dm_refineloss, a coarse subset of dmarr is searched first at lowered threshold and other dms are only imaged around its hits (see calc_dmrefine).
+    Candidates are kept by CandCollector, limited by maxcands and maxcands_trial. Counts of found and discarded cands per (dmind, dtind) are saved in d['candcounts'].
+    With savepeaks, peak snr and pixel of every imaged int are written to peaks file of segment (see peaksshape and parsepeaks).
     """
 
-    data = numpyview(data_mem, 'complex64', datashape(d))
+    data = dataview(d, data_mem)
     u = numpyview(u_mem, 'float32', d['nbl'])
     v = numpyview(v_mem, 'float32', d['nbl'])
     w = numpyview(w_mem, 'float32', d['nbl'])
-    data_resamp_mem = mps.Array(mps.ctypes.c_float, datasize(d)*2)
-    data_resamp = numpyview(data_resamp_mem, 'complex64', datashape(d))
+
+    # fdmt dedispersion produces subbands, so data_resamp and imaging use state for subbands
+    if d['dedisptype'] == 'fdmt':
+        ds = fdmtstate(d)
+    else:
+        ds = d
+    # image dedispersion makes dms from subband images, so it has no data_resamp
+    if d['dedisptype'] == 'image':
+        data_resamp_mem = None
+        subims_mem = mps.Array(mps.ctypes.c_float, subimagesize(d))
+    else:
+        data_resamp_mem = mps.Array(mps.ctypes.c_float, resampsize(ds)*2)
+        data_resamp = numpyview(data_resamp_mem, 'complex64', resampshape(ds))
+        subims_mem = None
+
+    # subband, image and fdmt dedispersion keep intermediate products in their own buffer
+    if d['dedisptype'] in ['subband', 'image']:
+        data_sub_mem = mps.Array(mps.ctypes.c_float, datasize(d)*2)
+        dmgroups = calc_dmgroups(d)
+    elif d['dedisptype'] == 'fdmt':
+        data_sub_mem = mps.Array(mps.ctypes.c_float, fdmtsize(d)*2)
+    else:
+        data_sub_mem = None
+    # fdmt counts unflagged visibilities in each sum, so subbands are mean of good channels
+    if d['dedisptype'] == 'fdmt':
+        fdmtcount_mem = mps.Array(mps.ctypes.c_uint16, fdmtsize(d))
+    else:
+        fdmtcount_mem = None
 
     logger.debug('Search of segment %d' % d['segment'])
 
-    beamnum = 0   # not yet implemented
-    cands = {}
+    plan = dp.get_plan(d)
+    collector = cc.CandCollector(recordfeatures(d), d['maxcands'], d['maxcands_trial'])
+    cands = collector.cands
+    prefilter = (d['sigma_prefilter'] or d['prefilter_topk']) and (d['searchtype'] == 'image1')
+    refine = d['dm_refineloss'] > 0
+    if prefilter or refine:
+        d['imagecounts'] = {}
+
+    # dm refinement searches coarse dms first. threshold is lowered, so pulses found at sigma_image1 on fine dm are hits on coarse dm.
+    if refine:
+        coarse = calc_dmrefine(d)
+        sigma_refine = d['sigma_image1']*(1 - d['dm_refineloss'])
+        snrcol = cc.snrcol(recordfeatures(d))
+        hits = []
+        dmorder = list(coarse)
+    else:
+        dmorder = range(len(d['dmarr']))
 
     candsfile = getcandsfile(d)
     if d['savecands'] and os.path.exists(candsfile):
         logger.warn('candsfile %s already exists' % candsfile)
         return cands
 
+    # peaks file is filled by workers as trials finish. made as npy, so it can be memory mapped later.
+    if d['savepeaks']:
+        assert d['searchtype'] == 'image1', 'savepeaks only supported for searchtype image1'
+        peakcube = n.lib.format.open_memmap(getpeaksfile(d), mode='w+', dtype=peaksdtype, shape=peaksshape(d))
+        del peakcube
+        logger.info('Saving peak of every imaged int to %s' % getpeaksfile(d))
+
+    # make fft plans for every batch size used by chunks before opening pool, so workers inherit them. FFTW wisdom in workdir avoids planning again after restarts.
+    wisdomfile = getwisdomfile(d)
+    rtlib.load_wisdom(wisdomfile)
+    for batch in calc_fftbatches(d, plan):
+        rtlib.get_fftplan(d['npixx'], d['npixy'], batch, d['fftthreads'], d['fftc2r'])
+        if d['npix_coarse']:
+            rtlib.get_fftplan(d['npixx_coarse'], d['npixy_coarse'], batch, d['fftthreads'], d['fftc2r'])
+    if rtlib.save_wisdom(wisdomfile):
+        logger.info('Saved new FFTW wisdom to %s' % wisdomfile)
+
+    # uv cells are fixed for segment, so make gridding operators once and share them with workers
+    uu = n.outer(u, ds['freq']/ds['freq_orig'][0])
+    vv = n.outer(v, ds['freq']/ds['freq_orig'][0])
+    gridop = rtlib.calc_gridop(uu, vv, ds['npixx'], ds['npixy'], ds['uvres'], ds['fftc2r'])
+    if ds['npix_coarse']:
+        gridop_coarse = rtlib.calc_gridop(uu, vv, ds['npixx_coarse'], ds['npixy_coarse'], ds['uvres'], ds['fftc2r'], ds['uvmax_coarse'])
+        ds = calc_coarse(ds, gridop, gridop_coarse)
+    else:
+        gridop_coarse = None
+
+    # each beam grids with its own fringe rotation, so data is never rephased
+    if d['beams']:
+        freqscale = (ds['freq']/ds['freq_orig'][0]).astype('float32')
+        dlm = [(l1 - d['l0'], m1 - d['m0']) for (l1, m1) in d['beams']]
+        gridops = [rtlib.calc_beamgridop(gridop, dl, dm, u, v, freqscale) for (dl, dm) in dlm]
+        gridops_coarse = [rtlib.calc_beamgridop(gridop_coarse, dl, dm, u, v, freqscale) if gridop_coarse else None for (dl, dm) in dlm]
+    else:
+        gridops = [gridop]
+        gridops_coarse = [gridop_coarse]
+
+    # channel averaging grids averaged channels at their mean frequency, with operators for each factor used
+    gridops_chanavg = {}
+    if d['chanavg'] > 1:
+        for chanavg in set([chanavg for chanavgs in d['chanavgfactors'] for chanavg in chanavgs]) - set([1]):
+            freqscale = (chanavgstate(ds, chanavg)['freq']/ds['freq_orig'][0]).astype('float32')
+            gridop1 = rtlib.calc_gridop(n.outer(u, freqscale), n.outer(v, freqscale), ds['npixx'], ds['npixy'], ds['uvres'], ds['fftc2r'])
+            if d['beams']:
+                gridops_chanavg[chanavg] = [rtlib.calc_beamgridop(gridop1, dl, dm, u, v, freqscale) for (dl, dm) in dlm]
+            else:
+                gridops_chanavg[chanavg] = [gridop1]
+
+    # image dedispersion grids each subband on its own
+    if d['dedisptype'] == 'image':
+        gridops_sub = [[rtlib.calc_subbandgridop(gridop1, d['nchan'], d['subbands'][s], d['subbands'][s+1]) for s in xrange(len(d['subbands'])-1)] for gridop1 in gridops]
+    else:
+        gridops_sub = None
+
+    # bispectrum search uses all closed triples of baselines
+    if d['searchtype'] == 'bispectrum':
+        triples = rtlib.make_triples(d)
+
     # make wterm kernels
     if d['searchtype'] == 'image2w':
         wres = 100
@@ -338,39 +460,144 @@ def search(d, data_mem, u_mem, v_mem, w_mem):
     if n.any(data):
         logger.info('Searching in %d chunks with %d threads' % (d['nchunk'], d['nthread']))
         logger.info('Dedispering to max (DM, dt) of (%d, %d) ...' % (d['dmarr'][-1], d['dtarr'][-1]) )
+        if d['dedisptype'] == 'subband':
+            logger.info('Using subband dedispersion with %d subbands and %d groups of DMs' % (len(d['subbands'])-1, len(dmgroups)))
+        elif d['dedisptype'] == 'image':
+            logger.info('Using image dedispersion with %d subbands and %d groups of DMs' % (len(d['subbands'])-1, len(dmgroups)))
+        elif d['dedisptype'] == 'fdmt':
+            logger.info('Using fdmt dedispersion with %d delays and imaging %d subbands' % (fdmtshape(d)[0], ds['nchan']))
 
         # open pool
-        with closing(mp.Pool(d['nthread'], initializer=initresamp, initargs=(data_mem, data_resamp_mem))) as resamppool:
-            for dmind in xrange(len(d['dmarr'])):
-                for dtind in xrange(len(d['dtarr'])):
+        with closing(mp.Pool(d['nthread'], initializer=initresamp, initargs=(data_mem, data_resamp_mem, data_sub_mem, gridops, gridops_coarse, subims_mem, gridops_sub, gridops_chanavg, fdmtcount_mem))) as resamppool:
+            blranges = [(d['nbl'] * t/d['nthread'], d['nbl']*(t+1)/d['nthread']) for t in range(d['nthread'])]
+
+            # fdmt makes all dms at once
+            if d['dedisptype'] == 'fdmt':
+                resamppool.map(partial(correct_fdmt, d), blranges)
+
+            for dmind in dmorder:     # with refine, fine dms are appended after last coarse dm
+                # first stage of subband dedispersion is shared by all dms in group
+                if (d['dedisptype'] in ['subband', 'image']) and (dmind in dmgroups):
+                    dmind0 = dmind
+                    logger.debug('Subband dedispersing for group starting at DM=%d' % d['dmarr'][dmind0])
+                    resamppool.map(partial(correct_subband, d, dmind0), blranges)
+
+                # image dedispersion searches all dms of group from one set of subband images
+                if d['dedisptype'] == 'image':
+                    if dmind == dmind0:
+                        dminds = range(dmind0, ([dmind1 for dmind1 in dmgroups if dmind1 > dmind0] + [len(d['dmarr'])])[0])
+                        for beamnum in xrange(len(gridops)):
+                            for imageresult in search_subimage(d, resamppool, plan, dminds, beamnum):
+                                collector.add(imageresult)
+                    continue
+
+                # folding makes one int per phase bin, so each dm is imaged once
+                if d['psrperiod']:
+                    bins = calc_psrbins(d, plan, dmind)
+                    resamppool.map(partial(correct_fold, d, dmind, bins), blranges)
+                    binints = [n.where(bins == b)[0].min() if n.any(bins == b) else -1 for b in xrange(d['psrnbins'])]
+                    foldranges = calc_foldranges(d)
+                    logger.info('Imaging %d phase bins folded at period %.4f s for DM=%d' % (d['psrnbins'], d['psrperiod'], d['dmarr'][dmind]))
+                    for beamnum in xrange(len(gridops)):
+                        imageresults = resamppool.map(partial(image1, ds, u, v, w, dmind, 0, beamnum), foldranges)
+                        for imageresult in imageresults:
+                            # int of cand is phase bin. locate it at first int of bin, so cand times are as usual.
+                            collector.add(dict(((segment, binints[i/d['dtarr'][0]], dmind1, dtind1, beamnum1), feat) for ((segment, i, dmind1, dtind1, beamnum1), feat) in imageresult.iteritems()))
+                    continue
+
+                # with dtimage, only dt=1 is dedispersed and imaged. images of other dts are sums of its images.
+                for dtind in xrange(1 if d['dtimage'] else len(d['dtarr'])):
+                    # fine dms of refinement are only searched around hits
+                    if refine and (dmind not in coarse) and (dtind not in calc_refinedtinds(d, dmind, refineints)):
+                        continue
+
+                    # trials with little smearing are imaged with averaged channels
+                    chanavg = d['chanavgfactors'][dmind][dtind] if d['chanavg'] > 1 else 1
+                    dtrial = chanavgstate(ds, chanavg) if chanavg > 1 else ds
+
                     # set partial functions for pool.map
-                    correctpart = partial(correct_dmdt, d, dmind, dtind)
-                    image1part = partial(image1, d, u, v, w, dmind, dtind, beamnum)
+                    if d['dtpyramid'] and (dtind > 0):
+                        correctpart = partial(correct_dt, ds, dtind)
+                    elif d['dedisptype'] == 'subband':
+                        correctpart = partial(correct_dmdt_subband, d, dmind, dtind, dmind0)
+                    elif d['dedisptype'] == 'fdmt':
+                        correctpart = partial(correct_dmdt_fdmt, d, dmind, dtind)
+                    elif chanavg > 1:
+                        correctpart = partial(correct_dmdt_chanavg, d, dmind, dtind, chanavg)
+                    else:
+                        correctpart = partial(correct_dmdt, d, dmind, dtind)
 
                     # dedispersion in shared memory, mapped over baselines
                     logger.debug('Dedispersing for (%d,%d)' % (d['dmarr'][dmind], d['dtarr'][dtind]),)
-                    blranges = [(d['nbl'] * t/d['nthread'], d['nbl']*(t+1)/d['nthread']) for t in range(d['nthread'])]
                     dedispresults = resamppool.map(correctpart, blranges)
 
-                    # set dm- and dt-dependent int ranges for segment
-                    nskip_dm = ((d['datadelay'][-1] - d['datadelay'][dmind]) / d['dtarr'][dtind]) * (d['segment'] != 0)  # nskip=0 for first segment
-                    searchints = (d['readints'] - d['datadelay'][dmind]) / d['dtarr'][dtind] - nskip_dm
-                    logger.info('Imaging %d ints from %d for (%d,%d)' % (searchints, nskip_dm, d['dmarr'][dmind], d['dtarr'][dtind]),)
+                    # dt pyramid needs lower dts of refined trial, but they are not imaged
+                    if refine and (dmind not in coarse) and ((dmind, dtind) not in refineints):
+                        continue
 
-                    # imaging in shared memory, mapped over ints
-                    irange = [(nskip_dm + searchints*chunk/d['nchunk'], nskip_dm + searchints*(chunk+1)/d['nchunk']) for chunk in range(d['nchunk'])]
-                    imageresults = resamppool.map(image1part, irange)
+                    if d['dtimage']:
+                        searchranges = [plan.searchrange(dmind, dtind1, d['segment']) for dtind1 in xrange(len(d['dtarr']))]
+                        irange = plan.dtimagerange(dmind, d['segment'])
+                        logger.info('Imaging %d ints for DM=%d and summing images for dt=%s' % (sum([i1-i0 for (i0, i1) in irange]), d['dmarr'][dmind], d['dtarr']))
+                        for beamnum in xrange(len(gridops)):
+                            imageresults = resamppool.map(partial(image1dt, ds, u, v, w, dmind, beamnum, searchranges), irange)
+                            for imageresult in imageresults:
+                                collector.add(imageresult)
+                        continue
 
-                    # COLLECTING THE RESULTS per dm/dt. Clears the way for overwriting data_resamp
-                    for imageresult in imageresults:
-                        for kk in imageresult.keys():
-                            cands[kk] = imageresult[kk]
+                    # dm- and dt-dependent int ranges for segment from plan
+                    nskip_dm, searchints = plan.searchrange(dmind, dtind, d['segment'])
+                    irange = plan.irange(dmind, dtind, d['segment'])
+
+                    # prefilter ranks ints of whole trial by power, so only the most promising are imaged
+                    if prefilter:
+                        prefilterresults = resamppool.map(partial(prefilter1, dtrial, dtind), irange)
+                        ints = n.concatenate([ints for (ints, blpower) in prefilterresults])
+                        imageints = calc_prefilterints(d, ints, n.concatenate([blpower for (ints, blpower) in prefilterresults]))
+                        d['imagecounts'][(dmind, dtind)] = (len(imageints), searchints)
+                        logger.info('Imaging %d of %d ints from %d for (%d,%d) after prefilter' % (len(imageints), searchints, nskip_dm, d['dmarr'][dmind], d['dtarr'][dtind]),)
+                    elif refine and (dmind not in coarse):
+                        imageints = refineints[(dmind, dtind)]
+                        d['imagecounts'][(dmind, dtind)] = (len(imageints), searchints)
+                        logger.info('Imaging %d of %d ints from %d for (%d,%d) around first pass hits' % (len(imageints), searchints, nskip_dm, d['dmarr'][dmind], d['dtarr'][dtind]),)
+                    else:
+                        imageints = None
+                        if refine:
+                            d['imagecounts'][(dmind, dtind)] = (searchints, searchints)
+                        logger.info('Imaging %d ints from %d for (%d,%d)%s' % (searchints, nskip_dm, d['dmarr'][dmind], d['dtarr'][dtind], ' with %d channels averaged' % chanavg if chanavg > 1 else ''),)
+
+                    for beamnum in xrange(len(gridops)):
+                        if d['searchtype'] == 'bispectrum':
+                            searchpart = partial(bispectrum1, ds, u, v, w, dmind, dtind, beamnum, triples)
+                        elif refine and (dmind in coarse):
+                            searchpart = partial(image1, dict(dtrial, sigma_image1=sigma_refine), u, v, w, dmind, dtind, beamnum)
+                        else:
+                            searchpart = partial(image1, dtrial, u, v, w, dmind, dtind, beamnum, ints=imageints)
+
+                        # imaging in shared memory, mapped over ints
+                        imageresults = resamppool.map(searchpart, irange)
+
+                        # COLLECTING THE RESULTS per dm/dt/beam. Clears the way for overwriting data_resamp
+                        for imageresult in imageresults:
+                            if refine and (dmind in coarse):    # all first pass cands are hits, but only those above sigma_image1 are kept
+                                hits += imageresult.keys()
+                                imageresult = dict([(candid, feat) for (candid, feat) in imageresult.iteritems() if abs(feat[snrcol]) > d['sigma_image1']])
+                            collector.add(imageresult)
+
+                # after last coarse dm, schedule fine dms around first pass hits
+                if refine and (dmind == coarse[-1]) and (len(dmorder) == len(coarse)):
+                    refineints = calc_refineints(d, plan, coarse, hits)
+                    dmorder += sorted(set([dmind1 for (dmind1, dtind1) in refineints]))
+                    logger.info('Refining %d first pass hits with %d of %d fine dms' % (len(hits), len(dmorder) - len(coarse), len(d['dmarr']) - len(coarse)))
 
     else:
         logger.warn('Data for processing is zeros. Moving on...')
 
-    logger.info('Found %d cands in scan %d segment %d of %s. ' % (len(cands), d['scan'], d['segment'], d['filename']))
-    return cands
+    d['candcounts'] = collector.counts
+    if collector.discarded:
+        logger.info('Discarded %d cands in %d (dm, dt) trials to stay within maxcands %d and maxcands_trial %d.' % (collector.discarded, len(collector.ndiscarded), d['maxcands'], d['maxcands_trial']))
+    logger.info('Found %d cands in scan %d segment %d of %s. ' % (len(collector), d['scan'], d['segment'], d['filename']))
+    return collector.cands
 
 def runreproduce(d, data_mem, data_resamp_mem, u, v, w, candint=-1, twindow=30):
     """ Reproduce function, much like search.
@@ -383,10 +610,10 @@ def runreproduce(d, data_mem, data_resamp_mem, u, v, w, candint=-1, twindow=30):
     with closing(mp.Pool(1, initializer=initresamp, initargs=(data_mem, data_resamp_mem))) as repropool:
         # dedisperse
         logger.info('Dedispersing with DM=%.1f, dt=%d...' % (d['dmarr'][dmind], d['dtarr'][dtind]))
-        repropool.apply(correct_dmdt, [d, dmind, dtind, (0,d['nbl'])])
+        repropool.apply(correct_dmdt_threaded, [d, dmind, dtind])
 
         # set up image
-        if d['searchtype'] == 'image1':
+        if d['searchtype'] in ['image1', 'bispectrum']:
             npixx = d['npixx']
             npixy = d['npixy']
         elif d['searchtype'] == 'image2':
@@ -408,8 +635,10 @@ def runreproduce(d, data_mem, data_resamp_mem, u, v, w, candint=-1, twindow=30):
 
             # rephase and trim interesting ints out
             repropool.apply(move_phasecenter, [d, l1, m1, u, v])
+            # window limited to ints fully dedispersed by plan
+            nskip_dm, searchints = dp.get_plan(d).searchrange(dmind, dtind, 0)
             minint = max(candint/d['dtarr'][dtind]-twindow/2, 0)
-            maxint = min(candint/d['dtarr'][dtind]+twindow/2, len(data_resamp)/d['dtarr'][dtind])
+            maxint = min(candint/d['dtarr'][dtind]+twindow/2, nskip_dm + searchints)
 
             return(im, data_resamp[minint:maxint].mean(axis=1))
         else:
@@ -498,11 +727,11 @@ def pipeline_lightcurve(d, l1=0, m1=0, segments=[], scan=-1):
     if scan == -1: scan = d['scan']
     if segments == []: segments = range(d['nsegments'])
 
-    d = set_pipeline(d['filename'], scan, fileroot=d['fileroot'], dmarr=[0], dtarr=[1], savenoise=False, timesub='', nologfile=True, nsegments=d['nsegments'])
+    d = set_pipeline(d['filename'], scan, fileroot=d['fileroot'], dmarr=[0], dtarr=[1], savenoise=False, timesub='', nologfile=True, nsegments=d['nsegments'], tlayout=False)
 
     # define memory and numpy arrays
     data_mem = mps.Array(mps.ctypes.c_float, datasize(d)*2)
-    data_read_mem = mps.Array(mps.ctypes.c_float, datasize(d)*2)
+    data_read_mem = mps.Array(mps.ctypes.c_float, readsize(d)*2)
     data_resamp_mem = mps.Array(mps.ctypes.c_float, datasize(d)*2)
     u_read_mem = mps.Array(mps.ctypes.c_float, d['nbl'])
     u_mem = mps.Array(mps.ctypes.c_float, d['nbl'])
@@ -510,11 +739,12 @@ def pipeline_lightcurve(d, l1=0, m1=0, segments=[], scan=-1):
     v_mem = mps.Array(mps.ctypes.c_float, d['nbl'])
     w_read_mem = mps.Array(mps.ctypes.c_float, d['nbl'])
     w_mem = mps.Array(mps.ctypes.c_float, d['nbl'])
-    data_read = numpyview(data_read_mem, 'complex64', datashape(d)) # optional
+    data_read = numpyview(data_read_mem, 'complex64', readshape(d)) # optional
     u_read = numpyview(u_read_mem, 'float32', d['nbl'], raw=False)
     v_read = numpyview(v_read_mem, 'float32', d['nbl'], raw=False)
     w_read = numpyview(w_read_mem, 'float32', d['nbl'], raw=False)
-    lightcurve = n.zeros(shape=(d['nints'], d['nchan'], d['npol']), dtype='complex64')
+    lightcurve = n.zeros(shape=(d['nints'], d['nchan'], len(d['pols'])), dtype='complex64')
+    plan = dp.get_plan(d)
 
     phasecenters = []
     with closing(mp.Pool(1, initializer=initread, initargs=(data_read_mem, u_read_mem, v_read_mem, w_read_mem, data_mem, u_mem, v_mem, w_mem))) as readpool:  
@@ -535,7 +765,8 @@ def pipeline_lightcurve(d, l1=0, m1=0, segments=[], scan=-1):
             phasecenters.append( (l2,m2) )
 
             nskip = (24*3600*(d['segmenttimes'][segment,0] - d['starttime_mjd'])/d['inttime']).astype(int)   # insure that lc is set as what is read
-            lightcurve[nskip: nskip+d['readints']] = data_read.mean(axis=1)
+            i0, nints = plan.searchrange(0, 0, segment)
+            lightcurve[nskip+i0: nskip+i0+nints] = data_read[i0:i0+nints].mean(axis=1)
 
     return phasecenters, lightcurve
 
@@ -635,6 +866,11 @@ def set_pipeline(filename, scan, fileroot='', paramfile='', **kwargs):
         d['features'] = ['snr1', 'immax1', 'l1', 'm1', 'specstd', 'specskew', 'speckurtosis', 'imskew', 'imkurtosis']  # note: spec statistics are all or nothing.
     elif 'image2' in d['searchtype']:
         d['features'] = ['snr1', 'immax1', 'l1', 'm1', 'snr2', 'immax2', 'l2', 'm2']   # features returned by image1
+    elif d['searchtype'] == 'bispectrum':
+        if d['bispec_image']:
+            d['features'] = ['snr1', 'immax1', 'l1', 'm1', 'snrbs']   # image1 features for ints passing bispectrum threshold
+        else:
+            d['features'] = ['snrbs', 'bamean']
     d['featureind'] = ['segment', 'int', 'dmind', 'dtind', 'beamnum']  # feature index. should be stable.
 
     # set imaging parameters to use
@@ -665,6 +901,11 @@ def set_pipeline(filename, scan, fileroot='', paramfile='', **kwargs):
         d['npixx'] = d['npix']
         d['npixy'] = d['npix']
 
+    # optional first pass of coarse-to-fine imaging
+    if d['npix_coarse']:
+        d['npixx_coarse'] = min(d['npix_coarse'], d['npixx'])
+        d['npixy_coarse'] = min(d['npix_coarse'], d['npixy'])
+
     # define dmarr, if not already
     if len(d['dmarr']) == 0:
         if d.has_key('dm_maxloss') and d.has_key('maxdm') and d.has_key('dm_pulsewidth'):
@@ -675,9 +916,19 @@ def set_pipeline(filename, scan, fileroot='', paramfile='', **kwargs):
             d['dmarr'] = [0]
             logger.info('Can\'t calculate dm grid without dm_maxloss, maxdm, and dm_pulsewidth defined. Setting to [0].')
 
+    # define subbands for subband, image or fdmt dedispersion
+    if d['dedisptype'] in ['subband', 'image']:
+        if d['nsubband'] == 0:
+            d['nsubband'] = int(round(n.sqrt(d['nchan'])))
+        d['subbands'] = rtlib.calc_subbands(d['nchan'], d['nsubband'])
+    elif d['dedisptype'] == 'fdmt':
+        if d['nsubband'] == 0:
+            d['nsubband'] = calc_fdmtnsubband(d, d['dm_maxloss'] if d.has_key('dm_maxloss') else 0.05)
+
     # define times for data to read
-    d['t_overlap'] = rtlib.calc_delay(d['freq'], d['inttime'], max(d['dmarr'])).max()*d['inttime']   # time of overlap for total dm coverage at segment boundaries
-    d['datadelay'] = [rtlib.calc_delay(d['freq'], d['inttime'],dm).max() for dm in d['dmarr']]
+    delaytable = dp.calc_delaytable(d['freq'], d['inttime'], d['dmarr'])
+    d['t_overlap'] = delaytable.max()*d['inttime']   # time of overlap for total dm coverage at segment boundaries
+    d['datadelay'] = list(delaytable.max(axis=1))
     d['nints'] = d['nints'] - d['nskip']
 
     # pols
@@ -685,7 +936,11 @@ def set_pipeline(filename, scan, fileroot='', paramfile='', **kwargs):
         d['pols'] = [pol for pol in d['pols_orig'] if pol in d['selectpol']]
     else:
         d['pols'] = d['pols_orig']
-    d['npol'] = len(d['pols'])
+    if d['stokesi']:   # pols are read, calibrated and flagged separately, then averaged
+        assert len(stokesipols(d)), 'stokesi requires a parallel-hand pol in %s' % d['pols']
+        d['npol'] = 1
+    else:
+        d['npol'] = len(d['pols'])
 
     # split imaging into chunks. ideally one per thread, but can modify to fit available memory
     if d['nchunk'] == 0:
@@ -711,6 +966,31 @@ def set_pipeline(filename, scan, fileroot='', paramfile='', **kwargs):
 
     # scaling of number of integrations beyond dt=1
     assert all(d['dtarr']), 'dtarr must be larger than 0'
+    if d['dtpyramid']:
+        assert all([d['dtarr'][i] % d['dtarr'][i-1] == 0 for i in range(1, len(d['dtarr']))]), 'dtpyramid requires each dt to be a multiple of the one before'
+    if d['tlayout']:
+        assert d['dedisptype'] == 'brute', 'tlayout only supported for brute dedisptype'
+        assert not d['stokesi'], 'tlayout does not support stokesi'
+    if d['beams']:
+        assert d['searchtype'] == 'image1', 'beams only supported for image1 searchtype'
+    if d['dtimage']:
+        assert d['searchtype'] == 'image1', 'dtimage only supported for image1 searchtype'
+        assert (d['dtarr'][0] == 1) and all([d['dtarr'][i] % d['dtarr'][i-1] == 0 for i in range(1, len(d['dtarr']))]), 'dtimage requires dtarr to start with 1 and each dt to be a multiple of the one before'
+        assert not (d['sigma_prefilter'] or d['prefilter_topk'] or d['npix_coarse'] or d['savepeaks']), 'dtimage does not support prefilter, npix_coarse or savepeaks'
+    if d['chanavg'] > 1:
+        assert (d['searchtype'] == 'image1') and (d['dedisptype'] == 'brute'), 'chanavg only supported for image1 searchtype and brute dedisptype'
+        assert not (d['dtpyramid'] or d['dtimage'] or d['tlayout'] or d['npix_coarse']), 'chanavg does not support dtpyramid, dtimage, tlayout or npix_coarse'
+        d['chanavgfactors'] = [[calc_chanavg(d)]*len(d['dtarr']) for dmind in xrange(len(d['dmarr']))]   # channels averaged per (dmind, dtind)
+    if d['dm_refineloss']:
+        assert (d['searchtype'] == 'image1') and (d['dedisptype'] == 'brute'), 'dm_refineloss only supported for image1 searchtype and brute dedisptype'
+        assert not (d['sigma_prefilter'] or d['prefilter_topk'] or d['savepeaks'] or d['dtimage'] or d['psrperiod']), 'dm_refineloss does not support prefilter, savepeaks, dtimage or psrperiod'
+    if d['psrperiod']:
+        assert (d['searchtype'] == 'image1') and (d['dedisptype'] == 'brute'), 'psrperiod only supported for image1 searchtype and brute dedisptype'
+        assert not (d['sigma_prefilter'] or d['prefilter_topk'] or d['savepeaks'] or d['dtimage'] or d['dtpyramid'] or d['tlayout']), 'psrperiod does not support prefilter, savepeaks, dtimage, dtpyramid or tlayout'
+        assert d['psrnbins'] <= d['readints'], 'psrnbins must be no larger than readints'
+    if d['dedisptype'] == 'image':
+        assert d['searchtype'] == 'image1', 'image dedisptype only supported for image1 searchtype'
+        assert not (d['sigma_prefilter'] or d['prefilter_topk'] or d['npix_coarse'] or d['savepeaks'] or d['dtimage'] or d['dtpyramid']), 'image dedisptype does not support prefilter, npix_coarse, savepeaks, dtimage or dtpyramid'
 
     # calculate number of thermal noise candidates per segment
     nfalse = calc_nfalse(d)
@@ -727,13 +1007,45 @@ def set_pipeline(filename, scan, fileroot='', paramfile='', **kwargs):
     logger.info('\t Downsampling in time/freq by %d/%d and skipping %d ints from start of scan.' % (d['read_tdownsample'], d['read_fdownsample'], d['nskip']))
     logger.info('\t Excluding ants %s' % (d['excludeants']))
     logger.info('\t Using pols %s' % (d['pols']))
+    if d['stokesi']:
+        logger.info('\t\t Averaging pols %s to Stokes I after flagging. Search uses 1 pol.' % [d['pols'][i] for i in stokesipols(d)])
     logger.info('')
 
-    logger.info('\t Search with %s and threshold %.1f.' % (d['searchtype'], d['sigma_image1']))
+    if (d['sigma_prefilter'] or d['prefilter_topk']) and (d['searchtype'] == 'image1'):
+        logger.info('\t Imaging only ints passing prefilter with sigma_prefilter=%.1f and prefilter_topk=%d.' % (d['sigma_prefilter'], d['prefilter_topk']))
+    if d['searchtype'] == 'bispectrum':
+        logger.info('\t Search with bispectrum threshold %.1f%s.' % (d['sigma_bispec'], ' and image threshold %.1f' % d['sigma_image1'] if d['bispec_image'] else ''))
+    else:
+        logger.info('\t Search with %s and threshold %.1f.' % (d['searchtype'], d['sigma_image1']))
+    if d['dtimage']:
+        logger.info('\t Imaging dt=1 only and making images of dt=%s by summing its images.' % d['dtarr'])
+    if d['chanavg'] > 1:
+        chanavgs = [chanavg for chanavgs1 in d['chanavgfactors'] for chanavg in chanavgs1]
+        logger.info('\t Averaging up to %d channels per (DM, dt) trial with bandwidth smearing loss at field edge within %.2f. Gridding %.0f%% of channels over all trials.' % (max(chanavgs), d['dm_maxloss'], 100*n.mean([1./chanavg for chanavg in chanavgs])))
+    if d['dm_refineloss']:
+        logger.info('\t Refining DM: first pass searches %d of %d DMs (max loss %.2f) at threshold %.1f. Other DMs only around its hits.' % (len(calc_dmrefine(d)), len(d['dmarr']), d['dm_refineloss'], d['sigma_image1']*(1 - d['dm_refineloss'])))
+    if d['psrperiod']:
+        logger.info('\t Folding at period %.4f s and imaging %d phase bins per segment. Only dt=%d is used.' % (d['psrperiod'], d['psrnbins'], d['dtarr'][0]))
+    if d['dedisptype'] == 'image':
+        logger.info('\t Imaging %d subbands per group of DMs and making images of each (DM, dt) by summing shifted subband images.' % (len(d['subbands'])-1))
     logger.info('\t Using %d DMs from %.1f to %.1f and dts %s.' % (len(d['dmarr']), min(d['dmarr']), max(d['dmarr']), d['dtarr']))
+    if d['dedisptype'] == 'fdmt':
+        bands = rtlib.calc_fdmtbands(d['nchan'], d['nsubband'])[-1]
+        fracbw = max([(d['freq'][k1-1] - d['freq'][k0] + abs(d['freq'][1] - d['freq'][0]))/d['freq'][k0:k1].mean() for (k0, k1) in bands])
+        logger.info('\t fdmt with %d subbands loses %.1f%% of sensitivity at phase center for pulses of 1 int. Subbands up to %.1f%% fractional bandwidth are imaged at their mean frequency, so loss is larger off axis. More subbands reduce both.' % (len(bands), 100*calc_fdmtloss(d), 100*fracbw))
+    logger.info('\t Dedispersing with %s algorithm%s%s.' % (d['dedisptype'], ' and dt pyramid'*d['dtpyramid'], ' on time-contiguous data'*d['tlayout']))
     logger.info('\t Using uvgrid npix=(%d,%d) and res=%d.' % (d['npixx'], d['npixy'], d['uvres']))
+    if d['beams']:
+        logger.info('\t Searching %d beams centered at (l, m) from (%.4f, %.4f) to (%.4f, %.4f).' % (len(d['beams']), min([l for (l, m) in d['beams']]), min([m for (l, m) in d['beams']]), max([l for (l, m) in d['beams']]), max([m for (l, m) in d['beams']])))
+    if d['npix_coarse']:
+        logger.info('\t First imaging pass with npix=(%d,%d)%s.' % (d['npixx_coarse'], d['npixy_coarse'], ' and uv distance below %.1f' % d['uvmax_coarse'] if d['uvmax_coarse'] else ''))
+    logger.info('\t Imaging %d ints per %s fft with %d thread%s.' % (d['fftbatch'], ['complex', 'c2r'][d['fftc2r']], d['fftthreads'], 's'[:d['fftthreads']-1]))
     logger.info('\t Expect %d thermal false positives per segment.' % nfalse)
 
+    # subband image cube is made in time blocks that fit in memory
+    if d['dedisptype'] == 'image':
+        d['subimage_ints'] = calc_subimage_ints(d)
+
     (vismem, immem) = calc_memory_footprint(d)
     if d.has_key('memory_limit'):    # if preference given, then test
         assert vismem < d['memory_limit'], 'Visibility reading requires %d GB, but memory limit is %d GB. Try forcing nsegments to value larger than %d.' % (vismem, d['memory_limit'], d['nsegments'])
@@ -748,8 +1060,14 @@ def set_pipeline(filename, scan, fileroot='', paramfile='', **kwargs):
     logger.info('')
     logger.info('\t Visibility memory usage is %.1f GB/segment' % vismem)
     logger.info('\t Imaging in %d chunk%s using max of %.1f GB/segment' % (d['nchunk'], "s"[not d['nsegments']-1:], immem))
+    if d['dedisptype'] == 'image':
+        logger.info('\t Subband image cube of %d ints per block of %d ints uses %.1f GB' % (subimageshape(d)[1], d['subimage_ints'], subimagesize(d)*4/1024.**3))
     logger.info('\t Grand total memory usage: %d GB/segment' % (vismem + immem))
 
+    # make (or read cached) dedispersion plan for final readints and nchunk
+    plan = dp.get_plan(d)
+    logger.debug('Using %s cached in %s' % (plan, dp.getplanfile(d)))
+
     return d
 
 def getcandsfile(d, segment=-1):
@@ -772,6 +1090,69 @@ def getnoisefile(d, segment=-1):
     else:
         return ''
 
+def getpeaksfile(d, segment=-1):
+    """ Return name of peaks file (see peaksshape) for a given dictionary. Must have d['segment'] defined.
+    """
+    if d.has_key('segment'):
+        return os.path.join(d['workdir'], 'peaks_' + d['fileroot'] + '_sc' + str(d['scan']) + 'seg' + str(d['segment']) + '.npy')
+    elif segment >= 0:
+        return os.path.join(d['workdir'], 'peaks_' + d['fileroot'] + '_sc' + str(d['scan']) + 'seg' + str(segment) + '.npy')
+    else:
+        return ''
+
+def calc_foldranges(d):
+    """ Returns list of (i0, i1) ranges of phase bins, one per imaging chunk, for folded data (psrperiod).
+    """
+
+    foldranges = [(d['psrnbins']*chunk/d['nchunk'], d['psrnbins']*(chunk+1)/d['nchunk']) for chunk in xrange(d['nchunk'])]
+    return [(i0, i1) for (i0, i1) in foldranges if i0 < i1]
+
+def calc_fftbatches(d, plan):
+    """ Returns sorted list of fft batch sizes used by imaging chunks of segment, so plans for all can be made before workers start.
+    Imaging uses batch of min(fftbatch, ints in chunk), so chunks shorter than fftbatch (e.g., for large dt) need their own plan.
+    """
+
+    if d['psrperiod']:
+        ranges = calc_foldranges(d)
+    elif d['dtimage']:
+        ranges = [irange for dmind in xrange(len(d['dmarr'])) for irange in plan.dtimagerange(dmind, d['segment'])]
+    elif d['dedisptype'] == 'image':
+        dmgroups = calc_dmgroups(d) + [len(d['dmarr'])]
+        ranges = [(edges[chunk], edges[chunk+1]) for g in xrange(len(dmgroups)-1) for (b0, b1, edges) in calc_subimageblocks(d, plan, range(dmgroups[g], dmgroups[g+1]))
+                  for chunk in xrange(d['nchunk']) if edges[chunk] < edges[chunk+1]]
+    else:
+        ranges = [irange for dmind in xrange(len(d['dmarr'])) for dtind in xrange(len(d['dtarr'])) for irange in plan.irange(dmind, dtind, d['segment'])]
+
+    return sorted(set([max(1, min(d['fftbatch'], i1-i0)) for (i0, i1) in ranges]))
+
+def getwisdomfile(d):
+    """ Return name of file with FFTW wisdom for imaging in workdir.
+    """
+
+    return os.path.join(d['workdir'], 'fftw_wisdom.pkl')
+
+def calc_coarse(d, gridop, gridop_coarse):
+    """ Returns copy of state dict with threshold for first pass of coarse-to-fine imaging.
+    Point source snr in first pass is lower by sqrt of fraction of visibilities it grids, so sigma_coarse of 0 scales sigma_image1 that way.
+    Logs full-resolution snr needed to pass first pass (the threshold loss) and fraction of noise ints expected to be imaged again.
+    """
+
+    nvis = (gridop[3] < 2).sum()
+    nvis_coarse = (gridop_coarse[3] < 2).sum()
+    assert nvis_coarse > 0, 'No visibilities in first pass with npix_coarse %d and uvmax_coarse %.1f' % (d['npix_coarse'], d['uvmax_coarse'])
+    visfrac = float(nvis_coarse)/nvis
+
+    dc = d.copy()
+    if dc['sigma_coarse'] == 0:
+        dc['sigma_coarse'] = d['sigma_image1']*n.sqrt(visfrac)
+    sigma_full = dc['sigma_coarse']/n.sqrt(visfrac)
+    qfrac = 1 - erf(dc['sigma_coarse']/n.sqrt(2))    # for max or min
+    reimagefrac = min(1., qfrac*d['npixx_coarse']*d['npixy_coarse'])
+
+    logger.info('First pass grids %.2f of visibilities at npix=(%d,%d) with threshold %.1f.' % (visfrac, d['npixx_coarse'], d['npixy_coarse'], dc['sigma_coarse']))
+    logger.info('Passing first pass needs SNR %.1f at full resolution (threshold loss %.1f) and %.3f of noise ints will be imaged again.' % (sigma_full, max(0., sigma_full - d['sigma_image1']), reimagefrac))
+    return dc
+
 def calc_nfalse(d):
     """ Calculate the number of thermal-noise false positives per segment.
     """
@@ -809,13 +1190,44 @@ def calc_memory_footprint(d, headroom=4., visonly=False):
 
     toGB = 8/1024.**3   # number of complex64s to GB
 
+    if d['dedisptype'] in ['subband', 'image']:   # extra copy for first stage of subband dedispersion
+        headroom += 1
+    elif d['dedisptype'] == 'fdmt':   # fdmt output for all delays and uint16 counts of unflagged visibilities
+        headroom += 1.25*fdmtsize(d)/float(datasize(d))
+    if d['dtpyramid']:   # data_resamp holds every dt
+        headroom += resampsize(d)/float(datasize(d)) - 1
+    if d['tlayout']:   # copy made while transposing in dataprep
+        headroom += 1
+    if d.has_key('stokesi') and d['stokesi']:   # data_read keeps all pols
+        headroom += readsize(d)/float(datasize(d)) - 1
+
     vismem = headroom * datasize(d) * toGB
     if visonly:
         return vismem
     else:
         immem = d['nthread'] * (d['readints']/d['nchunk'] * d['npixx'] * d['npixy']) * toGB
+        if d.has_key('dtimage') and d['dtimage']:   # float32 running sum image per dt
+            immem += d['nthread'] * (len(d['dtarr']) * d['npixx'] * d['npixy']) * toGB/2
+        if d.has_key('subimage_ints'):   # float32 subband image cube
+            immem += subimagesize(d) * toGB/2
         return (vismem, immem)
 
+def calc_subimage_ints(d):
+    """ Memory planner for image dedisptype. Returns number of dt=1 ints per time block of subband image cube (see subimageshape).
+    Block is whole segment, unless memory_limit is exceeded. Then it is halved in multiples of max(dtarr) until cube fits.
+    Cube also has ints for max dm delay after block, which are imaged again for next block.
+    """
+
+    maxdt = max(d['dtarr'])
+    ds = d.copy()
+    ds['subimage_ints'] = maxdt*int(n.ceil(d['readints']/float(maxdt)))
+    if d.has_key('memory_limit'):
+        while (sum(calc_memory_footprint(ds)) > d['memory_limit']) and (ds['subimage_ints'] > maxdt):
+            ds['subimage_ints'] = maxdt*max(1, ds['subimage_ints']/maxdt/2)
+        if ds['subimage_ints'] < d['readints']:
+            logger.info('Subband image cube limited to blocks of %d ints to fit in %d GB memory limit.' % (ds['subimage_ints'], d['memory_limit']))
+    return ds['subimage_ints']
+
 def calc_fringetime(d):
     """ Estimate largest time span of a "segment".
     A segment is the maximal time span that can be have a single bg fringe subtracted and uv grid definition.
@@ -828,20 +1240,201 @@ def calc_fringetime(d):
     return fringetime
 
 def correct_dmdt(d, dmind, dtind, blrange):
-    """ Dedisperses and resamples data *in place*.
+    """ Dedisperses and resamples data into data_resamp.
     Drops edges, since it assumes that data is read with overlapping chunks in time.
     """
 
+    data_resamp = resampview(d, dtind)
+    if d.has_key('tlayout') and d['tlayout']:
+        # reads time-contiguous data and writes data_resamp in usual shape
+        datat = numpyview(data_mem, 'complex64', datashape_t(d))
+        rtlib.dedisperse_resample_t(datat, data_resamp, d['freq'], d['inttime'], d['dmarr'][dmind], d['dtarr'][dtind], blrange)
+    else:
+        data = numpyview(data_mem, 'complex64', datashape(d))
+        rtlib.dedisperse_resample_blocks(data, data_resamp, d['freq'], d['inttime'], d['dmarr'][dmind], d['dtarr'][dtind], blrange)        # dedisperses data.
+
+def correct_dmdt_threaded(d, dmind, dtind):
+    """ Dedisperses and resamples all baselines with a pool of d['nthread'] threads.
+    Dedispersion kernels release the GIL, so this parallelizes within a single process.
+    """
+
+    blranges = [(d['nbl'] * t/d['nthread'], d['nbl']*(t+1)/d['nthread']) for t in range(d['nthread'])]
+    with closing(ThreadPool(d['nthread'])) as threadpool:
+        threadpool.map(partial(correct_dmdt, d, dmind, dtind), blranges)
+
+def correct_dmdt_chanavg(d, dmind, dtind, chanavg, blrange):
+    """ Dedisperses and resamples data and averages groups of chanavg adjacent channels into data_resamp.
+    data_resamp has shape of chanavgstate.
+    """
+
     data = numpyview(data_mem, 'complex64', datashape(d))
-    data_resamp = numpyview(data_resamp_mem, 'complex64', datashape(d))
-    bl0,bl1 = blrange
-    data_resamp[:, bl0:bl1] = data[:, bl0:bl1]
-    rtlib.dedisperse_resample(data_resamp, d['freq'], d['inttime'], d['dmarr'][dmind], d['dtarr'][dtind], blrange, verbose=0)        # dedisperses data.
+    rtlib.dedisperse_resample_chanavg(data, resampview(chanavgstate(d, chanavg), dtind), d['freq'], d['inttime'], d['dmarr'][dmind], d['dtarr'][dtind], chanavg, blrange)
+
+def calc_chanavg(d):
+    """ Returns number of adjacent channels averaged for (dm, dt) trials, for chanavg > 1.
+    Largest power of 2 up to chanavg that divides nchan and whose added bandwidth smearing loss at field edge (calc_bwsmearloss, relative to single channels) is within dm_maxloss.
+    Averaging follows exact dedispersion, so it adds no time smearing and factor is the same for every trial.
+    """
+
+    chanwidth = abs(d['freq'][1] - d['freq'][0])
+    chanavg = 1
+    while (2*chanavg <= d['chanavg']) and (d['nchan'] % (2*chanavg) == 0) and (1 - (1 - calc_bwsmearloss(d, 2*chanavg*chanwidth))/(1 - calc_bwsmearloss(d, chanwidth)) <= d['dm_maxloss']):
+        chanavg *= 2
+    return chanavg
+
+def calc_bwsmearloss(d, chanwidth):
+    """ Returns fractional loss of peak flux from bandwidth smearing of source at edge of field, for channels of width chanwidth (GHz) at lowest freq.
+    Uses square bandpass and gaussian beam (Bridle & Schwab 1999). Field edge is 1/(2*uvres) from center and beam is uvoversample/(npix*uvres),
+    so radial smearing is chanwidth/freq*npix/(2*uvoversample) beams.
+    """
+
+    smear = (chanwidth/min(d['freq'])) * max(d['npixx'], d['npixy'])/(2.*d['uvoversample'])
+    return 1 - 1.0645*erf(0.8326*smear)/smear
+
+def chanavgstate(d, chanavg):
+    """ Returns copy of state dict that describes data_resamp with groups of chanavg adjacent channels averaged.
+    Imaging grids each averaged channel at its mean frequency.
+    """
+
+    ds = d.copy()
+    ds['freq'] = n.array(d['freq'], dtype='float32').reshape(d['nchan']/chanavg, chanavg).mean(axis=1)
+    ds['nchan'] = d['nchan']/chanavg
+    ds['chanavgfactor'] = chanavg
+    return ds
+
+def correct_fold(d, dmind, bins, blrange):
+    """ Dedisperses data and folds it into first ints of data_resamp, one per phase bin in bins (as from calc_psrbins).
+    """
+
+    data = numpyview(data_mem, 'complex64', datashape(d))
+    rtlib.dedisperse_fold(data, resampview(d, 0), d['freq'], d['inttime'], d['dmarr'][dmind], bins, blrange)
+
+def calc_psrbins(d, plan, dmind):
+    """ Returns phase bin of each int of segment for folding at psrperiod into psrnbins bins.
+    Phase is zero at start of first segment, so bins line up across segments. Phase of int is at its middle, so it is not on bin edge when period is a multiple of inttime. Ints outside search range of dm for first dt are -1.
+    """
+
+    nskip_dm, searchints = [d['dtarr'][0]*i for i in plan.searchrange(dmind, 0, d['segment'])]
+    times = 24*3600*(d['segmenttimes'][d['segment'], 0] - d['segmenttimes'][0, 0]) + d['inttime']*(n.arange(d['readints']) + 0.5)   # middle of int, as in parsecands.make_psrprofile
+    bins = (n.mod(times/d['psrperiod'], 1.)*d['psrnbins']).astype(n.int32) % d['psrnbins']
+    bins[:nskip_dm] = -1
+    bins[nskip_dm+searchints:] = -1
+    return bins
+
+def correct_dt(d, dtind, blrange):
+    """ Builds level of dt pyramid for dtind by resampling level dtind-1 of data_resamp.
+    Assumes previous level is dedispersed for same dm.
+    """
+
+    rtlib.resample_pyramid(resampview(d, dtind-1), resampview(d, dtind), d['dtarr'][dtind]/d['dtarr'][dtind-1], blrange)
+
+def correct_subband(d, dmind, blrange):
+    """ First stage of subband dedispersion. Shifts channels within each subband from data into data_sub.
+    Only needed once per group of dms defined by calc_dmgroups.
+    """
+
+    data = numpyview(data_mem, 'complex64', datashape(d))
+    data_sub = numpyview(data_sub_mem, 'complex64', datashape(d))
+    intradelay, subdelay, err = rtlib.calc_subdelay(d['freq'], d['inttime'], d['dmarr'][dmind], d['subbands'])
+    rtlib.dedisperse_subband1(data, data_sub, intradelay, blrange)
+
+def correct_dmdt_subband(d, dmind, dtind, dmind0, blrange):
+    """ Second stage of subband dedispersion. Shifts subbands of data_sub and resamples into data_resamp.
+    dmind0 is first dm of group used to make data_sub.
+    Produces same data_resamp as correct_dmdt when subbandtol=0.
+    """
+
+    data_sub = numpyview(data_sub_mem, 'complex64', datashape(d))
+    data_resamp = resampview(d, dtind)
+    intradelay, subdelay0, err = rtlib.calc_subdelay(d['freq'], d['inttime'], d['dmarr'][dmind0], d['subbands'])
+    intradelay, subdelay, err = rtlib.calc_subdelay(d['freq'], d['inttime'], d['dmarr'][dmind], d['subbands'], intradelay)
+    rtlib.dedisperse_subband2(data_sub, data_resamp, d['subbands'], subdelay, intradelay, d['dtarr'][dtind], blrange)
+
+def correct_fdmt(d, blrange):
+    """ Fast dispersion measure transform of data for baselines in blrange.
+    Output in data_sub has all delays up to max(dmarr) and is shared by all dm trials.
+    Number of unflagged visibilities in each sum goes to fdmtcount_mem.
+    """
+
+    data = numpyview(data_mem, 'complex64', datashape(d))
+    data_fdmt = numpyview(data_sub_mem, 'complex64', fdmtshape(d))
+    data_count = numpyview(fdmtcount_mem, 'uint16', fdmtshape(d))
+    rtlib.fdmt(data, data_fdmt, d['freq'], d['inttime'], max(d['dmarr']), d['nsubband'], blrange, data_count)
+
+def correct_dmdt_fdmt(d, dmind, dtind, blrange):
+    """ Extracts single dm from fdmt output into data_resamp and resamples.
+    data_resamp has subbands as channels, as defined by fdmtstate.
+    """
+
+    ds = fdmtstate(d)
+    data_fdmt = numpyview(data_sub_mem, 'complex64', fdmtshape(d))
+    data_count = numpyview(fdmtcount_mem, 'uint16', fdmtshape(d))
+    data_resamp = resampview(ds, dtind)
+    rtlib.fdmt_extract(data_fdmt, data_resamp, d['freq'], d['inttime'], max(d['dmarr']), d['dmarr'][dmind], d['nsubband'], blrange, data_count)
+    if d['dtarr'][dtind] > 1:
+        rtlib.dedisperse_resample(data_resamp, ds['freq'], d['inttime'], 0, d['dtarr'][dtind], blrange)
+
+def fdmtstate(d):
+    """ Returns copy of state dict that describes subband visibilities extracted from fdmt.
+    Imaging grids each subband at its mean frequency.
+    """
+
+    bands = rtlib.calc_fdmtbands(d['nchan'], d['nsubband'])[-1]
+    ds = d.copy()
+    ds['freq'] = n.array([d['freq'][k0:k1].mean() for (k0, k1) in bands], dtype='float32')
+    ds['nchan'] = len(bands)
+    return ds
+
+def calc_fdmtloss(d):
+    """ Estimates fractional sensitivity loss of fdmt dedispersion for pulse of one int at phase center.
+    Channels whose fdmt delay (rtlib.calc_fdmtoffsets) is not the exact delay miss the pulse. Loss is mean over dmarr.
+    Does not include smearing off axis from imaging each subband at its mean frequency.
+    """
+
+    loss = []
+    for dm in d['dmarr']:
+        offsets = rtlib.calc_fdmtoffsets(d['freq'], d['inttime'], max(d['dmarr']), d['nsubband'], dm)
+        loss.append(n.mean(offsets != rtlib.calc_delay(d['freq'], d['inttime'], dm)))
+    return n.mean(loss)
+
+def calc_fdmtnsubband(d, maxloss):
+    """ Returns smallest nsubband for fdmt whose loss from calc_fdmtloss is within maxloss.
+    Fewer subbands image faster, but have more levels of merging and so more rounding of delays.
+    """
+
+    for nsubband in sorted(set([len(bands) for bands in rtlib.calc_fdmtbands(d['nchan'], 1)])):
+        if calc_fdmtloss(dict(d, nsubband=nsubband)) <= maxloss:
+            break
+    return nsubband
+
+def fdmtshape(d):
+    bands = rtlib.calc_fdmtbands(d['nchan'], d['nsubband'])[-1]
+    ndelay = sum([rtlib.calc_fdmtndelay(d['freq'], d['inttime'], max(d['dmarr']), band) for band in bands])
+    return (ndelay, d['readints'], d['nbl'], d['npol'])
+
+def fdmtsize(d):
+    return long(n.prod(fdmtshape(d)))
+
+def calc_dmgroups(d):
+    """ Helper function to group dmarr for subband dedispersion.
+    Neighboring dms share first stage of dedispersion if channel delays are within subbandtol ints of exact.
+    Returns list of dminds that start a new group.
+    """
+
+    dmgroups = []
+    for dmind in xrange(len(d['dmarr'])):
+        if dmgroups:
+            intradelay, subdelay, err = rtlib.calc_subdelay(d['freq'], d['inttime'], d['dmarr'][dmind], d['subbands'], intradelay0)
+        if (not dmgroups) or (err > d['subbandtol']):
+            intradelay0, subdelay, err = rtlib.calc_subdelay(d['freq'], d['inttime'], d['dmarr'][dmind], d['subbands'])
+            dmgroups.append(dmind)
+    return dmgroups
 
 def calc_lm(d, im, pix=(), minmax='max'):
     """ Helper function to calculate location of image pixel in (l,m) coords.
     Assumes peak pixel, but input can be provided in pixel units.
     minmax defines whether to look for image maximum or minimum.
+    If pix is provided, im can be image shape instead of image.
     """
 
     if len(pix) == 0:  # default is to get pixel from image
@@ -853,11 +1446,22 @@ def calc_lm(d, im, pix=(), minmax='max'):
     elif len(pix) == 2:   # can also specify
         peakl, peakm = pix
 
-    npixx, npixy = im.shape
+    npixx, npixy = n.shape(im) if len(n.shape(im)) == 2 else im
     l1 = (npixx/2. - peakl)/(npixx*d['uvres'])
     m1 = (npixy/2. - peakm)/(npixy*d['uvres'])
     return l1, m1
 
+def calc_candspectra(d, data_resamp, ints, lm, u, v, halfwindow=0):
+    """ Returns spectra of candidates at ints of data_resamp with (l1, m1) locations in lm, as from rtlib.calc_spectra.
+    Window of each candidate is halfwindow ints before and after it, limited to data_resamp, or just its int for halfwindow 0.
+    Returns (spec, nvalid, windows), where windows has (first, last+1) int of each window.
+    """
+
+    windows = n.array([(max(0, i-halfwindow), min(i + max(halfwindow, 1), len(data_resamp))) for i in ints], dtype=n.int32).reshape(len(ints), 2)
+    dlm = n.array([(l1 - d['l0'], m1 - d['m0']) for (l1, m1) in lm], dtype=n.float32).reshape(len(ints), 2)
+    spec, nvalid = rtlib.calc_spectra(data_resamp, windows, dlm, u, v, (d['freq']/d['freq_orig'][0]).astype(n.float32))
+    return spec, nvalid, windows
+
 def move_phasecenter(d, l1, m1, u, v):
     """ Handler function for phaseshift_threaded
     """
@@ -865,11 +1469,44 @@ def move_phasecenter(d, l1, m1, u, v):
     data_resamp = numpyview(data_resamp_mem, 'complex64', datashape(d))
     rtlib.phaseshift_threaded(data_resamp, d, l1, m1, u, v)
 
+def calc_beamgrid(d, nbeamx, nbeamy):
+    """ Returns list of (l, m) beam centers for nbeamx by nbeamy image fields tiled around phase center.
+    Image field is 1/uvres wide, so neighboring beams are that far apart. Can be used as beams parameter.
+    """
+
+    field = 1./d['uvres']
+    return [(d['l0'] + field*(i - (nbeamx-1)/2.), d['m0'] + field*(j - (nbeamy-1)/2.)) for i in range(nbeamx) for j in range(nbeamy)]
+
 def calc_dmgrid(d, maxloss=0.05, dt=3000., mindm=0., maxdm=0.):
     """ Function to calculate the DM values for a given maximum sensitivity loss.
     maxloss is sensitivity loss tolerated by dm bin width. dt is assumed pulse width in microsec.
     """
 
+    loss = lambda dm, ddm: calc_dmloss(d, dm, ddm, dt)
+
+    if maxdm == 0:
+        return [0]
+    else:
+        # iterate over dmgrid to find optimal dm values. go higher than maxdm to be sure final list includes full range.
+        # each step evaluates loss relative to last dm for all higher dms and jumps to first that exceeds maxloss
+        dmgrid = n.arange(mindm, maxdm, 0.05)
+        dmgrid_final = [dmgrid[0]]
+        i = 0
+        while i < len(dmgrid)-1:
+            ll = loss(dmgrid[i+1:], (dmgrid[i+1:] - dmgrid[i])/2.)
+            over = n.where(ll > maxloss)[0]
+            if not len(over):
+                break
+            i = i + 1 + over[0]
+            dmgrid_final.append(dmgrid[i])
+
+    return dmgrid_final
+
+def calc_dmloss(d, dm, ddm, dt=3000.):
+    """ Returns sensitivity loss of pulse at dm searched at dm offset by ddm.
+    dt is assumed pulse width in microsec.
+    """
+
     # parameters
     tsamp = d['inttime']*1e6  # in microsec
     k = 8.3
@@ -878,42 +1515,143 @@ def calc_dmgrid(d, maxloss=0.05, dt=3000., mindm=0., maxdm=0.):
     ch = 1e3*(d['freq'][1] - d['freq'][0])  # channel width in MHz
 
     # width functions and loss factor
-    dt0 = lambda dm: n.sqrt(dt**2 + tsamp**2 + ((k*dm*ch)/(freq**3))**2)
-    dt1 = lambda dm, ddm: n.sqrt(dt**2 + tsamp**2 + ((k*dm*ch)/(freq**3))**2 + ((k*ddm*bw)/(freq**3.))**2)
-    loss = lambda dm, ddm: 1-n.sqrt(dt0(dm)/dt1(dm,ddm))
+    dt0 = n.sqrt(dt**2 + tsamp**2 + ((k*dm*ch)/(freq**3))**2)
+    dt1 = n.sqrt(dt**2 + tsamp**2 + ((k*dm*ch)/(freq**3))**2 + ((k*ddm*bw)/(freq**3.))**2)
+    return 1-n.sqrt(dt0/dt1)
 
-    if maxdm == 0:
-        return [0]
+def calc_dmrefine(d):
+    """ Returns dminds of coarse subset of dmarr searched in first pass of dm refinement.
+    Each next coarse dm is the last one with loss of at most dm_refineloss for pulses between it and the previous one. First and last dm are always included.
+    """
+
+    coarse = [0]
+    for dmind in xrange(1, len(d['dmarr'])):
+        if calc_dmloss(d, d['dmarr'][dmind], (d['dmarr'][dmind] - d['dmarr'][coarse[-1]])/2., d['dm_pulsewidth']) > d['dm_refineloss']:
+            coarse.append(max(dmind-1, coarse[-1]+1))
+    if coarse[-1] != len(d['dmarr'])-1:
+        coarse.append(len(d['dmarr'])-1)
+    return coarse
+
+def calc_refineints(d, plan, coarse, hits):
+    """ Schedules second pass of dm refinement. For each first pass hit, dms of dmarr between its coarse dm and neighboring coarse dms are imaged around hit.
+    Ints imaged are within max change of channel delay from hit dm, so the pulse is covered at every fine dm.
+    hits are cand locations from first pass (segment, int, dmind, dtind, beamnum).
+    Returns dict of ints of data_resamp to image, keyed by (dmind, dtind).
+    """
+
+    refineints = {}
+    for (segment, i, dmind, dtind, beamnum) in hits:
+        c = coarse.index(dmind)
+        dt = d['dtarr'][dtind]
+        for dmind1 in range(coarse[max(c-1, 0)]+1, coarse[min(c+1, len(coarse)-1)]):
+            if dmind1 == dmind:
+                continue
+            window = n.abs(plan.delay[dmind1].astype(int) - plan.delay[dmind]).max()/dt + 1
+            nskip_dm, searchints = plan.searchrange(dmind1, dtind, d['segment'])
+            ints = range(max(nskip_dm, i/dt - window), min(nskip_dm + searchints, i/dt + window + 1))
+            refineints.setdefault((dmind1, dtind), set()).update(ints)
+    return dict([(trial, n.array(sorted(ints), dtype=int)) for (trial, ints) in refineints.iteritems()])
+
+def calc_refinedtinds(d, dmind, refineints):
+    """ Returns dtinds of fine dmind to dedisperse in second pass of dm refinement.
+    These are the dtinds of its trials in refineints. With dtpyramid, every lower dtind is included too, since each dt is made from the one before.
+    """
+
+    dtinds = [dtind for dtind in xrange(len(d['dtarr'])) if (dmind, dtind) in refineints]
+    if d['dtpyramid'] and dtinds:
+        return range(max(dtinds)+1)
     else:
-        # iterate over dmgrid to find optimal dm values. go higher than maxdm to be sure final list includes full range.
-        dmgrid = n.arange(mindm, maxdm, 0.05)
-        dmgrid_final = [dmgrid[0]]
-        for i in range(len(dmgrid)):
-            ddm = (dmgrid[i] - dmgrid_final[-1])/2.
-            ll = loss(dmgrid[i],ddm)
-            if ll > maxloss:
-                dmgrid_final.append(dmgrid[i])
+        return dtinds
 
-    return dmgrid_final
+def calc_imageints(d, data):
+    """ Returns array of ints in data to image.
+    Skips ints with no data or with fraction of nonzero visibilities below minvalidfrac, so they are not gridded or fft'd.
+    """
+
+    validfrac = rtlib.calc_validfrac(data)
+    return n.where( (validfrac > 0) & (validfrac >= d['minvalidfrac']) )[0]
+
+def prefilter1(d, dtind, irange):
+    """ Parallelizable function for prefilter statistic of a chunk of data for a single dm.
+    Returns ints of data_resamp with enough valid data to image and their incoherent power (see rtlib.calc_blpower).
+    """
+
+    i0, i1 = irange
+    data_resamp = resampview(d, dtind)
+
+    ints = calc_imageints(d, data_resamp[i0:i1])
+    blpower = rtlib.calc_blpower(data_resamp[i0:i1])
+    return (i0 + ints, blpower[ints])
+
+def calc_prefilterints(d, ints, blpower):
+    """ Returns ints to image for a dm/dt trial, given ints and their power from prefilter1 for all chunks.
+    Power is normalized by sigma-clipped mean and std over trial. Ints above sigma_prefilter or among prefilter_topk with largest power are kept.
+    """
 
-def image1(d, u, v, w, dmind, dtind, beamnum, irange):
+    if len(ints) <= max(2, d['prefilter_topk']):
+        return ints
+
+    keep = n.zeros(len(ints), dtype=bool)
+    if d['sigma_prefilter']:
+        (powermin, powermax) = rtlib.sigma_clip(blpower)
+        clipped = blpower[(blpower > powermin) & (blpower < powermax)]
+        keep = keep | ((blpower - clipped.mean())/clipped.std() > d['sigma_prefilter'])
+    if d['prefilter_topk']:
+        keep[n.argsort(blpower)[-d['prefilter_topk']:]] = True
+    return ints[keep]
+
+def image1(d, u, v, w, dmind, dtind, beamnum, irange, ints=None):
     """ Parallelizable function for imaging a chunk of data for a single dm.
     Assumes data is dedispersed and resampled, so this just images each integration.
     Simple one-stage imaging that returns dict of params.
+    ints optionally selects ints of data_resamp to image (e.g., from prefilter or bispectrum1), of which those in irange are imaged. Otherwise, all ints with enough valid data are imaged.
     returns dictionary with keys of cand location and values as tuple of features
     """
 
     i0, i1 = irange
-    data_resamp = numpyview(data_resamp_mem, 'complex64', datashape(d))
+    data_resamp = resampview(d, dtind)
+
+    if ints is None:
+        ints = calc_imageints(d, data_resamp[i0:i1])
+        if len(ints) < i1-i0:
+            logger.debug('Skipping %d of %d ints with too little valid data for (%d,%d)' % (i1-i0-len(ints), i1-i0, d['dmarr'][dmind], d['dtarr'][dtind]))
+    else:
+        ints = n.array([i-i0 for i in ints if (i >= i0) and (i < i1)], dtype=int)
+
+    # coarse-to-fine imaging. first pass finds ints worth imaging at full resolution.
+    if d['npix_coarse'] and len(ints):
+        ims,snr,ints = rtlib.imgallfullfilterxy(n.outer(u, d['freq']/d['freq_orig'][0]), n.outer(v, d['freq']/d['freq_orig'][0]), data_resamp[i0:i1], d['npixx_coarse'], d['npixy_coarse'], d['uvres'], d['sigma_coarse'], d['fftthreads'], d['fftbatch'], gridops_coarse[beamnum], d['fftc2r'], ints)
+        logger.debug('First pass kept %d of %d ints for (%d,%d)' % (len(ints), i1-i0, d['dmarr'][dmind], d['dtarr'][dtind]))
+
+    # imaging returns compact record of each candidate with features that need its image
+    peaks = n.zeros(i1-i0, dtype=peaksdtype) if d['savepeaks'] else None
+    gridop = gridops_chanavg[d['chanavgfactor']][beamnum] if d.has_key('chanavgfactor') else gridops[beamnum]
+    recs, ims = rtlib.imgallfullfilterxypeak(n.outer(u, d['freq']/d['freq_orig'][0]), n.outer(v, d['freq']/d['freq_orig'][0]), data_resamp[i0:i1], d['npixx'], d['npixy'], d['uvres'], d['sigma_image1'], d['fftthreads'], d['fftbatch'], gridop, d['fftc2r'], ints, cutout=40 if 'im40' in d['features'] else 0, moments=('imskew' in d['features']) or ('imkurtosis' in d['features']), peaks=peaks)
+
+    # peak of every imaged int goes straight to segment peaks file, so it is written as trials finish
+    if d['savepeaks']:
+        peakcube = n.load(getpeaksfile(d), mmap_mode='r+')
+        peakcube[beamnum, dmind, dtind, i0:i1] = peaks
+        peakcube.flush()
+        del peakcube
+    candints = recs['int']
+    snr = [float(snr1) for snr1 in recs['snr']]
+
+    # locate all candidates first, so their spectra are extracted in one call
+    lm = []
+    for i in xrange(len(candints)):
+        l1, m1 = calc_lm(d, (d['npixx'], d['npixy']), pix=(recs['peakx'][i], recs['peaky'][i]))
+        if d['beams']:    # image is centered on beam
+            l1 += d['beams'][beamnum][0] - d['l0']
+            m1 += d['beams'][beamnum][1] - d['m0']
+        lm.append((l1, m1))
 
-    ims,snr,candints = rtlib.imgallfullfilterxyflux(n.outer(u, d['freq']/d['freq_orig'][0]), n.outer(v, d['freq']/d['freq_orig'][0]), data_resamp[i0:i1], d['npixx'], d['npixy'], d['uvres'], d['sigma_image1'])
+    if ('spec20' in d['features']) or ('specstd' in d['features']):
+        spec, nvalid, windows = calc_candspectra(d, data_resamp, [i0+i for i in candints], lm, u, v, 10 if 'spec20' in d['features'] else 0)
 
     feat = {}
     for i in xrange(len(candints)):
-        if snr[i] > 0:
-            l1, m1 = calc_lm(d, ims[i], minmax='max')
-        else:
-            l1, m1 = calc_lm(d, ims[i], minmax='min')
+        l1, m1 = lm[i]
         logger.info('Got one!  Int=%d, DM=%d, dt=%d: SNR_im=%.1f @ (%.2e,%.2e).' % ((i0+candints[i])*d['dtarr'][dtind], d['dmarr'][dmind], d['dtarr'][dtind], snr[i], l1, m1))
         candid =  (d['segment'], (i0+candints[i])*d['dtarr'][dtind], dmind, dtind, beamnum)
 
@@ -923,49 +1661,227 @@ def image1(d, u, v, w, dmind, dtind, beamnum, irange):
             if feature == 'snr1':
                 ff.append(snr[i])
             elif feature == 'immax1':
-                if snr[i] > 0:
-                    ff.append(ims[i].max())
-                else:
-                    ff.append(ims[i].min())
+                ff.append(recs['immax'][i])
             elif feature == 'l1':
                 ff.append(l1)
             elif feature == 'm1':
                 ff.append(m1)
-            elif feature == 'im40':  # 40 pixel image peak cutout
-                peakx, peaky = n.where(ims[i] == ims[i].max())
-                sizex, sizey = ims[i].shape
-                # set image window with min=0 and max=size
-                xmin = max(0, peakx - 20); xmax = min(peakx + 20, sizex)   
-                ymin = max(0, peaky - 20); ymax = min(peaky + 20, sizey)
-                ff.append(ims[i][xmin:xmax,ymin:ymax])
-            elif feature == 'spec20':  # 20 int spectrum cutout
-                # set int window with min 0 and max len()
-                imin = max(0, (i0+candints[i])*d['dtarr'][dtind] - 10)
-                imax = min( (i0+candints[i])*d['dtarr'][dtind] + 10, len(data_resamp))
-                data_cut = data_resamp[imin:imax].copy()
-                rtlib.phaseshift_threaded(data_cut, d, l1, m1, u, v)
-                ff.append(data_cut.mean(axis=1))
+            elif feature == 'im40':  # 40 pixel image cutout centered on peak
+                ff.append(recs['cutout'][i])
+            elif feature == 'spec20':  # 20 int spectrum cutout, mean over baselines
+                ff.append(spec[i, :windows[i,1]-windows[i,0]]/d['nbl'])
             elif feature in ['specstd', 'specskew', 'speckurtosis']:  # this is standard set and must all appear together
                 if feature == 'specstd':  # first this one, then others will use same data
-                    seli = (i0+candints[i])*d['dtarr'][dtind]
-                    rtlib.phaseshift_threaded(data_resamp[seli:seli+1], d, l1, m1, u, v)
-                    data = n.ma.masked_equal(data_resamp[seli:seli+1], 0j)
-                    spec = data.mean(axis=3).mean(axis=1).mean(axis=0).real
-                    std = spec.std(axis=0)
+                    t = i0 + candints[i] - windows[i,0]
+                    nvalidt = nvalid[i, t].sum(axis=1)
+                    spect = n.ma.array(spec[i, t].sum(axis=1).real/n.maximum(nvalidt, 1), mask=(nvalidt == 0))   # mean over baselines and pols of unflagged data
+                    std = spect.std(axis=0)
                     ff.append(std)
                 elif feature == 'specskew':
-                    skew = float(mstats.skew(spec))
+                    skew = float(mstats.skew(spect))
                     ff.append(skew)
                 elif feature == 'speckurtosis':
-                    kurtosis = float(mstats.kurtosis(spec))
+                    kurtosis = float(mstats.kurtosis(spect))
                     ff.append(kurtosis)
             elif feature == 'imskew':
-                skew = float(mstats.skew(ims[i].flatten()))
-                ff.append(skew)
+                ff.append(float(recs['skew'][i]))
             elif feature == 'imkurtosis':
-                kurtosis = float(mstats.kurtosis(ims[i].flatten()))
-                ff.append(kurtosis)
+                ff.append(float(recs['kurtosis'][i]))
+
+        feat[candid] = list(ff)
+    return feat
+
+def image1dt(d, u, v, w, dmind, beamnum, searchranges, irange):
+    """ Parallelizable function for imaging a chunk of dt=1 data for a single dm and making images of every dt by summing them (dtimage).
+    irange is from plan.dtimagerange, so it starts at a multiple of every dt. searchranges has (first int, number of ints) of search range of each dt, as from plan.searchrange.
+    Same features as image1 for searchtype image1. Only candidates in search range of their dt are returned.
+    returns dictionary with keys of cand location and values as tuple of features
+    """
+
+    i0, i1 = irange
+    data_resamp = resampview(d, 0)
+    ints = calc_imageints(d, data_resamp[i0:i1])
+
+    recsdt = rtlib.imgallfullfilterxydt(n.outer(u, d['freq']/d['freq_orig'][0]), n.outer(v, d['freq']/d['freq_orig'][0]), data_resamp[i0:i1], d['npixx'], d['npixy'], d['uvres'], d['sigma_image1'], d['dtarr'], d['fftthreads'], d['fftbatch'], gridops[beamnum], d['fftc2r'], ints, cutout=40 if 'im40' in d['features'] else 0, moments=('imskew' in d['features']) or ('imkurtosis' in d['features']))
+
+    feat = {}
+    for dtind in xrange(len(d['dtarr'])):
+        recs = recsdt[dtind]
+        nskip_dm, searchints = searchranges[dtind]
+        for i in xrange(len(recs)):
+            candint = i0/d['dtarr'][dtind] + recs['int'][i]    # int of data_resamp for dt
+            if (candint < nskip_dm) or (candint >= nskip_dm + searchints):
+                continue
+
+            candid, ff = calc_recfeatures(d, recs[i], candint, dmind, dtind, beamnum)
+            feat[candid] = ff
+    return feat
+
+def recordfeatures(d):
+    """ Returns features in cand records made by search, in order.
+    searchtype image2 and image2w are searched with image1, so their second stage features (snr2, immax2, l2, m2) are not in records.
+    """
+
+    if 'image2' in d['searchtype']:
+        return [feature for feature in d['features'] if feature not in ['snr2', 'immax2', 'l2', 'm2']]
+    else:
+        return list(d['features'])
+
+def calc_recfeatures(d, rec, candint, dmind, dtind, beamnum):
+    """ Helper function to make cand location and features of record from image kernels that do not keep data_resamp (e.g., imgallfullfilterxydt).
+    candint is int of candidate in units of dt. Only features measured in image are made (snr1, immax1, l1, m1, im40, imskew, imkurtosis).
+    Returns tuple of (candid, list of features).
+    """
+
+    snr = float(rec['snr'])
+    l1, m1 = calc_lm(d, (d['npixx'], d['npixy']), pix=(rec['peakx'], rec['peaky']))
+    if d['beams']:    # image is centered on beam
+        l1 += d['beams'][beamnum][0] - d['l0']
+        m1 += d['beams'][beamnum][1] - d['m0']
+    logger.info('Got one!  Int=%d, DM=%d, dt=%d: SNR_im=%.1f @ (%.2e,%.2e).' % (candint*d['dtarr'][dtind], d['dmarr'][dmind], d['dtarr'][dtind], snr, l1, m1))
+    candid =  (d['segment'], candint*d['dtarr'][dtind], dmind, dtind, beamnum)
+
+    # assemble feature in requested order
+    ff = []
+    for feature in d['features']:
+        if feature == 'snr1':
+            ff.append(snr)
+        elif feature == 'immax1':
+            ff.append(rec['immax'])
+        elif feature == 'l1':
+            ff.append(l1)
+        elif feature == 'm1':
+            ff.append(m1)
+        elif feature == 'im40':
+            ff.append(rec['cutout'])
+        elif feature == 'imskew':
+            ff.append(float(rec['skew']))
+        elif feature == 'imkurtosis':
+            ff.append(float(rec['kurtosis']))
+    return candid, ff
+
+def search_subimage(d, pool, plan, dminds, beamnum):
+    """ Searches all dts of dms in dminds for one beam with image dedispersion.
+    Assumes data_sub has first stage of subband dedispersion for dminds[0] and pool is made with initresamp.
+    In each time block of subband image cube, every subband of data_sub is imaged once. Each (dm, dt) then only shifts and sums subband images.
+    Returns list of dicts of cands, as from image1.
+    """
+
+    nsub, ncube, npix = subimageshape(d)
+    trials = [(dmind, dtind) + tuple(plan.searchrange(dmind, dtind, d['segment'])) for dmind in dminds for dtind in xrange(len(d['dtarr']))]
+
+    results = []
+    for (b0, b1, edges) in calc_subimageblocks(d, plan, dminds):
+        # image each subband of cube once, in chunks of ints. ints after end of segment are left empty.
+        c1 = edges[-1]
+        tasks = [(s, (edges[chunk], edges[chunk+1])) for s in xrange(nsub) for chunk in xrange(d['nchunk']) if edges[chunk] < edges[chunk+1]]
+        logger.info('Imaging %d subbands of %d ints from %d for DMs from %d to %d' % (nsub, c1-b0, b0, d['dmarr'][dminds[0]], d['dmarr'][dminds[-1]]))
+        nonzeros = n.zeros((nsub, ncube), dtype=n.int32)
+        upper = n.zeros((nsub, ncube), dtype=n.uint8)
+        for ((s, (j0, j1)), (nonzeros1, upper1)) in zip(tasks, pool.map(partial(subimage1, d, beamnum, b0), tasks)):
+            nonzeros[s, j0-b0:j1-b0] = nonzeros1
+            upper[s, j0-b0:j1-b0] = upper1
+
+        # search ranges of trials in block
+        searchtasks = []
+        for (dmind, dtind, nskip, searchints) in trials:
+            i0 = max(nskip, b0/d['dtarr'][dtind])
+            i1 = min(nskip + searchints, b1/d['dtarr'][dtind])
+            if i0 < i1:
+                searchtasks.append((dmind, dtind, (i0, i1)))
+        logger.info('Summing subband images for %d (DM, dt) trials' % len(searchtasks))
+        results += pool.map(partial(image1sub, d, dminds[0], beamnum, b0, nonzeros, upper), searchtasks)
+
+    return results
+
+def calc_subimageblocks(d, plan, dminds):
+    """ Returns list of (b0, b1, edges) for time blocks of subband image cube that search dms in dminds with image dedispersion.
+    Block searches dt=1 ints from b0 to b1. edges are dt=1 ints of chunks of data_sub imaged into cube for block.
+    """
 
+    nsub, ncube, npix = subimageshape(d)
+    maxdt = max(d['dtarr'])
+    trials = [plan.searchrange(dmind, dtind, d['segment']) + (d['dtarr'][dtind],) for dmind in dminds for dtind in xrange(len(d['dtarr']))]
+    start = (min([nskip*dt for (nskip, searchints, dt) in trials])/maxdt)*maxdt
+    stop = max([(nskip+searchints)*dt for (nskip, searchints, dt) in trials])
+
+    blocks = []
+    for b0 in xrange(start, stop, d['subimage_ints']):
+        c1 = min(b0 + ncube, d['readints'])
+        blocks.append( (b0, b0 + d['subimage_ints'], [b0 + ((c1-b0)*chunk)/d['nchunk'] for chunk in range(d['nchunk']+1)]) )
+    return blocks
+
+def subimage1(d, beamnum, offset, task):
+    """ Parallelizable function for imaging ints of one subband of data_sub into subband image cube for image dedispersion.
+    task is tuple of (subband, (i0, i1)) with ints of data_sub. offset is int of data_sub at start of cube.
+    Returns tuple of (number of nonzero vis, whether subband has data in upper third of band) for each int.
+    """
+
+    s, (i0, i1) = task
+    data_sub = numpyview(data_sub_mem, 'complex64', datashape(d))
+    subims = numpyview(subims_mem, 'float32', subimageshape(d))
+
+    nonzeros = rtlib.imgallraw(data_sub[i0:i1], d['npixx'], d['npixy'], gridops_sub[beamnum][s], d['fftc2r'], subims[s, i0-offset:i1-offset], d['fftthreads'], d['fftbatch'])
+    upper = n.any(data_sub[i0:i1, :, max(d['subbands'][s], d['nchan']/3):d['subbands'][s+1]], axis=(1,2,3))
+    return nonzeros, upper
+
+def image1sub(d, dmind0, beamnum, offset, nonzeros, upper, trial):
+    """ Parallelizable function for searching one (dm, dt) with image dedispersion by shifting and summing subband images of cube.
+    trial is tuple of (dmind, dtind, (i0, i1)) with ints of dt to search. dmind0 is first dm of group used to make data_sub. offset is int of data_sub at start of cube.
+    Same features as image1dt. Away from segment edges, images are those of image1 after subband dedispersion with same groups of dms.
+    returns dictionary with keys of cand location and values as tuple of features
+    """
+
+    dmind, dtind, (i0, i1) = trial
+    subims = numpyview(subims_mem, 'float32', subimageshape(d))
+    intradelay, subdelay0, err = rtlib.calc_subdelay(d['freq'], d['inttime'], d['dmarr'][dmind0], d['subbands'])
+    intradelay, subdelay, err = rtlib.calc_subdelay(d['freq'], d['inttime'], d['dmarr'][dmind], d['subbands'], intradelay)
+
+    recs = rtlib.imgsubbandsum(subims, nonzeros, upper, subdelay, d['dtarr'][dtind], offset, i0, i1, d['sigma_image1'], d['npixx'], d['npixy'], d['fftc2r'], cutout=40 if 'im40' in d['features'] else 0, moments=('imskew' in d['features']) or ('imkurtosis' in d['features']))
+
+    feat = {}
+    for i in xrange(len(recs)):
+        candid, ff = calc_recfeatures(d, recs[i], recs['int'][i], dmind, dtind, beamnum)
+        feat[candid] = ff
+    return feat
+
+def bispectrum1(d, u, v, w, dmind, dtind, beamnum, triples, irange):
+    """ Parallelizable function for bispectrum search of a chunk of data for a single dm.
+    Thresholds snr of mean bispectrum of each int against noise per baseline, so no fft is needed.
+    If bispec_image, ints above threshold are also imaged as in image1.
+    returns dictionary with keys of cand location and values as tuple of features
+    """
+
+    i0, i1 = irange
+    data_resamp = resampview(d, dtind)
+
+    ints = calc_imageints(d, data_resamp[i0:i1])
+    if not len(ints):
+        return {}
+
+    datamean = data_resamp[i0:i1].mean(axis=3).mean(axis=2)
+    bamean, ntr = rtlib.calc_bispectra(datamean, triples)
+    snrbs = bamean*n.sqrt(ntr)/(2*estimate_noisemean(datamean)**3)    # noise of real part of bispectrum is 2*sigma**3 per triple
+    bsints = [i for i in ints if snrbs[i] > d['sigma_bispec']]
+
+    if d['bispec_image']:
+        feat = image1(d, u, v, w, dmind, dtind, beamnum, irange, [i0+i for i in bsints])
+        for candid in feat.keys():
+            feat[candid].append(snrbs[candid[1]/d['dtarr'][dtind] - i0])
+        return feat
+
+    feat = {}
+    for i in bsints:
+        logger.info('Got one!  Int=%d, DM=%d, dt=%d: SNR_bs=%.1f.' % ((i0+i)*d['dtarr'][dtind], d['dmarr'][dmind], d['dtarr'][dtind], snrbs[i]))
+        candid =  (d['segment'], (i0+i)*d['dtarr'][dtind], dmind, dtind, beamnum)
+
+        # assemble feature in requested order
+        ff = []
+        for feature in d['features']:
+            if feature == 'snrbs':
+                ff.append(snrbs[i])
+            elif feature == 'bamean':
+                ff.append(bamean[i])
         feat[candid] = list(ff)
     return feat
 
@@ -977,12 +1893,13 @@ def image2(d, i0, i1, u, v, w, dmind, dtind, beamnum):
     """
 
     data_resamp = numpyview(data_resamp_mem, 'complex64', datashape(d))
-    ims,snr,candints = rtlib.imgallfullfilterxy(n.outer(u, d['freq']/d['freq_orig'][0]), n.outer(v, d['freq']/d['freq_orig'][0]), data_resamp[i0:i1], d['npixx'], d['npixy'], d['uvres'], d['sigma_image1'])
+    ints = calc_imageints(d, data_resamp[i0:i1])
+    ims,snr,candints = rtlib.imgallfullfilterxy(n.outer(u, d['freq']/d['freq_orig'][0]), n.outer(v, d['freq']/d['freq_orig'][0]), data_resamp[i0:i1], d['npixx'], d['npixy'], d['uvres'], d['sigma_image1'], d['fftthreads'], d['fftbatch'], gridops[beamnum], d['fftc2r'], ints)
 
     feat = {}
     for i in xrange(len(candints)):
         # reimage
-        im2 = rtlib.imgonefullxy(n.outer(u, d['freq']/d['freq_orig'][0]), n.outer(v, d['freq']/d['freq_orig'][0]), data_resamp[i0+candints[i]], d['npixx_full'], d['npixy_full'], d['uvres'], verbose=0)
+        im2 = rtlib.imgonefullxy(n.outer(u, d['freq']/d['freq_orig'][0]), n.outer(v, d['freq']/d['freq_orig'][0]), data_resamp[i0+candints[i]], d['npixx_full'], d['npixy_full'], d['uvres'], verbose=0, c2r=d['fftc2r'])
 
         # find most extreme pixel
         snrmax = im2.max()/im2.std()
@@ -1047,7 +1964,8 @@ def image2w(d, i0, i1, u, v, w, dmind, dtind, beamnum, bls, uvkers):
     """
 
     data_resamp = numpyview(data_resamp_mem, 'complex64', datashape(d))
-    ims,snr,candints = rtlib.imgallfullfilterxy(n.outer(u, d['freq']/d['freq_orig'][0]), n.outer(v, d['freq']/d['freq_orig'][0]), data_resamp[i0:i1], d['npixx'], d['npixy'], d['uvres'], d['sigma_image1'])
+    ints = calc_imageints(d, data_resamp[i0:i1])
+    ims,snr,candints = rtlib.imgallfullfilterxy(n.outer(u, d['freq']/d['freq_orig'][0]), n.outer(v, d['freq']/d['freq_orig'][0]), data_resamp[i0:i1], d['npixx'], d['npixy'], d['uvres'], d['sigma_image1'], d['fftthreads'], d['fftbatch'], gridops[beamnum], d['fftc2r'], ints)
 
     feat = {}
     for i in xrange(len(candints)):
@@ -1119,7 +2037,7 @@ def image1wrap(d, u, v, w, npixx, npixy, candint):
     """
 
     data_resamp = numpyview(data_resamp_mem, 'complex64', datashape(d))
-    image = rtlib.imgonefullxy(n.outer(u, d['freq']/d['freq_orig'][0]), n.outer(v, d['freq']/d['freq_orig'][0]), data_resamp[candint], npixx, npixy, d['uvres'], verbose=1)
+    image = rtlib.imgonefullxy(n.outer(u, d['freq']/d['freq_orig'][0]), n.outer(v, d['freq']/d['freq_orig'][0]), data_resamp[candint], npixx, npixy, d['uvres'], verbose=1, c2r=d['fftc2r'])
     return image
 
 def sample_image(d, data, u, v, w, i=-1, verbose=1, imager='xy', wres=100):
@@ -1131,11 +2049,11 @@ def sample_image(d, data, u, v, w, i=-1, verbose=1, imager='xy', wres=100):
         i = len(data)/2
 
     if imager == 'xy':
-        image = rtlib.imgonefullxy(n.outer(u, d['freq']/d['freq_orig'][0]), n.outer(v, d['freq']/d['freq_orig'][0]), data[i], d['npixx'], d['npixy'], d['uvres'], verbose=verbose)
+        image = rtlib.imgonefullxy(n.outer(u, d['freq']/d['freq_orig'][0]), n.outer(v, d['freq']/d['freq_orig'][0]), n.ascontiguousarray(data[i]), d['npixx'], d['npixy'], d['uvres'], verbose=verbose, c2r=d['fftc2r'])
     elif imager == 'w':
         npix = max(d['npixx'], d['npixy'])
         bls, uvkers = rtlib.genuvkernels(w, wres, npix, d['uvres'], ksize=21, oversample=1)
-        image = rtlib.imgonefullw(n.outer(u, d['freq']/d['freq_orig'][0]), n.outer(v, d['freq']/d['freq_orig'][0]), data[i], npix, d['uvres'], bls, uvkers, verbose=verbose)
+        image = rtlib.imgonefullw(n.outer(u, d['freq']/d['freq_orig'][0]), n.outer(v, d['freq']/d['freq_orig'][0]), n.ascontiguousarray(data[i]), npix, d['uvres'], bls, uvkers, verbose=verbose)
 
 #        bls, lmkers = rtlib.genlmkernels(w, wres, npix, d['uvres'])
 #        image = rtlib.imgonefullw(n.outer(u, d['freq']/d['freq_orig'][0]), n.outer(v, d['freq']/d['freq_orig'][0]), data[i], npix, d['uvres'], [bls[0]], [lmkers[0]], verbose=verbose)
@@ -1155,6 +2073,15 @@ def estimate_noiseperbl(data):
     logger.debug('Clipped to %d%% of data (%.3f to %.3f). Noise = %.3f.' % (100.*len(good[0])/len(datamean.flatten()), datameanmin, datameanmax, noiseperbl))
     return noiseperbl
 
+def estimate_noisemean(datamean):
+    """ Takes array of visibilities averaged over channels and pols with shape (nints, nbl) and sigma clips it to find noise of real or imaginary part.
+    Used for bispectrum snr (see bispectrum1).
+    """
+
+    datamean = datamean[datamean != 0j].imag.astype('float32')    # use imaginary part to estimate noise without calibrated, on-axis signal
+    (datameanmin, datameanmax) = rtlib.sigma_clip(datamean)
+    return datamean[(datamean > datameanmin) & (datamean < datameanmax)].std()/0.9866    # clipping at 3 sigma underestimates gaussian std by this factor
+
 def noisepickle(d, data, u, v, w, chunk=200):
     """ Calculates noise properties and saves values to pickle.
     chunk defines window for measurement. at least one measurement always made.
@@ -1197,23 +2124,113 @@ def datashape(d):
 def datasize(d):
     return long(d['readints']*d['nbl']*d['nchan']*d['npol'])
 
+def readshape(d):
+    """ Shape of data_read, which has all pols read. With stokesi, data has one pol (see datashape).
+    """
+
+    return (d['readints'], d['nbl'], d['nchan'], len(d['pols']))
+
+def readsize(d):
+    return long(d['readints']*d['nbl']*d['nchan']*len(d['pols']))
+
+def stokesipols(d):
+    """ Returns indices of parallel-hand pols (e.g., RR, LL) in d['pols'] that are averaged to Stokes I.
+    """
+
+    return [i for i in range(len(d['pols'])) if d['pols'][i][0] == d['pols'][i][1]]
+
+def datashape_t(d):
+    return (d['nbl'], d['npol'], d['nchan'], d['readints'])
+
+def dataview(d, arr):
+    """ Returns numpy view of segment data in mp shared array with shape datashape(d).
+    With d['tlayout'], data is stored time contiguous, so view is a transpose.
+    """
+
+    if d.has_key('tlayout') and d['tlayout']:
+        return numpyview(arr, 'complex64', datashape_t(d)).transpose(3,0,2,1)
+    else:
+        return numpyview(arr, 'complex64', datashape(d))
+
+def readview(d, arr):
+    """ Returns numpy view of data_read in mp shared array. Same as dataview, unless stokesi keeps more pols in data_read.
+    """
+
+    if d.has_key('stokesi') and d['stokesi']:
+        return numpyview(arr, 'complex64', readshape(d))
+    else:
+        return dataview(d, arr)
+
+def resamplevels(d):
+    """ Returns list of (start, stop) ints in data_resamp used for each dt.
+    With dtpyramid, each dt after the first has its own level. Otherwise, all dts share one.
+    """
+
+    levels = [(0, d['readints'])]
+    for dt in d['dtarr'][1:]:
+        if d.has_key('dtpyramid') and d['dtpyramid']:
+            levels.append( (levels[-1][1], levels[-1][1] + d['readints']/dt) )
+        else:
+            levels.append(levels[0])
+    return levels
+
+def resampshape(d):
+    return (resamplevels(d)[-1][1], d['nbl'], d['nchan'], d['npol'])
+
+def resampsize(d):
+    return long(resamplevels(d)[-1][1]*d['nbl']*d['nchan']*d['npol'])
+
+def resampview(d, dtind=0):
+    """ Returns numpy view of data_resamp for dtind. Assumes data_resamp_mem is global mps.Array.
+    """
+
+    i0, i1 = resamplevels(d)[dtind]
+    return numpyview(data_resamp_mem, 'complex64', resampshape(d))[i0:i1]
+
+peaksdtype = [('snr', 'float32'), ('peakx', 'int16'), ('peaky', 'int16')]
+
+def peaksshape(d):
+    """ Shape of peaks file of segment, indexed by (beamnum, dmind, dtind, int). int indexes data_resamp for dtind, so only first readints/dt are used for dt > 1.
+    Records have snr of most extreme pixel (sign gives max or min) and its pixel as for calc_lm. Ints not imaged have snr 0.
+    """
+
+    return (max(1, len(d['beams'])), len(d['dmarr']), len(d['dtarr']), d['readints'])
+
+def subimageshape(d):
+    """ Shape of subband image cube for image dedisptype, indexed by (subband, int, pixel).
+    Has unrolled images of each subband for block of subimage_ints ints plus max dm delay.
+    """
+
+    return (len(d['subbands'])-1, d['subimage_ints'] + max(d['datadelay']), d['npixx']*d['npixy'])
+
+def subimagesize(d):
+    return long(n.prod(subimageshape(d)))
+
 def numpyview(arr, datatype, shape, raw=False):
     """ Takes mp shared array and returns numpy array with given shape.
     """
 
+    count = int(n.prod(shape))   # shape can be smaller than arr (e.g., data_resamp with averaged channels)
     if raw:
-        return n.frombuffer(arr, dtype=n.dtype(datatype)).view(n.dtype(datatype)).reshape(shape)   # for shared mps.RawArray
+        return n.frombuffer(arr, dtype=n.dtype(datatype), count=count).view(n.dtype(datatype)).reshape(shape)   # for shared mps.RawArray
     else:
-        return n.frombuffer(arr.get_obj(), dtype=n.dtype(datatype)).view(n.dtype(datatype)).reshape(shape)  # for shared mp.Array
+        return n.frombuffer(arr.get_obj(), dtype=n.dtype(datatype), count=count).view(n.dtype(datatype)).reshape(shape)  # for shared mp.Array
 
 def initreadonly(shared_arr_):
     global data_read_mem
     data_read_mem = shared_arr_ # must be inhereted, not passed as an argument
 
-def initresamp(shared_arr_, shared_arr2_):
-    global data_mem, data_resamp_mem
+def initresamp(shared_arr_, shared_arr2_, shared_arr3_=None, gridops_=None, gridops_coarse_=None, shared_arr4_=None, gridops_sub_=None, gridops_chanavg_=None, shared_arr5_=None):
+    global data_mem, data_resamp_mem, data_sub_mem, gridops, gridops_coarse, subims_mem, gridops_sub, gridops_chanavg, fdmtcount_mem
     data_mem = shared_arr_
     data_resamp_mem = shared_arr2_
+    data_sub_mem = shared_arr3_
+    gridops = gridops_  # read-only gridding operators from rtlib.calc_gridop, one per beam
+    gridops_coarse = gridops_coarse_
+    subims_mem = shared_arr4_   # subband image cube for image dedisptype
+    gridops_sub = gridops_sub_  # gridding operators per beam and subband
+    gridops_chanavg = gridops_chanavg_   # gridding operators per beam for each channel averaging factor
+    fdmtcount_mem = shared_arr5_   # counts of unflagged visibilities for fdmt dedisptype
 
 def initread(shared_arr1_, shared_arr2_, shared_arr3_, shared_arr4_, shared_arr5_, shared_arr6_, shared_arr7_, shared_arr8_):
     global data_read_mem, u_read_mem, v_read_mem, w_read_mem, data_mem, u_mem, v_mem, w_mem
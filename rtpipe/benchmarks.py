@@ -0,0 +1,258 @@
+#
+# functions to benchmark search algorithms on simulated data
+#
+
+import rtlib_cython as rtlib
+import numpy as n
+import logging, time
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+def make_data(nints=200, nbl=351, nchan=256, npol=2, seed=0):
+    """ Make gaussian noise visibilities with shape (nints, nbl, nchan, npol) for benchmarking.
+    """
+
+    rand = n.random.RandomState(seed)
+    data = n.empty((nints, nbl, nchan, npol), dtype='complex64')
+    data.real = rand.normal(size=data.shape)
+    data.imag = rand.normal(size=data.shape)
+    return data
+
+def make_freq(nchan=256, freq0=1.2, bw=0.5):
+    """ Make array of channel center frequencies in GHz, as in d['freq'].
+    """
+
+    return n.linspace(freq0, freq0+bw, nchan, endpoint=False).astype('float32')
+
+def bench_dedisperse(nints=200, nbl=351, nchan=256, npol=2, inttime=0.005, dmarr=range(0, 200, 2), dt=1, nsubband=0, subbandtol=0):
+    """ Compares time for brute force (dedisperse_resample) and subband dedispersion over a dm grid.
+    subbandtol is max channel delay error in ints allowed for dms to share first stage (as in RT.calc_dmgroups).
+    Returns dict of total time in seconds for each algorithm.
+    """
+
+    data = make_data(nints, nbl, nchan, npol)
+    freq = make_freq(nchan)
+    data_resamp = n.empty_like(data)
+    data_sub = n.empty_like(data)
+    blr = (0, nbl)
+    newlen0 = nints/dt
+
+    if nsubband == 0:
+        nsubband = int(round(n.sqrt(nchan)))
+    subbands = rtlib.calc_subbands(nchan, nsubband)
+
+    # brute force
+    t0 = time.time()
+    for dm in dmarr:
+        data_resamp[:] = data
+        rtlib.dedisperse_resample(data_resamp, freq, inttime, dm, dt, blr)
+    t_brute = time.time() - t0
+    brute = data_resamp[:newlen0].copy()
+
+    # subband
+    t0 = time.time()
+    ngroup = 0; maxerr = 0
+    for dm in dmarr:
+        if ngroup:
+            intradelay, subdelay, err = rtlib.calc_subdelay(freq, inttime, dm, subbands, intradelay0)
+        if (not ngroup) or (err > subbandtol):
+            intradelay0, subdelay, err = rtlib.calc_subdelay(freq, inttime, dm, subbands)
+            rtlib.dedisperse_subband1(data, data_sub, intradelay0, blr)
+            ngroup += 1
+        maxerr = max(maxerr, err)
+        rtlib.dedisperse_subband2(data_sub, data_resamp, subbands, subdelay, intradelay0, dt, blr)
+    t_subband = time.time() - t0
+    same = n.array_equal(brute, data_resamp[:newlen0])
+
+    logger.info('Dedispersed %d DMs with shape %s and dt=%d.' % (len(dmarr), str(data.shape), dt))
+    logger.info('\t brute: %.2f s (%.1f ms/DM)' % (t_brute, 1e3*t_brute/len(dmarr)))
+    logger.info('\t subband: %.2f s (%.1f ms/DM) with %d subbands and %d groups. Max delay error %d ints. Last trial identical: %s' % (t_subband, 1e3*t_subband/len(dmarr), nsubband, ngroup, maxerr, same))
+
+    return {'brute': t_brute, 'subband': t_subband}
+
+def bench_fdmt(nints=200, nbl=351, nchan=256, npol=2, inttime=0.005, dmarr=range(0, 200, 2), nsubband=16):
+    """ Compares per-dm cost of brute force (dedisperse_resample) and fdmt dedispersion.
+    fdmt cost is one transform for all dms (with counts of unflagged visibilities, as in search) plus extraction of each dm.
+    Returns dict of time per dm in seconds for each algorithm.
+    """
+
+    data = make_data(nints, nbl, nchan, npol)
+    freq = make_freq(nchan)
+    data_resamp = n.empty_like(data)
+    blr = (0, nbl)
+    maxdm = max(dmarr)
+
+    # brute force
+    t0 = time.time()
+    for dm in dmarr:
+        data_resamp[:] = data
+        rtlib.dedisperse_resample(data_resamp, freq, inttime, dm, 1, blr)
+    t_brute = time.time() - t0
+
+    # fdmt
+    bands = rtlib.calc_fdmtbands(nchan, nsubband)[-1]
+    ndelay = sum([rtlib.calc_fdmtndelay(freq, inttime, maxdm, band) for band in bands])
+    data_fdmt = n.empty((ndelay, nints, nbl, npol), dtype='complex64')
+    data_count = n.empty((ndelay, nints, nbl, npol), dtype='uint16')
+    data_sub = n.empty((nints, nbl, len(bands), npol), dtype='complex64')
+
+    t0 = time.time()
+    rtlib.fdmt(data, data_fdmt, freq, inttime, maxdm, nsubband, blr, data_count)
+    t_transform = time.time() - t0
+    for dm in dmarr:
+        rtlib.fdmt_extract(data_fdmt, data_sub, freq, inttime, maxdm, dm, nsubband, blr, data_count)
+    t_fdmt = time.time() - t0
+
+    logger.info('Dedispersed %d DMs with shape %s.' % (len(dmarr), str(data.shape)))
+    logger.info('\t brute: %.2f s (%.1f ms/DM)' % (t_brute, 1e3*t_brute/len(dmarr)))
+    logger.info('\t fdmt: %.2f s (%.1f ms/DM) with %d delays to %d subbands. Transform took %.2f s.' % (t_fdmt, 1e3*t_fdmt/len(dmarr), ndelay, len(bands), t_transform))
+
+    return {'brute': t_brute/len(dmarr), 'fdmt': t_fdmt/len(dmarr)}
+
+def bench_tlayout(nints=200, nbl=351, nchan=256, npol=2, inttime=0.005, dmarr=range(0, 200, 20), dt=1):
+    """ Compares time for meantsub and dedispersion of a dm grid with usual (nints, nbl, nchan, npol) layout and time-contiguous (nbl, npol, nchan, nints) layout.
+    Time-contiguous dedispersion writes output in usual layout for imaging (as with d['tlayout']), so both produce same data_resamp.
+    Returns dict of total time in seconds for each layout.
+    """
+
+    data = make_data(nints, nbl, nchan, npol)
+    freq = make_freq(nchan)
+    datat = data.transpose(1,3,2,0).copy()
+    data_resamp = n.empty_like(data)
+    blr = (0, nbl)
+    newlen0 = nints/dt
+
+    # usual layout
+    t0 = time.time()
+    rtlib.meantsub(data, blr)
+    t_meantsub = time.time() - t0
+    t0 = time.time()
+    for dm in dmarr:
+        data_resamp[:] = data
+        rtlib.dedisperse_resample(data_resamp, freq, inttime, dm, dt, blr)
+    t_dedisp = time.time() - t0
+    usual = data_resamp[:newlen0].copy()
+
+    # time-contiguous layout
+    t0 = time.time()
+    rtlib.meantsub_t(datat, blr)
+    t_meantsub_t = time.time() - t0
+    t0 = time.time()
+    for dm in dmarr:
+        rtlib.dedisperse_resample_t(datat, data_resamp, freq, inttime, dm, dt, blr)
+    t_dedisp_t = time.time() - t0
+    same = n.array_equal(usual, data_resamp[:newlen0])
+
+    logger.info('Meantsub and dedispersed %d DMs with shape %s and dt=%d.' % (len(dmarr), str(data.shape), dt))
+    logger.info('\t usual layout: meantsub %.2f s, dedispersion %.2f s (%.1f ms/DM)' % (t_meantsub, t_dedisp, 1e3*t_dedisp/len(dmarr)))
+    logger.info('\t time-contiguous layout: meantsub %.2f s, dedispersion %.2f s (%.1f ms/DM). Last trial identical: %s' % (t_meantsub_t, t_dedisp_t, 1e3*t_dedisp_t/len(dmarr), same))
+
+    return {'usual': t_meantsub + t_dedisp, 'tlayout': t_meantsub_t + t_dedisp_t}
+
+def bench_c2r(npixarr=[512, 1024, 2048], nints=16, nbl=351, nchan=256, npol=2, uvres=60):
+    """ Compares imgallfullfilterxyflux with complex fft of full grid and c2r fft of hermitian half grid for each npix in npixarr.
+    Timing uses high threshold, as for typical search with few candidates. Agreement of images is tested in tests/test_c2r.py.
+    Returns dict with time per int in seconds for each method, keyed by npix.
+    """
+
+    data = make_data(nints, nbl, nchan, npol)
+    freq = make_freq(nchan)
+    rand = n.random.RandomState(1)
+
+    times = {}
+    for npix in npixarr:
+        u = n.outer(rand.uniform(-npix*uvres/3, npix*uvres/3, nbl), freq/freq[0]).astype('float32')
+        v = n.outer(rand.uniform(-npix*uvres/3, npix*uvres/3, nbl), freq/freq[0]).astype('float32')
+
+        times[npix] = {}
+        for name, c2r in [('complex', False), ('c2r', True)]:
+            gridop = rtlib.calc_gridop(u, v, npix, npix, uvres, c2r)
+            rtlib.get_fftplan(npix, npix, 1, 1, c2r)
+            t0 = time.time()
+            rtlib.imgallfullfilterxyflux(u, v, data, npix, npix, uvres, 100., 1, 1, gridop, c2r)
+            times[npix][name] = (time.time() - t0)/nints
+
+        logger.info('\t npix %d: complex %.1f ms/int, c2r %.1f ms/int (speedup %.1f)' % (npix, 1e3*times[npix]['complex'], 1e3*times[npix]['c2r'], times[npix]['complex']/times[npix]['c2r']))
+
+    return times
+
+def bench_dtimage(nints=128, nbl=351, nchan=256, npol=2, npix=512, uvres=60, dm=50., dtarr=[1, 2, 4, 8], inttime=0.005):
+    """ Compares time to search all dts in dtarr of one dm as in image1 without dtimage (dedisperse_resample_blocks and imgallfullfilterxypeak per dt)
+    and with dtimage (dedisperse_resample_blocks for dt=1, then imgallfullfilterxydt). Both include dedispersion. Checks that snrs are the same.
+    Returns dict of time per dt=1 int in seconds for each method.
+    """
+
+    data = make_data(nints, nbl, nchan, npol)
+    freq = make_freq(nchan)
+    rand = n.random.RandomState(1)
+    u = n.outer(rand.uniform(-npix*uvres/3, npix*uvres/3, nbl), freq/freq[0]).astype('float32')
+    v = n.outer(rand.uniform(-npix*uvres/3, npix*uvres/3, nbl), freq/freq[0]).astype('float32')
+    gridop = rtlib.calc_gridop(u, v, npix, npix, uvres, True)
+    rtlib.get_fftplan(npix, npix, 1, 1, True)
+
+    times = {}
+    t0 = time.time()
+    recs0 = []
+    for dt in dtarr:
+        data_resamp = n.zeros((nints/dt, nbl, nchan, npol), dtype='complex64')
+        rtlib.dedisperse_resample_blocks(data, data_resamp, freq, inttime, dm, dt, (0, nbl))
+        recs0.append(rtlib.imgallfullfilterxypeak(u, v, data_resamp, npix, npix, uvres, 0., 1, 1, gridop, True)[0])
+    times['perdt'] = (time.time() - t0)/nints
+
+    t0 = time.time()
+    data_resamp = n.zeros((nints, nbl, nchan, npol), dtype='complex64')
+    rtlib.dedisperse_resample_blocks(data, data_resamp, freq, inttime, dm, 1, (0, nbl))
+    recs1 = rtlib.imgallfullfilterxydt(u, v, data_resamp, npix, npix, uvres, 0., dtarr, 1, 1, gridop, True)
+    times['dtimage'] = (time.time() - t0)/nints
+
+    # last ints of each dt have data shifted past end of segment, so only ints that search would use are compared
+    maxint = nints - rtlib.calc_delay(freq, inttime, dm).max()
+    snrdiff = 0.
+    for (dt, r0, r1) in zip(dtarr, recs0, recs1):
+        snr0 = dict([(r['int'], r['snr']) for r in r0 if r['int'] < maxint/dt])
+        snr1 = dict([(r['int'], r['snr']) for r in r1 if r['int'] < maxint/dt])
+        assert sorted(snr0.keys()) == sorted(snr1.keys()), 'dtimage ints differ'
+        snrdiff = max([snrdiff] + [abs(snr0[i] - snr1[i]) for i in snr0])
+    logger.info('\t per dt: %.2f ms/int. dtimage: %.2f ms/int (speedup %.1f). Max snr difference %.1e' % (1e3*times['perdt'], 1e3*times['dtimage'], times['perdt']/times['dtimage'], snrdiff))
+    assert snrdiff < 1e-3, 'dtimage snrs differ'
+
+    return times
+
+def bench_stokesi(nints=128, nbl=351, nchan=256, npol=2, npix=512, uvres=60, dmarr=[0., 25., 50., 75., 100.], dt=1, inttime=0.005):
+    """ Compares time to dedisperse and image trials of dmarr with all pols (dedisperse_resample_blocks and imgallfullfilterxypeak)
+    and after averaging pols to Stokes I once, as in dataprep with stokesi (stokesi, then same functions with one pol).
+    Returns dict of time per int and dm in seconds for each method and bytes of data and data_resamp with each (mem_allpols, mem_stokesi). Stokes I time includes averaging pols.
+    """
+
+    data = make_data(nints, nbl, nchan, npol)
+    freq = make_freq(nchan)
+    rand = n.random.RandomState(1)
+    u = n.outer(rand.uniform(-npix*uvres/3, npix*uvres/3, nbl), freq/freq[0]).astype('float32')
+    v = n.outer(rand.uniform(-npix*uvres/3, npix*uvres/3, nbl), freq/freq[0]).astype('float32')
+    gridop = rtlib.calc_gridop(u, v, npix, npix, uvres, True)
+    rtlib.get_fftplan(npix, npix, 1, 1, True)
+
+    times = {}
+    t0 = time.time()
+    data_resamp = n.zeros((nints/dt, nbl, nchan, npol), dtype='complex64')
+    for dm in dmarr:
+        rtlib.dedisperse_resample_blocks(data, data_resamp, freq, inttime, dm, dt, (0, nbl))
+        rtlib.imgallfullfilterxypeak(u, v, data_resamp, npix, npix, uvres, 0., 1, 1, gridop, True)
+    times['allpols'] = (time.time() - t0)/(nints*len(dmarr))
+    times['mem_allpols'] = data.nbytes + data_resamp.nbytes
+
+    t0 = time.time()
+    data_i = n.zeros((nints, nbl, nchan, 1), dtype='complex64')
+    rtlib.stokesi(data, data_i, range(npol), (0, nbl))
+    data_resamp = n.zeros((nints/dt, nbl, nchan, 1), dtype='complex64')
+    for dm in dmarr:
+        rtlib.dedisperse_resample_blocks(data_i, data_resamp, freq, inttime, dm, dt, (0, nbl))
+        rtlib.imgallfullfilterxypeak(u, v, data_resamp, npix, npix, uvres, 0., 1, 1, gridop, True)
+    times['stokesi'] = (time.time() - t0)/(nints*len(dmarr))
+    times['mem_stokesi'] = data_i.nbytes + data_resamp.nbytes
+
+    logger.info('\t %d pols: %.2f ms/int/dm. Stokes I: %.2f ms/int/dm (speedup %.1f)' % (npol, 1e3*times['allpols'], 1e3*times['stokesi'], times['allpols']/times['stokesi']))
+    logger.info('\t data and data_resamp use %.1f MB with %d pols and %.1f MB with Stokes I' % (times['mem_allpols']/1024.**2, npol, times['mem_stokesi']/1024.**2))
+
+    return times
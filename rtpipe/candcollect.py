@@ -0,0 +1,130 @@
+#
+# Define object for collecting candidates of a segment with bounded memory
+#
+
+import heapq
+import logging
+
+logger = logging.getLogger(__name__)
+
+class CandCollector(object):
+    """ Collects candidates of a segment, as returned by image1 and friends in dicts keyed by (segment, int, dmind, dtind, beamnum).
+    Keeps at most maxcands per segment and maxcands_trial per (dmind, dtind), choosing the largest |snr| with min-heaps. 0 means no limit.
+    Discarded candidates are only counted, so memory is bounded however many candidates are found.
+    features are those in each candidate record (see RT.recordfeatures). snr is only used with a limit.
+    """
+
+    def __init__(self, features, maxcands=0, maxcands_trial=0):
+
+        self.maxcands = maxcands
+        self.maxcands_trial = maxcands_trial
+        self.nfeat = len(features)
+        self.snrcol = snrcol(features) if (maxcands or maxcands_trial) else None
+
+        self.cands = {}   # kept candidates
+        self.heap = []    # (|snr|, candid) of kept cands, only with segment limit. may have stale entries for cands discarded by trial limit.
+        self.trialheaps = {}   # same per (dmind, dtind), only with trial limit. may have stale entries for cands discarded by segment limit.
+        self.nstale = 0
+        self.nkept = {}; self.nfound = {}; self.ndiscarded = {}; self.maxdiscarded = {}
+
+    def add(self, cands):
+        """ Adds dict of candidates, keeping only those allowed by limits.
+        """
+
+        for candid, feat in cands.iteritems():
+            if len(feat) != self.nfeat:
+                raise ValueError('Candidate %s has %d features, but collector expects %d' % (str(candid), len(feat), self.nfeat))
+
+            if candid in self.cands:
+                self.cands[candid] = feat
+                continue
+
+            trial = tuple(candid[2:4])
+            self.cands[candid] = feat
+            self.nfound[trial] = self.nfound.get(trial, 0) + 1
+            self.nkept[trial] = self.nkept.get(trial, 0) + 1
+
+            if self.snrcol is None:   # no limits
+                continue
+
+            entry = (abs(feat[self.snrcol]), candid)
+            if self.maxcands:
+                heapq.heappush(self.heap, entry)
+            if self.maxcands_trial:
+                trialheap = self.trialheaps.setdefault(trial, [])
+                heapq.heappush(trialheap, entry)
+                while self.nkept[trial] > self.maxcands_trial:
+                    self.discard(heapq.heappop(trialheap))
+
+            if self.maxcands:
+                while len(self.cands) > self.maxcands:
+                    self.discard(heapq.heappop(self.heap))
+
+            # each discard leaves entry in other heap. rebuild heaps before they get much bigger than cands.
+            if self.nstale > max(len(self.cands), 1000):
+                self.compact()
+
+    def discard(self, entry):
+        """ Removes candidate of heap entry, if not already removed, and counts it for its trial.
+        """
+
+        snr, candid = entry
+        if candid not in self.cands:
+            return
+
+        del self.cands[candid]
+        self.nstale += 1
+        trial = tuple(candid[2:4])
+        self.nkept[trial] -= 1
+        if trial not in self.ndiscarded:
+            logger.warn('Rate limiting candidates of (dmind, dtind) = %s with maxcands %d and maxcands_trial %d.' % (str(trial), self.maxcands, self.maxcands_trial))
+        self.ndiscarded[trial] = self.ndiscarded.get(trial, 0) + 1
+        self.maxdiscarded[trial] = max(self.maxdiscarded.get(trial, 0.), snr)
+
+    def compact(self):
+        """ Rebuilds heaps from kept candidates, dropping stale entries.
+        """
+
+        if self.snrcol is None:
+            return
+
+        entries = [(abs(feat[self.snrcol]), candid) for (candid, feat) in self.cands.iteritems()]
+        if self.maxcands:
+            self.heap = list(entries)
+            heapq.heapify(self.heap)
+        if self.maxcands_trial:
+            self.trialheaps = {}
+            for entry in entries:
+                self.trialheaps.setdefault(tuple(entry[1][2:4]), []).append(entry)
+            for trialheap in self.trialheaps.itervalues():
+                heapq.heapify(trialheap)
+        self.nstale = 0
+
+    @property
+    def counts(self):
+        """ Dict with (found, discarded, max |snr| discarded) per (dmind, dtind) with candidates.
+        """
+
+        return dict([(trial, (self.nfound[trial], self.ndiscarded.get(trial, 0), self.maxdiscarded.get(trial, 0.))) for trial in self.nfound])
+
+    @property
+    def discarded(self):
+        return sum(self.ndiscarded.values())
+
+    def __len__(self):
+        return len(self.cands)
+
+    def __str__(self):
+        return 'CandCollector(%d cands kept, %d discarded, maxcands %d, maxcands_trial %d)' % (len(self.cands), self.discarded, self.maxcands, self.maxcands_trial)
+
+    def __repr__(self):
+        return self.__str__()
+
+def snrcol(features):
+    """ Returns index of feature used to rank candidates (snr2, snr1 or snrbs, in that order).
+    """
+
+    for feature in ['snr2', 'snr1', 'snrbs']:
+        if feature in features:
+            return features.index(feature)
+    raise ValueError('No snr feature in %s' % str(features))
@@ -0,0 +1,130 @@
+#
+# Define object for dedispersion plan of a segment
+#
+
+import rtlib_cython as rtlib
+import numpy as n
+import os, pickle, hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+_plans = {}   # plans already used by this process, keyed by plankey
+
+class DedispPlan(object):
+    """ Dedispersion plan for segments with given freq, inttime, dmarr, dtarr, readints and nchunk.
+    Precomputes channel delays for each dm, resample factors, and int ranges imaged for each (dm, dt) trial.
+    Only depends on its inputs, so it can be pickled and reused (see get_plan).
+    """
+
+    def __init__(self, freq, inttime, dmarr, dtarr, readints, nchunk=1):
+
+        self.freq = n.array(freq, dtype='float32')
+        self.inttime = inttime
+        self.dmarr = list(dmarr)
+        self.dtarr = list(dtarr)
+        self.readints = readints
+        self.nchunk = nchunk
+        self.key = plankey(freq, inttime, dmarr, dtarr, readints, nchunk)
+
+        # delay per (dm, chan) and max delay per dm
+        self.delay = calc_delaytable(self.freq, inttime, self.dmarr)
+        self.datadelay = self.delay.max(axis=1).astype(int)
+        self.resample = n.array(self.dtarr, dtype=int)
+
+        # int ranges per (dm, dt). index 0 for first segment, which has no overlap to skip, and 1 for others.
+        nskip_dm = (self.datadelay[-1] - self.datadelay[:,None]) // self.resample[None,:]
+        self.nskip = n.array([n.zeros_like(nskip_dm), nskip_dm])
+        self.searchints = (readints - self.datadelay[None,:,None]) // self.resample[None,None,:] - self.nskip
+        chunks = n.arange(nchunk+1)
+        self.chunkedges = self.nskip[...,None] + (self.searchints[...,None]*chunks) // nchunk
+
+    def searchrange(self, dmind, dtind, segment):
+        """ Returns tuple of (first int, number of ints) to image for trial in segment.
+        """
+
+        first = int(segment != 0)
+        return (self.nskip[first, dmind, dtind], self.searchints[first, dmind, dtind])
+
+    def irange(self, dmind, dtind, segment):
+        """ Returns list of (i0, i1) int ranges, one per imaging chunk, for trial in segment.
+        """
+
+        edges = self.chunkedges[int(segment != 0), dmind, dtind]
+        return [(edges[chunk], edges[chunk+1]) for chunk in range(self.nchunk)]
+
+    def dtimagerange(self, dmind, segment):
+        """ Returns list of (i0, i1) ranges of dt=1 ints, one per imaging chunk, that cover search range of every dt of dm in segment.
+        Edges are multiples of max(dtarr), so ints summed for any dt are in one range. Used to image each dt by summing dt=1 images.
+        """
+
+        first = int(segment != 0)
+        maxdt = max(self.dtarr)
+        start = min(self.nskip[first, dmind]*self.resample)
+        stop = max((self.nskip[first, dmind] + self.searchints[first, dmind])*self.resample)
+        nblock = (stop - (start//maxdt)*maxdt + maxdt - 1)//maxdt
+        edges = [(start//maxdt + (nblock*chunk)//self.nchunk)*maxdt for chunk in range(self.nchunk+1)]
+        edges[-1] = min(edges[-1], self.readints)
+        return [(int(edges[chunk]), int(edges[chunk+1])) for chunk in range(self.nchunk) if edges[chunk] < edges[chunk+1]]
+
+    def save(self, planfile):
+        with open(planfile, 'wb') as pkl:
+            pickle.dump(self, pkl, protocol=2)
+
+    def __str__(self):
+        return 'DedispPlan(%d dms, dts %s, %d ints, %d chunks)' % (len(self.dmarr), self.dtarr, self.readints, self.nchunk)
+
+    def __repr__(self):
+        return self.__str__()
+
+def calc_delaytable(freq, inttime, dmarr):
+    """ Returns array of delay in ints with shape (len(dmarr), nchan), as from calc_delay for each dm.
+    """
+
+    return n.array([rtlib.calc_delay(n.array(freq, dtype='float32'), inttime, dm) for dm in dmarr], dtype=n.int16).reshape(len(dmarr), len(freq))
+
+def plankey(freq, inttime, dmarr, dtarr, readints, nchunk):
+    """ Returns string that uniquely defines plan inputs. Used to name cached plans.
+    """
+
+    key = hashlib.md5()
+    key.update(n.array(freq, dtype='float32').tostring())
+    key.update(n.array(dmarr, dtype='float64').tostring())
+    key.update(repr((float(inttime), [int(dt) for dt in dtarr], int(readints), int(nchunk))))
+    return key.hexdigest()
+
+def getplanfile(d):
+    """ Return name of cached plan file for a given dictionary.
+    """
+
+    return os.path.join(d['workdir'], 'plan_' + plankey(d['freq'], d['inttime'], d['dmarr'], d['dtarr'], d['readints'], d['nchunk']) + '.pkl')
+
+def get_plan(d):
+    """ Returns DedispPlan for pipeline state dict d.
+    Uses plan already made by this process or cached in workdir, if available. Otherwise, makes and caches it.
+    """
+
+    planfile = getplanfile(d)
+    if planfile in _plans:
+        return _plans[planfile]
+
+    plan = None
+    if os.path.exists(planfile):
+        try:
+            with open(planfile, 'rb') as pkl:
+                plan = pickle.load(pkl)
+            logger.debug('Read dedispersion plan from %s' % planfile)
+        except Exception:
+            logger.warn('Could not read plan file %s. Remaking plan.' % planfile)
+            plan = None
+
+    if plan is None:
+        plan = DedispPlan(d['freq'], d['inttime'], d['dmarr'], d['dtarr'], d['readints'], d['nchunk'])
+        try:
+            plan.save(planfile)
+            logger.debug('Saved dedispersion plan to %s' % planfile)
+        except IOError:
+            logger.warn('Could not save plan file %s.' % planfile)
+
+    _plans[planfile] = plan
+    return plan
@@ -562,16 +562,7 @@ def make_psrrates(pkllist, nbins=60, period=0.156):
 
     # get metadata
     state = pickle.load(open(pkllist[0], 'r'))  # assume single state for all scans
-    if 'image2' in state['searchtype']:
-        immaxcol = state['features'].index('immax2')
-        logger.info('Using immax2 for flux.')
-    elif 'image1' in state['searchtype']:
-        try:
-            immaxcol = state['features'].index('immax1')
-            logger.info('Using immax1 for flux.')
-        except:
-            immaxcol = state['features'].index('snr1')
-            logger.info('Warning: Using snr1 for flux.')
+    immaxcol = get_fluxcol(state)
 
     # read cands
     for pklfile in pkllist:
@@ -629,6 +620,44 @@ def make_psrrates(pkllist, nbins=60, period=0.156):
     else:
         return {0: n.array(f0).transpose(), 1: n.array(f1).transpose(), 2: n.array(f2).transpose()}
 
+def get_fluxcol(state):
+    """ Returns index of feature used as flux of pulsar cands (immax2, immax1 or snr1, depending on searchtype).
+    """
+
+    if 'image2' in state['searchtype']:
+        immaxcol = state['features'].index('immax2')
+        logger.info('Using immax2 for flux.')
+    elif 'image1' in state['searchtype']:
+        try:
+            immaxcol = state['features'].index('immax1')
+            logger.info('Using immax1 for flux.')
+        except:
+            immaxcol = state['features'].index('snr1')
+            logger.info('Warning: Using snr1 for flux.')
+    return immaxcol
+
+def make_psrprofile(pklfile, dmind=0, beamnum=0):
+    """ Makes pulse profile from pkl file of search with psrperiod, which images each phase bin once per segment.
+    Flux of each phase bin is mean over segments of flux column, as for make_psrrates. Bins without cands have flux 0.
+    Returns tuple of arrays (phase, flux), with phase at start of each bin.
+    """
+
+    state = pickle.load(open(pklfile, 'r'))
+    assert state['psrperiod'], 'pkl file not from search with psrperiod'
+    immaxcol = get_fluxcol(state)
+
+    flux = n.zeros(state['psrnbins']); count = n.zeros(state['psrnbins'])
+    loc, prop = read_candidates(pklfile)
+    if len(loc):
+        times = int2mjd(state, loc) - 24*3600*state['segmenttimes'][0, 0] + 0.5*state['inttime']   # middle of int, as in RT.calc_psrbins
+        bins = (n.mod(times/state['psrperiod'], 1.)*state['psrnbins']).astype(int) % state['psrnbins']
+        for i in range(len(loc)):
+            if (loc[i, state['featureind'].index('dmind')] == dmind) and (loc[i, state['featureind'].index('beamnum')] == beamnum):
+                flux[bins[i]] += prop[i][immaxcol]
+                count[bins[i]] += 1
+
+    return n.arange(state['psrnbins'])/float(state['psrnbins']), flux/n.maximum(count, 1)
+
 def plot_psrrates(pkllist, outname=''):
     """ Plot cumulative rate histograms. List of pkl files in order, as for make_psrrates.
     """
@@ -233,7 +233,7 @@ def readiterinit(d):
     selection = {'time': [starttime, stoptime], 'uvdist': [1., 1e10], 'antenna1': d['ants'], 'antenna2': d['ants']}    # exclude auto-corrs
     ms.select(items = selection)
     ms.selectpolarization(d['pols'])
-    ms.iterinit(['TIME'], 0, d['iterint']*d['nbl']*d['nspw']*d['npol'], adddefaultsortcolumns=False)
+    ms.iterinit(['TIME'], 0, d['iterint']*d['nbl']*d['nspw']*len(d['pols']), adddefaultsortcolumns=False)
     iterstatus = ms.iterorigin()
 
 def readiter(d):
@@ -16,16 +16,33 @@ class Params(object):
         self.chans = []; self.spw = []    
         self.nskip = 0; self.excludeants = []; self.read_tdownsample = 1; self.read_fdownsample = 1
         self.selectpol = ['RR', 'LL', 'XX', 'YY']   # default processing assumes dual-pol
+        self.stokesi = False   # average parallel-hand pols to Stokes I before search. not for tlayout
         self.nthread = 1; self.nchunk = 0; self.nsegments = 0; self.scale_nsegments = 1
         self.timesub = ''
         self.dmarr = []; self.dtarr = [1]    # dmarr = [] will autodetect, given other parameters
+        self.dtimage = False   # image dt=1 only and sum images for larger dt (image1 only)
+        self.dtpyramid = False   # if True, each dt is resampled from previous dt (each a multiple of the last), rather than from data
+        self.dedisptype = 'brute'; self.nsubband = 0; self.subbandtol = 0   # dedispersion engine ('brute', 'subband', 'image', or 'fdmt'). nsubband = 0 will autodetect. tol is max channel delay error in ints
+        self.chanavg = 1   # max channels averaged after dedispersion. 1 for no averaging
+        self.tlayout = False   # segment data is time contiguous (nbl, npol, nchan, nints). brute dedisptype only
         self.dm_maxloss = 0.05; self.maxdm = 0; self.dm_pulsewidth = 3000   # dmloss is fractional sensitivity loss, maxdm in pc/cm3, width in microsec
+        self.dm_refineloss = 0.   # dm loss of coarse first pass. 0 for no refinement (image1 only)
         self.searchtype = 'image1'; self.sigma_image1 = 7.; self.sigma_image2 = 7.
+        self.psrperiod = 0.; self.psrnbins = 16   # fold period (s) and phase bins. 0 for no folding (image1 only)
+        self.sigma_bispec = 5.; self.bispec_image = False   # bispectrum search threshold. bispec_image images ints above it
         self.l0 = 0.; self.m0 = 0.
+        self.beams = []   # (l, m) phase centers searched in one pass. [] for phase center only
         self.uvres = 0; self.npix = 0; self.uvoversample = 1.
+        self.fftthreads = 1; self.fftbatch = 1   # threads per fft in each of nthread imaging processes, and ints imaged per batched fft (larger batches help with fftthreads > 1)
+        self.fftc2r = False   # image with complex-to-real ffts of hermitian half uv grid
+        self.sigma_prefilter = 0.; self.prefilter_topk = 0   # incoherent power threshold and top ints per trial to image (image1 only). 0 for all
+        self.minvalidfrac = 0.   # min fraction of nonzero vis for an int to be imaged
+        self.npix_coarse = 0; self.uvmax_coarse = 0.; self.sigma_coarse = 0.   # coarse first pass npix, uv range (0 for all) and threshold (0 scales from sigma_image1)
         self.flaglist = [('badchtslide', 4., 0.) , ('badap', 3., 0.2), ('blstd', 3.0, 0.05)]
         self.flagantsol = True; self.gainfile = ''; self.bpfile = ''; self.fileroot = ''
+        self.maxcands = 0; self.maxcands_trial = 0   # max cands kept per segment and per dm/dt trial. 0 for no limit
         self.savenoise = False; self.savecands = False
+        self.savepeaks = False   # save peak snr and pixel of every imaged int (image1 only)
         self.writebdfpkl = False
                            
         # overload with the parameter file values, if provided
@@ -0,0 +1,115 @@
+#
+# functions to re-threshold, cluster and plot peaks files saved by search with savepeaks
+#
+
+import numpy as n
+from scipy import ndimage
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import pickle, os
+import rtpipe.RT as rt
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+def read_peaks(candsfile):
+    """ Reads state dict from segment candsfile and memory maps its peaks file (see RT.peaksshape).
+    Returns tuple (d, peaks). peaks is read-only and only read from disk as used.
+    """
+
+    with open(candsfile, 'rb') as pkl:
+        d = pickle.load(pkl)
+
+    peaks = n.load(rt.getpeaksfile(d), mmap_mode='r')
+    assert peaks.shape == rt.peaksshape(d), 'Peaks file shape %s does not match state %s' % (str(peaks.shape), str(rt.peaksshape(d)))
+    return d, peaks
+
+def find_peaks(d, peaks, sigma, cluster=True):
+    """ Thresholds peaks at |snr| > sigma. sigma below sigma_image1 of search finds cands it did not save.
+    If cluster, neighboring (dm, int) above threshold for each beam and dt are one cand at their max |snr|.
+    Returns tuple (loc, snr, size). loc has columns (segment, int, dmind, dtind, beamnum), as d['featureind'], with int in units of inttime. size is number of (dm, int) in each cluster.
+    """
+
+    loc = []; snr = []; size = []
+    nbeam, ndm, ndt, nints = peaks.shape
+    for beamnum in xrange(nbeam):
+        for dtind in xrange(ndt):
+            snrs = n.abs(peaks['snr'][beamnum, :, dtind])
+            mask = snrs > sigma
+            if not mask.any():
+                continue
+
+            if cluster:
+                labels, nlabel = ndimage.label(mask, structure=n.ones((3,3)))
+                index = range(1, nlabel+1)
+                positions = ndimage.maximum_position(snrs, labels, index)
+                sizes = ndimage.sum(mask, labels, index)
+            else:
+                positions = zip(*n.where(mask))
+                sizes = [1]*len(positions)
+
+            for ((dmind, i), size1) in zip(positions, sizes):
+                loc.append((d['segment'], i*d['dtarr'][dtind], dmind, dtind, beamnum))
+                snr.append(peaks['snr'][beamnum, dmind, dtind, i])
+                size.append(int(size1))
+
+    loc = n.array(loc, dtype=int).reshape(len(loc), 5)
+    logger.info('Found %d %s above %.1f sigma.' % (len(loc), 'clusters' if cluster else 'peaks', sigma))
+    return loc, n.array(snr), n.array(size)
+
+def peaks_lm(d, peaks, loc):
+    """ Returns arrays (l1, m1) of peak pixel for each location in loc (as from find_peaks), including offset of its beam.
+    """
+
+    l1 = []; m1 = []
+    for (segment, i, dmind, dtind, beamnum) in loc:
+        peak = peaks[beamnum, dmind, dtind, i/d['dtarr'][dtind]]
+        ll, mm = rt.calc_lm(d, (d['npixx'], d['npixy']), pix=(peak['peakx'], peak['peaky']))
+        if d['beams']:
+            ll += d['beams'][beamnum][0] - d['l0']
+            mm += d['beams'][beamnum][1] - d['m0']
+        l1.append(ll); m1.append(mm)
+    return n.array(l1), n.array(m1)
+
+def plot_butterfly(d, peaks, beamnum=0, outroot='', sigma=0):
+    """ Plots DM versus time of peak |snr| for each dt, as saved by search. Only |snr| > sigma is shown.
+    """
+
+    if not outroot:
+        outroot = '_'.join([d['fileroot'], 'sc' + str(d['scan']), 'seg' + str(d['segment'])])
+    outname = os.path.join(d['workdir'], 'plot_' + outroot + '_butterfly.png')
+
+    nbeam, ndm, ndt, nints = peaks.shape
+    fig = plt.Figure(figsize=(15,10))
+    for dtind in xrange(ndt):
+        snrs = n.abs(peaks['snr'][beamnum, :, dtind, :nints/d['dtarr'][dtind]])
+        snrs = n.where(snrs > sigma, snrs, 0)
+        ax = fig.add_subplot(ndt, 1, dtind+1)
+        im = ax.imshow(snrs, origin='lower', aspect='auto', interpolation='nearest', cmap=plt.cm.gray_r,
+                       extent=(0, nints*d['inttime'], min(d['dmarr']), max(d['dmarr'])))
+        ax.text(0.95, 0.9, 'dt=' + str(d['dtarr'][dtind]), transform=ax.transAxes, ha='right')
+        ax.set_ylabel('DM (pc/cm3)')
+        fig.colorbar(im, ax=ax, label='|SNR|')
+    ax.set_xlabel('Time in segment (s)', fontsize=20)
+    canvas = FigureCanvasAgg(fig)
+    canvas.print_figure(outname)
+    logger.info('Saved butterfly plot to %s' % outname)
+
+def rethreshold(candsfile, sigma, cluster=True, plot=True):
+    """ Finds cands in peaks file of segment candsfile above new threshold sigma without imaging again.
+    Returns dict like search, keyed by cand location with features (snr1, l1, m1). Clustered cands also have their cluster size.
+    """
+
+    d, peaks = read_peaks(candsfile)
+    loc, snr, size = find_peaks(d, peaks, sigma, cluster)
+    l1, m1 = peaks_lm(d, peaks, loc)
+    if plot:
+        plot_butterfly(d, peaks, sigma=sigma)
+
+    cands = {}
+    for i in xrange(len(loc)):
+        cands[tuple(loc[i])] = [float(snr[i]), l1[i], m1[i]] + ([size[i]] if cluster else [])
+    return cands
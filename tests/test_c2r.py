@@ -0,0 +1,103 @@
+#
+# regression tests of c2r imaging against complex fft imaging and the original per-int imager
+#
+
+import pytest
+
+rtlib = pytest.importorskip('rtlib_cython')
+import numpy as n
+
+nints, nbl, nchan, npol, npix, uvres = 8, 100, 32, 2, 128, 60
+
+@pytest.fixture(scope='module')
+def uvdata():
+    """ Noise visibilities with a point source in one int and uv coords within the grid.
+    """
+
+    rand = n.random.RandomState(0)
+    data = n.empty((nints, nbl, nchan, npol), dtype='complex64')
+    data.real = rand.normal(size=data.shape)
+    data.imag = rand.normal(size=data.shape)
+    data[nints/2] += 2.
+    data[1] = 0j    # empty int is not imaged
+
+    freq = n.linspace(1.2, 1.7, nchan, endpoint=False).astype('float32')
+    u = n.outer(rand.uniform(-npix*uvres/3, npix*uvres/3, nbl), freq/freq[0]).astype('float32')
+    v = n.outer(rand.uniform(-npix*uvres/3, npix*uvres/3, nbl), freq/freq[0]).astype('float32')
+    return u, v, data
+
+def baselineimage(u, v, data):
+    """ Image of one int of data (nbl, nchan, npol) as made by the original imgonefullxy, without gridding operators.
+    Visibilities go to nearest uv cell and image is real part of complex inverse fft, scaled by number of nonzero gridded visibilities.
+    Returns (image, snr) with image recentered and snr of most extreme pixel.
+    """
+
+    uu = n.round(u/uvres).astype(int)
+    vv = n.round(v/uvres).astype(int)
+    ok = (n.abs(uu) < npix/2) & (n.abs(vv) < npix/2)
+    grid = n.zeros((npix, npix), dtype='complex128')
+    n.add.at(grid, (n.mod(uu[ok], npix), n.mod(vv[ok], npix)), data[ok].sum(axis=-1))
+    im = n.fft.ifft2(grid).real*npix*npix/n.count_nonzero(data[ok])
+    im = n.roll(n.roll(im, npix/2, axis=0), npix/2, axis=1)
+    snr = im.max()/im.std() if im.max() >= -im.min() else im.min()/im.std()
+    return im, snr
+
+def assert_sameimage(im0, im1):
+    """ Images have same peak flux, peak location and std.
+    """
+
+    assert n.unravel_index(n.abs(im0).argmax(), im0.shape) == n.unravel_index(n.abs(im1).argmax(), im1.shape)
+    assert n.allclose(n.abs(im0).max(), n.abs(im1).max(), rtol=1e-4)
+    assert n.allclose(im0.std(), im1.std(), rtol=1e-4)
+
+@pytest.mark.parametrize('c2r', [False, True])
+def test_imgonefullxy_baseline(uvdata, c2r):
+    u, v, data = uvdata
+    im0, snr0 = baselineimage(u, v, data[nints/2])
+    im1 = rtlib.imgonefullxy(u, v, data[nints/2], npix, npix, uvres, verbose=0, c2r=c2r)
+    assert_sameimage(im0, im1)
+
+@pytest.mark.parametrize('c2r', [False, True])
+def test_imgallfullfilterxyflux_baseline(uvdata, c2r):
+    u, v, data = uvdata
+    gridop = rtlib.calc_gridop(u, v, npix, npix, uvres, c2r)
+    ims, snrs, ints = rtlib.imgallfullfilterxyflux(u, v, data, npix, npix, uvres, 0., 1, 3, gridop, c2r)
+
+    for (im1, snr1, i) in zip(ims, snrs, ints):
+        im0, snr0 = baselineimage(u, v, data[i])
+        assert_sameimage(im0, im1)
+        assert n.allclose(snr0, snr1, rtol=1e-4)
+
+def test_imgonefullxy(uvdata):
+    u, v, data = uvdata
+    im0 = rtlib.imgonefullxy(u, v, data[nints/2], npix, npix, uvres, verbose=0, c2r=False)
+    im1 = rtlib.imgonefullxy(u, v, data[nints/2], npix, npix, uvres, verbose=0, c2r=True)
+
+    assert im0.shape == im1.shape
+    assert n.abs(im0 - im1).max() < 1e-4*n.abs(im0).max()
+
+@pytest.mark.parametrize('batch', [1, 3])
+def test_imgallfullfilterxyflux(uvdata, batch):
+    u, v, data = uvdata
+    results = []
+    for c2r in [False, True]:
+        gridop = rtlib.calc_gridop(u, v, npix, npix, uvres, c2r)
+        results.append(rtlib.imgallfullfilterxyflux(u, v, data, npix, npix, uvres, 0., 1, batch, gridop, c2r))
+    (ims0, snrs0, ints0), (ims1, snrs1, ints1) = results
+
+    assert ints0 == ints1
+    assert nints/2 in ints0 and 1 not in ints0
+    assert n.allclose(snrs0, snrs1, rtol=1e-4)
+    for (im0, im1) in zip(ims0, ims1):
+        assert n.abs(im0 - im1).max() < 1e-4*n.abs(im0).max()
+
+def test_imgallfullfilterxyflux_threshold(uvdata):
+    u, v, data = uvdata
+    results = []
+    for c2r in [False, True]:
+        gridop = rtlib.calc_gridop(u, v, npix, npix, uvres, c2r)
+        results.append(rtlib.imgallfullfilterxyflux(u, v, data, npix, npix, uvres, 7., 1, 1, gridop, c2r))
+    (ims0, snrs0, ints0), (ims1, snrs1, ints1) = results
+
+    assert ints0 == ints1 == [nints/2]
+    assert n.allclose(snrs0, snrs1, rtol=1e-4)
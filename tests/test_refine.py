@@ -0,0 +1,77 @@
+#
+# tests of dm refinement (dm_refineloss) with dt pyramid
+#
+
+import pytest
+
+rtlib = pytest.importorskip('rtlib_cython')
+rt = pytest.importorskip('rtpipe.RT')
+import numpy as n
+import multiprocessing.sharedctypes as mps
+
+nints, nbl, nchan, npol = 200, 60, 32, 1
+
+def test_refinedtinds():
+    """ Lower dts of refined trial are dedispersed with dtpyramid, since each dt is made from the one before.
+    """
+
+    refineints = {(3, 1): n.arange(10), (5, 0): n.arange(10)}
+    assert rt.calc_refinedtinds({'dtarr': [1, 4], 'dtpyramid': True}, 3, refineints) == [0, 1]
+    assert rt.calc_refinedtinds({'dtarr': [1, 4], 'dtpyramid': False}, 3, refineints) == [1]
+    assert rt.calc_refinedtinds({'dtarr': [1, 4], 'dtpyramid': True}, 5, refineints) == [0]
+    assert rt.calc_refinedtinds({'dtarr': [1, 4], 'dtpyramid': True}, 4, refineints) == []
+
+def search(dtpyramid):
+    """ Searches noise with a wide pulse at dm 117 that first pass finds only at dt=4.
+    Returns cands and refineints of second pass.
+    """
+
+    freq = n.linspace(1.2, 1.7, nchan, endpoint=False).astype('float32')
+    d = dict(readints=nints, nbl=nbl, nchan=nchan, npol=npol, freq=freq, freq_orig=freq, inttime=0.002, dtarr=[1, 4],
+             npixx=64, npixy=64, npix=64, uvres=60, fftc2r=True, fftbatch=4, fftthreads=1, nthread=2, nchunk=2, segment=1, scan=1,
+             fileroot='test', workdir='.', filename='test', features=['snr1', 'immax1', 'l1', 'm1'], featureind=['segment', 'int', 'dmind', 'dtind', 'beamnum'],
+             searchtype='image1', sigma_image1=7., sigma_prefilter=0, prefilter_topk=0, npix_coarse=0, beams=[], dedisptype='brute', nsubband=0, subbandtol=0,
+             dtpyramid=dtpyramid, tlayout=False, dtimage=False, chanavg=1, stokesi=False, savecands=False, savepeaks=False, maxcands=0, maxcands_trial=0,
+             l0=0., m0=0., minvalidfrac=0., psrperiod=0., dm_pulsewidth=2000., dm_refineloss=0.3)
+    d['dmarr'] = rt.calc_dmgrid(d, maxloss=0.05, dt=2000., maxdm=200.)
+    d['datadelay'] = list(rt.dp.calc_delaytable(d['freq'], d['inttime'], d['dmarr']).max(axis=1))
+
+    data_mem = mps.Array(mps.ctypes.c_float, rt.datasize(d)*2)
+    data = rt.numpyview(data_mem, 'complex64', rt.datashape(d))
+    rand = n.random.RandomState(0)
+    data.real = rand.normal(size=data.shape)
+    data.imag = rand.normal(size=data.shape)
+    delay = rtlib.calc_delay(d['freq'], d['inttime'], 117.)
+    for k in xrange(nchan):
+        data[30+delay[k]:46+delay[k], :, k] += 0.1
+
+    uvw = [mps.Array(mps.ctypes.c_float, nbl) for i in range(3)]
+    rand = n.random.RandomState(2)
+    for arr in uvw:
+        rt.numpyview(arr, 'float32', nbl)[:] = rand.uniform(-1000, 1000, nbl)
+
+    refineints = {}
+    calc_refineints = rt.calc_refineints
+    def record(*args):
+        refineints.update(calc_refineints(*args))
+        return refineints
+    rt.calc_refineints = record
+    try:
+        cands = rt.search(d, data_mem, *uvw)
+    finally:
+        rt.calc_refineints = calc_refineints
+    return cands, refineints
+
+def test_refine_dtpyramid(tmpdir):
+    """ Refined trial at dt=4 without dt=1 finds same cands with dtpyramid as without.
+    """
+
+    with tmpdir.as_cwd():
+        cands0, refineints = search(False)
+        cands1, refineints1 = search(True)
+
+    assert any([(dmind, 0) not in refineints for (dmind, dtind) in refineints if dtind == 1])
+    assert len(cands0)
+    assert sorted(cands0.keys()) == sorted(cands1.keys())
+    for candid in cands0:
+        assert n.allclose(cands0[candid], cands1[candid])